@@ -0,0 +1,69 @@
+import threading
+
+import paho.mqtt.client as mqtt
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
+
+# MQTT v5 topic aliases. With an alias the broker learns the topic once per
+# connection, after that each publish only carries a 2 byte alias instead of e.g.
+# "bms/pack_12/v_cells/cell_16". Aliases are only valid for one connection, so they
+# are handed out again after every (re)connect.
+
+
+def protocol(config):
+
+    # paho protocol for the mqtt_protocol option, "3.1.1" (default) or "5"
+    if str(config.get('mqtt_protocol', "3.1.1")) == "5":
+        return mqtt.MQTTv5
+    return mqtt.MQTTv311
+
+
+class TopicAliasClient:
+
+    # Stands in for the paho client in the sinks. The first topics published after a
+    # connect get an alias, up to the lower of limit and the broker's Topic Alias
+    # Maximum; the publish order of a poll cycle is the same every time, so that is
+    # the stable set of per pack topics. Everything else is published as before.
+
+    def __init__(self, client, limit=64):
+        self.client = client
+        self.limit = limit
+        self.maximum = 0
+        self.aliases = {}
+        self.properties = []
+        self.lock = threading.Lock()
+
+    def reset(self, connack_properties=None):
+
+        # Call from on_connect with the CONNACK properties. A broker that does not
+        # send Topic Alias Maximum does not accept aliases
+        maximum = getattr(connack_properties, "TopicAliasMaximum", 0) or 0
+        with self.lock:
+            self.maximum = min(self.limit, maximum)
+            self.aliases.clear()
+
+    def alias_properties(self, alias):
+        while len(self.properties) < alias:
+            properties = Properties(PacketTypes.PUBLISH)
+            properties.TopicAlias = len(self.properties) + 1
+            self.properties.append(properties)
+        return self.properties[alias - 1]
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+
+        with self.lock:
+
+            alias = self.aliases.get(topic)
+            if alias is not None:
+                return self.client.publish("", payload, qos, retain, properties=self.alias_properties(alias))
+
+            if len(self.aliases) < self.maximum:
+                # The first publish sends topic and alias so the broker can map them.
+                # If it never left, the broker does not know the alias yet
+                alias = len(self.aliases) + 1
+                info = self.client.publish(topic, payload, qos, retain, properties=self.alias_properties(alias))
+                if info.rc == mqtt.MQTT_ERR_SUCCESS:
+                    self.aliases[topic] = alias
+                return info
+
+        return self.client.publish(topic, payload, qos, retain)
@@ -0,0 +1,107 @@
+# Micro-benchmark: legacy 0x42 analog parsing vs the compiled layouts.PACE decoder
+# Run from the repository root: python3 benchmarks/bench_analog.py [packs]
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import constants
+import decoders
+import layouts
+
+
+def make_info(packs, cells=16, temps=6):
+
+    info = '00%02X' % packs
+    for p in range(packs):
+        info += '%02X' % cells
+        info += ''.join('%04X' % (3300 + (p + i) % 40) for i in range(cells))
+        info += '%02X' % temps
+        info += ''.join('%04X' % (2980 + i) for i in range(temps))
+        info += '%04X%04X%04X%02X%04X%04X%04X%02X' % (0xFF38, 53120, 9000, 3, 10000, 42, 10000, 0)
+    return info.encode()
+
+
+def legacy_parse(inc_data):
+
+    byte_index = 2
+    i_pack = []
+    v_pack = []
+    i_remain_cap = []
+    i_full_cap = []
+    cycles = []
+    i_design_cap = []
+
+    packs = int(inc_data[byte_index:byte_index+2],16)
+    byte_index += 2
+
+    v_cell = {}
+    t_cell = {}
+
+    for p in range(1,packs+1):
+
+        cells = int(inc_data[byte_index:byte_index+2],16)
+        byte_index += 2
+
+        for i in range(0,cells):
+            v_cell[(p-1,i)] = int(inc_data[byte_index:byte_index+4],16)
+            byte_index += 4
+
+        temps = int(inc_data[byte_index:byte_index + 2],16)
+        byte_index += 2
+
+        for i in range(0,temps):
+            t_cell[(p-1,i)] = (int(inc_data[byte_index:byte_index + 4],16)-2730)/10
+            byte_index += 4
+
+        i_pack.append(int(inc_data[byte_index:byte_index+4],16))
+        byte_index += 4
+        if i_pack[p-1] >= 32768:
+            i_pack[p-1] = -1*(65535 - i_pack[p-1])
+        i_pack[p-1] = i_pack[p-1]/100
+
+        v_pack.append(int(inc_data[byte_index:byte_index+4],16)/1000)
+        byte_index += 4
+
+        i_remain_cap.append(int(inc_data[byte_index:byte_index+4],16)*10)
+        byte_index += 4
+
+        byte_index += 2
+
+        i_full_cap.append(int(inc_data[byte_index:byte_index+4],16)*10)
+        byte_index += 4
+
+        cycles.append(int(inc_data[byte_index:byte_index+4],16))
+        byte_index += 4
+
+        i_design_cap.append(int(inc_data[byte_index:byte_index+4],16)*10)
+        byte_index += 4
+
+        byte_index += 2
+
+        if (byte_index < len(inc_data)) and (cells != int(inc_data[byte_index:byte_index+2],16)):
+            byte_index += 2
+
+    return v_cell, t_cell
+
+
+def main():
+
+    packs = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    info = make_info(packs)
+    decoder = decoders.compile_dialect(layouts.PACE)[constants.cid2PackAnalogData]
+
+    decoder.decode(info)
+    v_cell, t_cell = legacy_parse(info)
+    assert all(decoder.items('v_cells', 'cells', p)[i] == v_cell[(p,i)] for (p,i) in v_cell)
+
+    number = 200
+    t_legacy = min(timeit.repeat(lambda: legacy_parse(info), number=number, repeat=5)) / number * 1e6
+    t_new = min(timeit.repeat(lambda: decoder.decode(info), number=number, repeat=5)) / number * 1e6
+    print("0x42 decode, %d packs x 16 cells   legacy %8.1f us   decoder %8.1f us   x%.1f" % (packs, t_legacy, t_new, t_legacy / t_new))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+# Micro-benchmark: legacy string based checksums vs codec.py
+# Run from the repository root: python3 benchmarks/bench_codec.py
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import codec
+
+# 16 cell analog response, as received from a single pack
+RESPONSE = b'~25014600D0F40002100DD50DBC0DD70DD70DD40DD70DD20DD50DD30DD60DC10DD40DD50DD70DD30DD5060B760B710B700B7A0B7D0B9D0000DD2326A90226AC011126AC64100DD30DBD0DD40DC60DD50DD40DD50DD50DD60DD60DD40DD20DD3'
+
+
+def legacy_chksum_calc(data):
+
+    chksum = 0
+    for element in range(1, len(data)):
+        chksum += (data[element])
+
+    chksum = chksum % 65536
+    chksum = '{0:016b}'.format(chksum)
+
+    flip_bits = ''
+    for i in chksum:
+        if i == '0':
+            flip_bits += '1'
+        else:
+            flip_bits += '0'
+
+    chksum = flip_bits
+    chksum = int(chksum,2)+1
+
+    return format(chksum, 'X')
+
+
+def legacy_lchksum_calc(lenid):
+
+    chksum = 0
+    for element in range(0, len(lenid)):
+        chksum += int(chr(lenid[element]),16)
+
+    chksum = chksum % 16
+    chksum = '{0:04b}'.format(chksum)
+
+    flip_bits = ''
+    for i in chksum:
+        if i == '0':
+            flip_bits += '1'
+        else:
+            flip_bits += '0'
+
+    chksum = flip_bits
+    chksum = int(chksum,2)
+
+    chksum += 1
+
+    if chksum > 15:
+        chksum = 0
+
+    return format(chksum, 'X')
+
+
+def legacy_build_request(ver, adr, cid1, cid2, info):
+
+    request = b'\x7e' + ver + adr + cid1 + cid2
+    LENID = bytes(format(len(info), '03X'), "ASCII")
+    if LENID == b'000':
+        LCHKSUM = '0'
+    else:
+        LCHKSUM = legacy_lchksum_calc(LENID)
+    request += bytes(LCHKSUM, "ASCII") + LENID + info
+    request += bytes(legacy_chksum_calc(request), "ASCII")
+    return request + b'\x0d'
+
+
+def bench(name, legacy, new, number):
+
+    t_legacy = min(timeit.repeat(legacy, number=number, repeat=5)) / number * 1e6
+    t_new = min(timeit.repeat(new, number=number, repeat=5)) / number * 1e6
+    print("%-22s legacy %8.2f us   codec %8.2f us   x%.1f" % (name, t_legacy, t_new, t_legacy / t_new))
+
+
+def main():
+
+    assert legacy_build_request(b'25', b'01', b'46', b'42', b'FF') == codec.build_request(b'25', b'01', b'46', b'42', b'FF')
+    assert legacy_chksum_calc(RESPONSE).encode() == codec.chksum(RESPONSE)
+
+    bench("response CHKSUM", lambda: legacy_chksum_calc(RESPONSE), lambda: codec.chksum(RESPONSE), 2000)
+    bench("LCHKSUM", lambda: legacy_lchksum_calc(b'0D0'), lambda: codec.LENGTH_FIELDS[0x0D0][0], 20000)
+    bench("request frame (0x42)", lambda: legacy_build_request(b'25', b'01', b'46', b'42', b'FF'), lambda: codec.build_request(b'25', b'01', b'46', b'42', b'FF'), 20000)
+
+
+if __name__ == "__main__":
+    main()
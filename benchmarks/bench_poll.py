@@ -0,0 +1,57 @@
+# Benchmark: full 0x42 / 0x44 / 0xA6 transactions against the simulated BMS over TCP,
+# request encoding, framing, checksums and decoding included, no hardware needed
+# Run from the repository root: python3 benchmarks/bench_poll.py [packs] [cells]
+
+import os
+import socket
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import codec
+import constants
+import decoders
+import layouts
+import simulator
+import snapshot
+import transport
+
+COMMANDS = (
+    (constants.cid2PackAnalogData, b'FF', snapshot.packs_from),
+    (constants.cid2WarnInfo, b'FF', snapshot.status_from),
+    (constants.cid2PackCapacity, b'', snapshot.capacity_from),
+)
+
+
+def main():
+
+    packs = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    cells = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+
+    server = simulator.serve_tcp(simulator.Simulator(packs, cells, latency=0), 0, "127.0.0.1")
+    comms = socket.create_connection(server.server_address)
+    reassembler = transport.FrameReassembler()
+    dialect = decoders.compile_dialect(layouts.PACE)
+
+    print("%d packs x %d cells" % (packs, cells))
+    for cid2, info, build in COMMANDS:
+        decoder = dialect[cid2]
+        request = codec.build_request(b'25', b'01', b'46', cid2, info)
+        number = 200
+        started = time.perf_counter()
+        for _ in range(number):
+            comms.sendall(request)
+            success, INFO = codec.parse_response(reassembler.read_frame(comms, 2))
+            assert success, INFO
+            decoder.decode(INFO)
+            build(decoder)
+        elapsed = (time.perf_counter() - started) / number
+        print("%-6s %6d bytes INFO   %8.1f us per transaction" % (cid2.decode(), len(INFO), elapsed * 1e6))
+
+    comms.close()
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -9,7 +9,24 @@ import io
 import json
 import atexit
 import sys
+import threading
 import constants
+import codec
+import decoders
+import layouts
+import publisher
+import snapshot
+import transport
+import aliases
+import engine
+import spool
+import scheduler
+import burst
+import sniffer
+import multiplexer
+import modbus
+import metrics
+import tracing
 
 def config_loader():
     config = {}
@@ -28,51 +45,112 @@ def config_loader():
 
     return config
 
-def mqtt_setup():
-    client = mqtt.Client()
+def mqtt_client():
+    global topic_aliases
+    client = mqtt.Client(protocol=aliases.protocol(config))
+    # Callbacks before connect, so the first CONNACK is seen too
+    client.on_connect = on_connect
+    client.on_disconnect = on_disconnect
+    if aliases.protocol(config) == mqtt.MQTTv5:
+        topic_aliases = aliases.TopicAliasClient(client, config.get('mqtt_topic_aliases', 64))
     client.username_pw_set(username=config['mqtt_user'], password=config['mqtt_password'])
+    return client
+
+def mqtt_setup():
+    client = mqtt_client()
     client.connect(config['mqtt_host'], config['mqtt_port'], 60)
     client.loop_start()
     time.sleep(2)
     return client
 
 mqtt_connected = False
+topic_aliases = None
 
-def on_connect(client, userdata, flags, rc):
+def on_connect(client, userdata, flags, rc, properties=None):
     print("MQTT connected with result code "+str(rc))
     client.will_set(config['mqtt_base_topic'] + "/availability", "offline", qos=0, retain=False)
+    if topic_aliases is not None:
+        topic_aliases.reset(properties)
     global mqtt_connected
     mqtt_connected = True
 
-def on_disconnect(client, userdata, rc):
+def on_disconnect(client, userdata, rc, properties=None):
     print("MQTT disconnected with result code "+str(rc))
     global mqtt_connected
     mqtt_connected = False
 
-def exit_handler(client):
+def exit_handler(client, endpoints):
     print("Script exiting")
-    client.publish(config['mqtt_base_topic'] + "/availability", "offline")
+    for endpoint in endpoints:
+        client.publish(endpoint['mqtt_base_topic'] + "/availability", "offline")
     return
 
-def main():
-    global config
-    global mqtt_connected
+def same_link(endpoint, config):
+    if endpoint['connection_type'] != config['connection_type']:
+        return False
+    if config['connection_type'] == "Serial":
+        return endpoint['bms_serial'] == config['bms_serial']
+    return (endpoint['bms_ip'], endpoint['bms_port']) == (config['bms_ip'], config['bms_port'])
 
-    print("Starting up...")
-    config = config_loader()
-    client = mqtt_setup()
+def endpoint_configs(config):
 
-    client.on_connect = on_connect
-    client.on_disconnect = on_disconnect
+    # One config per BMS: the add-on options, overridden by each entry of
+    # bms_endpoints. Without bms_endpoints the options describe a single BMS.
+    # Endpoints without their own mqtt_base_topic publish below the main one
+    endpoints = config.get('bms_endpoints') or [{}]
+    configs = []
+
+    for i, endpoint in enumerate(endpoints):
+        endpoint_config = dict(config)
+        endpoint_config.update(endpoint)
+        if len(endpoints) > 1 and not endpoint.get('mqtt_base_topic'):
+            endpoint_config['mqtt_base_topic'] = config['mqtt_base_topic'] + "/" + endpoint.get('name', "bms_" + str(i+1))
+        if len(endpoints) > 1 and not endpoint.get('modbus_unit'):
+            endpoint_config['modbus_unit'] = i + 1
+        configs.append(endpoint_config)
 
-    atexit.register(exit_handler, client)
+    return configs
+
+def poll_endpoint(client, config):
+
+    # Polls one BMS and publishes below its mqtt_base_topic. Each endpoint runs in
+    # its own thread with its own connection, decoders and sinks; the MQTT client
+    # is shared and reconnected by main()
 
     connection_type = config['connection_type']
     bms_serial = config['bms_serial']
     code_running = True
-    scan_interval = config['scan_interval']
     debug_output = config['debug_output']
+    frame_timeout = config.get('frame_timeout', 2)
+    request_pacing = config.get('request_pacing', "fixed")
+    pacer = transport.RequestPacer(request_pacing, turnaround=config.get('bus_turnaround', 0.05), max_timeout=frame_timeout)
     print_initial = True
+    bms_connected = False
+    bms_version = ''
+    bms_sn = ''
+    pack_sn = ''
+    reassembler = transport.FrameReassembler()
+    dialect = decoders.compile_dialect(layouts.PACE, pack_offset=int(config.get('force_pack_offset', 0))//2)
+    analog = dialect[constants.cid2PackAnalogData]
+    warn = dialect[constants.cid2WarnInfo]
+    capacity = dialect[constants.cid2PackCapacity]
+    version = dialect[constants.cid2SoftwareVersion]
+    serial_number = dialect[constants.cid2SerialNumber]
+    polling = scheduler.command_scheduler(config)
+    adaptive = scheduler.adaptive_interval(config)
+    sampler = burst.burst_sampler(config)
+    sinks = [publisher.mqtt_sink(topic_aliases or client, config)]
+    modbus_sink = modbus.modbus_sink(config)
+    if modbus_sink is not None:
+        sinks.append(modbus_sink)
+    stats = metrics.endpoint_metrics(config, config['mqtt_base_topic'])
+    metrics_sink = metrics.metrics_sink(config, config['mqtt_base_topic'])
+    if metrics_sink is not None:
+        sinks.append(metrics_sink)
+    publishing = publisher.publish_queue(sinks, config)
+    trace = tracing.tracer(config)
+    publishing.tracer = trace
+    spooling = spool.store_and_forward(client, config, lambda: mqtt_connected)
 
     def bms_connect(address, port):
 
@@ -81,6 +159,7 @@ def main():
             try:
                 print("trying to connect %s" % bms_serial)
                 s = serial.Serial(bms_serial,timeout = 1)
+                reassembler.reset()
                 print("BMS serial connected")
                 return s, True
             except IOError as msg:
@@ -94,6 +173,7 @@ def main():
                 s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
                 s.settimeout(2)
                 s.connect((address, port))
+                reassembler.reset()
                 print("BMS socket connected")
                 return s, True
             except OSError as msg:
@@ -106,8 +186,9 @@ def main():
 
             try:
                 if len(request) > 0:
+                    pacer.before_send()
                     comms.write(request)
-                    time.sleep(0.25)
+                    pacer.after_send(request)
                     return True
             except IOError as e:
                 print("BMS serial error: %s" % e)
@@ -118,8 +199,9 @@ def main():
 
             try:
                 if len(request) > 0:
+                    pacer.before_send()
                     comms.send(request)
-                    time.sleep(0.25)
+                    pacer.after_send(request)
                     return True
             except Exception as e:
                 print("BMS socket error: %s" % e)
@@ -128,60 +210,24 @@ def main():
             
     def bms_get_data(comms):
         try:
-            if connection_type == "Serial":
-                inc_data = comms.readline()
-            else:
-                temp = comms.recv(4096)
-                temp2 = temp.split(b'\r')
-                # Decide which one to take:
-                for element in range(0,len(temp2)):
-                    SOI = hex(ord(temp2[element][0:1]))
-                    if SOI == '0x7e':
-                        inc_data = temp2[element] + b'\r'
-                        break
-
-                if (len(temp2) > 2) & (debug_output > 0):
-                    print("Multiple EOIs detected")
-                    print("...for incoming data: " + str(temp) + " |Hex: " + str(temp.hex(' ')))
+            timeout = pacer.response_timeout()
+            inc_data = reassembler.read_frame(comms, timeout)
+            rtt = pacer.after_response(inc_data is not None)
+            if inc_data is None:
+                if debug_output > 0:
+                    print("No complete frame received within " + str(round(timeout,3)) + "s, partial data kept: " + str(bytes(reassembler.buffer)))
+                return False
+            if debug_output > 1:
+                print("Round trip: " + str(round(rtt*1000)) + " ms")
+            if (len(reassembler.buffer) > 0) & (debug_output > 0):
+                print("Extra data after EOI kept for next read: " + str(bytes(reassembler.buffer)))
             return inc_data
         except Exception as e:
+            pacer.after_response(False)
             print("BMS socket receive error: %s" % e)
             # global bms_connected
             return False
         
-    def chksum_calc(data):
-
-        nonlocal debug_output
-        chksum = 0
-
-        try:
-
-            for element in range(1, len(data)): #-5):
-                chksum += (data[element])
-            
-            chksum = chksum % 65536
-            chksum = '{0:016b}'.format(chksum)
-        
-            flip_bits = '' 
-            for i in chksum:
-                if i == '0':
-                    flip_bits += '1'
-                else:
-                    flip_bits += '0'
-
-            chksum = flip_bits
-            chksum = int(chksum,2)+1
-
-            chksum = format(chksum, 'X')
-
-        except Exception as e:
-            if debug_output > 0:
-                print("Error calculating CHKSUM using data: " + data)
-                print("Error details: ", str(e))
-            return(False)
-
-        return(chksum)
-
     def cid2_rtn(rtn):
 
         # RTN Reponse codes, looking for errors
@@ -206,8 +252,6 @@ def main():
 
     def bms_parse_data(inc_data):
 
-        nonlocal debug_output
-
         try:
             
             SOI = hex(ord(inc_data[0:1]))
@@ -223,6 +267,7 @@ def main():
             RTN = inc_data[7:9]
             error, info = cid2_rtn(RTN)
             if error:
+                stats.rtn_error(RTN)
                 print(error)
                 raise Exception(error)
             
@@ -236,14 +281,13 @@ def main():
 
             LENID = int(inc_data[10:13],16) #amount of bytes, i.e. 2x hex
 
-            calc_LCHKSUM = lchksum_calc(inc_data[10:13])
-            if calc_LCHKSUM == False:
-                return(False,"Error calculating LCHKSUM for incoming data")
+            calc_LCHKSUM = codec.LENGTH_FIELDS[LENID][0]
 
-            if LCHKSUM != ord(calc_LCHKSUM):
+            if LCHKSUM != calc_LCHKSUM:
+                stats.frame_error("lchksum")
                 if debug_output > 0:
-                    print("LCHKSUM received: " + str(LCHKSUM) + " does not match calculated: " + str(ord(calc_LCHKSUM)))
-                return(False,"LCHKSUM received: " + str(LCHKSUM) + " does not match calculated: " + str(ord(calc_LCHKSUM)))
+                    print("LCHKSUM received: " + str(LCHKSUM) + " does not match calculated: " + str(calc_LCHKSUM))
+                return(False,"LCHKSUM received: " + str(LCHKSUM) + " does not match calculated: " + str(calc_LCHKSUM))
 
             if debug_output > 1:
                 print(" - LENID (int): ", LENID)
@@ -258,7 +302,7 @@ def main():
             if debug_output > 1:
                 print("CHKSUM: ", CHKSUM)
 
-            calc_CHKSUM = chksum_calc(inc_data[:len(inc_data)-5])
+            calc_CHKSUM = codec.chksum(inc_data[:len(inc_data)-5])
 
             if debug_output > 1:
                 print("Calc CHKSUM: ", calc_CHKSUM)
@@ -267,16 +311,12 @@ def main():
                 print("Error1 calculating CHKSUM using data: ", inc_data)
             return(False,"Error1 calculating CHKSUM: " + str(e))
 
-        if calc_CHKSUM == False:
-            if debug_output > 0:
-                print("Error2 calculating CHKSUM using data: ", inc_data)
-            return(False,"Error2 calculating CHKSUM")
-
-        if CHKSUM.decode("ASCII") == calc_CHKSUM:
+        if CHKSUM == calc_CHKSUM:
             return(True,INFO)
         else:
+            stats.frame_error("chksum")
             if debug_output > 0:
-                print("Received and calculated CHKSUM does not match: Received: " + CHKSUM.decode("ASCII") + ", Calculated: " + calc_CHKSUM)
+                print("Received and calculated CHKSUM does not match: Received: " + CHKSUM.decode("ASCII") + ", Calculated: " + calc_CHKSUM.decode("ASCII"))
                 print("...for incoming data: " + str(inc_data) + " |Hex: " + str(inc_data.hex(' ')))
                 print("Length of incoming data as measured: " + str(len(inc_data)))
                 print("SOI: ", SOI)
@@ -292,82 +332,38 @@ def main():
                 print("CHKSUM: ", CHKSUM)
             return(False,"Checksum error")
         
-    def lchksum_calc(lenid):
-
-        chksum = 0
-
-        try:
-            
-            for element in range(0, len(lenid)):
-                chksum += int(chr(lenid[element]),16)
-
-            chksum = chksum % 16
-            chksum = '{0:04b}'.format(chksum)
-
-            flip_bits = '' 
-            for i in chksum:
-                if i == '0':
-                    flip_bits += '1'
-                else:
-                    flip_bits += '0'
-
-            chksum = flip_bits
-            chksum = int(chksum,2)
-
-            chksum += 1
-
-            if chksum > 15:
-                chksum = 0
-
-            chksum = format(chksum, 'X')
-
-        except:
-
-            print("Error calculating LCHKSUM using LENID: ", lenid)
-            return(False)
+    def bms_request(bms, ver=b"\x32\x35",adr=b"\x30\x31",cid1=b"\x34\x36",cid2=b"\x43\x31",info=b""):
 
-        return(chksum)
-    
-    def bms_request(bms, ver=b"\x32\x35",adr=b"\x30\x31",cid1=b"\x34\x36",cid2=b"\x43\x31",info=b"",LENID=False):
+        nonlocal bms_connected
 
-        global bms_connected
-        nonlocal debug_output
+        if trace is not None:
+            trace.start()
         
-        request = b'\x7e'
-        request += ver
-        request += adr
-        request += cid1
-        request += cid2
-
-        if not(LENID):
-            LENID = len(info)
-            LENID = bytes(format(LENID, '03X'), "ASCII")
-
-        if LENID == b'000':
-            LCHKSUM = '0'
-        else:
-            LCHKSUM = lchksum_calc(LENID)
-            if LCHKSUM == False:
-                return(False,"Error calculating LCHKSUM)")
-
-        request += bytes(LCHKSUM, "ASCII")
-        request += LENID
-        request += info
-        CHKSUM = bytes(chksum_calc(request), "ASCII")
-        if CHKSUM == False:
-            return(False,"Error calculating CHKSUM)")
-        request += CHKSUM
-        request += b'\x0d'
+        request = codec.build_request(ver, adr, cid1, cid2, info)
+        if trace is not None:
+            trace.mark("encode")
 
         if debug_output > 2:
             print("-> Outgoing Data: ", request)
 
+        # Complete frames still buffered are late replies to earlier requests
+        stale = reassembler.pending_frames()
+        if (len(stale) > 0) & (debug_output > 0):
+            print("Discarding stale frames: " + str(stale))
+
         if not bms_sendData(bms,request):
             bms_connected = False
             print("Error, connection to BMS lost")
             return(False,"Error, connection to BMS lost")
+        sent = pacer.pending[1] # fixed pacing already slept part of the round trip
+        if trace is not None:
+            trace.mark("send")
 
         inc_data = bms_get_data(bms)
+        stats.request(cid2, None if inc_data == False else time.monotonic() - sent)
+        if trace is not None and inc_data != False:
+            trace.mark("first_byte", reassembler.first_data)
+            trace.mark("last_byte")
 
         if inc_data == False:
             print("Error retrieving data from BMS")
@@ -377,6 +373,8 @@ def main():
             print("<- Incoming data: ", inc_data)
 
         success, INFO = bms_parse_data(inc_data)
+        if trace is not None:
+            trace.mark("checksum")
 
         return(success, INFO)    
     
@@ -397,7 +395,7 @@ def main():
 
     def bms_getVersion(comms):
 
-        global bms_version
+        nonlocal bms_version
 
         success, INFO = bms_request(bms,cid2=constants.cid2SoftwareVersion)
 
@@ -406,7 +404,8 @@ def main():
 
         try:
 
-            bms_version = bytes.fromhex(INFO.decode("ascii")).decode("ASCII")
+            version.decode(INFO)
+            bms_version = version.bms_version
             client.publish(config['mqtt_base_topic'] + "/bms_version",bms_version)
             print("BMS Version: " + bms_version)
         except:
@@ -416,8 +415,8 @@ def main():
 
     def bms_getSerial(comms):
 
-        global bms_sn
-        global pack_sn
+        nonlocal bms_sn
+        nonlocal pack_sn
 
         success, INFO = bms_request(bms,cid2=constants.cid2SerialNumber)
 
@@ -427,8 +426,9 @@ def main():
 
         try:
 
-            bms_sn = bytes.fromhex(INFO[0:30].decode("ascii")).decode("ASCII").replace(" ", "")
-            pack_sn = bytes.fromhex(INFO[40:68].decode("ascii")).decode("ASCII").replace(" ", "")
+            serial_number.decode(INFO)
+            bms_sn = serial_number.bms_sn.replace(" ", "")
+            pack_sn = serial_number.pack_sn.replace(" ", "")
             client.publish(config['mqtt_base_topic'] + "/bms_sn",bms_sn)
             client.publish(config['mqtt_base_topic'] + "/pack_sn",pack_sn)
             print("BMS Serial Number: " + bms_sn)
@@ -441,20 +441,6 @@ def main():
     
     def bms_getAnalogData(bms,batNumber):
 
-        nonlocal print_initial
-        global cells
-        global temps
-        global packs
-        byte_index = 2
-        i_pack = []
-        v_pack = []
-        i_remain_cap = []
-        i_design_cap = []
-        cycles = []
-        i_full_cap = []
-        soc = []
-        soh = []
-
         battery = bytes(format(batNumber, '02X'), 'ASCII')
         # print("Get analog info for battery: ", battery)
 
@@ -464,403 +450,288 @@ def main():
             return(False,inc_data)
 
         try:
-
-            packs = int(inc_data[byte_index:byte_index+2],16)
-            if print_initial:
-                print("Packs: " + str(packs))
-            byte_index += 2
-
-            v_cell = {}
-            t_cell = {}
-
-            for p in range(1,packs+1):
-
-                if p > 1:
-                    cells_prev = cells
-
-                cells = int(inc_data[byte_index:byte_index+2],16)
-
-                #Possible remove this next test as were now testing for the INFOFLAG at the end
-                if p > 1:
-                    if cells != cells_prev:
-                        byte_index += 2
-                        cells = int(inc_data[byte_index:byte_index+2],16)
-                        if cells != cells_prev:
-                            print("Error parsing BMS analog data: Cannot read multiple packs")
-                            return(False,"Error parsing BMS analog data: Cannot read multiple packs")
-
-                if print_initial:
-                    print("Pack " + str(p) + ", Total cells: " + str(cells))
-                byte_index += 2
-                
-                cell_min_volt = 0
-                cell_max_volt = 0
-
-                for i in range(0,cells):
-                    v_cell[(p-1,i)] = int(inc_data[byte_index:byte_index+4],16)
-                    byte_index += 4
-                    client.publish(config['mqtt_base_topic'] + "/pack_" + str(p) + "/v_cells/cell_" + str(i+1) ,str(v_cell[(p-1,i)]))
-                    if print_initial:
-                        print("Pack " + str(p) +", V Cell" + str(i+1) + ": " + str(v_cell[(p-1,i)]) + " mV")
-
-                    #Calculate cell max and min volt
-                    if i == 0:
-                        cell_min_volt = v_cell[(p-1,i)]
-                        cell_max_volt = v_cell[(p-1,i)]
-                    else:
-                        if v_cell[(p-1,i)] < cell_min_volt:
-                            cell_min_volt = v_cell[(p-1,i)]
-                        if v_cell[(p-1,i)] > cell_max_volt:
-                            cell_max_volt = v_cell[(p-1,i)]
-            
-                #Calculate cells max diff volt
-                cell_max_diff_volt = cell_max_volt - cell_min_volt
-                client.publish(config['mqtt_base_topic'] + "/pack_" + str(p) + "/cells_max_diff_calc" ,str(cell_max_diff_volt))
-                if print_initial:
-                    print("Pack " + str(p) +", Cell Max Diff Volt Calc: " + str(cell_max_diff_volt) + " mV")
-
-                temps = int(inc_data[byte_index:byte_index + 2],16)
-                if print_initial:
-                    print("Pack " + str(p) + ", Total temperature sensors: " + str(temps))
-                byte_index += 2
-
-                for i in range(0,temps): #temps-2
-                    t_cell[(p-1,i)] = (int(inc_data[byte_index:byte_index + 4],16)-2730)/10
-                    byte_index += 4
-                    client.publish(config['mqtt_base_topic'] + "/pack_" + str(p) + "/temps/temp_" + str(i+1) ,str(round(t_cell[(p-1,i)],1)))
-                    if print_initial:
-                        print("Pack " + str(p) + ", Temp" + str(i+1) + ": " + str(round(t_cell[(p-1,i)],1)) + " ℃")
-
-                i_pack.append(int(inc_data[byte_index:byte_index+4],16))
-                byte_index += 4
-                if i_pack[p-1] >= 32768:
-                    i_pack[p-1] = -1*(65535 - i_pack[p-1])
-                i_pack[p-1] = i_pack[p-1]/100
-                client.publish(config['mqtt_base_topic'] + "/pack_" + str(p) + "/i_pack",str(i_pack[p-1]))
-                if print_initial:
-                    print("Pack " + str(p) + ", I Pack: " + str(i_pack[p-1]) + " A")
-
-                v_pack.append(int(inc_data[byte_index:byte_index+4],16)/1000)
-                byte_index += 4
-                client.publish(config['mqtt_base_topic'] + "/pack_" + str(p) + "/v_pack",str(v_pack[p-1]))
-                if print_initial:
-                    print("Pack " + str(p) + ", V Pack: " + str(v_pack[p-1]) + " V")
-
-                i_remain_cap.append(int(inc_data[byte_index:byte_index+4],16)*10)
-                byte_index += 4
-                client.publish(config['mqtt_base_topic'] + "/pack_" + str(p) + "/i_remain_cap",str(i_remain_cap[p-1]))
-                if print_initial:
-                    print("Pack " + str(p) + ", I Remaining Capacity: " + str(i_remain_cap[p-1]) + " mAh")
-
-                byte_index += 2 # Manual: Define number P = 3
-
-                i_full_cap.append(int(inc_data[byte_index:byte_index+4],16)*10)
-                byte_index += 4
-                client.publish(config['mqtt_base_topic'] + "/pack_" + str(p) + "/i_full_cap",str(i_full_cap[p-1]))
-                if print_initial:
-                    print("Pack " + str(p) + ", I Full Capacity: " + str(i_full_cap[p-1]) + " mAh")
-
-                soc.append(round(i_remain_cap[p-1]/i_full_cap[p-1]*100,2))
-                client.publish(config['mqtt_base_topic'] + "/pack_" + str(p) + "/soc",str(soc[p-1]))
-                if print_initial:
-                    print("Pack " + str(p) + ", SOC: " + str(soc[p-1]) + " %")
-
-                cycles.append(int(inc_data[byte_index:byte_index+4],16))
-                byte_index += 4
-                client.publish(config['mqtt_base_topic'] + "/pack_" + str(p) + "/cycles",str(cycles[p-1]))
-                if print_initial:
-                    print("Pack " + str(p) + ", Cycles: " + str(cycles[p-1]))
-
-                i_design_cap.append(int(inc_data[byte_index:byte_index+4],16)*10)
-                byte_index += 4
-                client.publish(config['mqtt_base_topic'] + "/pack_" + str(p) + "/i_design_cap",str(i_design_cap[p-1]))
-                if print_initial:
-                    print("Pack " + str(p) + ", Design Capacity: " + str(i_design_cap[p-1]) + " mAh")
-
-                soh.append(round(i_full_cap[p-1]/i_design_cap[p-1]*100,2))
-                client.publish(config['mqtt_base_topic'] + "/pack_" + str(p) + "/soh",str(soh[p-1]))
-                if print_initial:
-                    print("Pack " + str(p) + ", SOH: " + str(soh[p-1]) + " %")
-
-                byte_index += 2
-
-                #Test for non signed value (matching cell count), to skip possible INFOFLAG present in data
-                if (byte_index < len(inc_data)) and (cells != int(inc_data[byte_index:byte_index+2],16)):
-                    byte_index += 2
-
+            analog.decode(inc_data)
+            packs = snapshot.packs_from(analog)
+            if trace is not None:
+                trace.mark("decode")
         except Exception as e:
             print("Error parsing BMS analog data: ", str(e))
             return(False,"Error parsing BMS analog data: " + str(e))
 
-        if print_initial:
-            print("Script running....")
-
-        return True,True
+        return True,packs
     
     def bms_getPackCapacity(bms):
 
-        byte_index = 0
-
         success, inc_data = bms_request(bms,cid2=constants.cid2PackCapacity) # Seem to always reply with pack 1 data, even with ADR= 0 or FF and INFO= '' or FF
 
         if success == False:
             return(False,inc_data)
 
         try:
-
-            pack_remain_cap = int(inc_data[byte_index:byte_index+4],16)*10
-            byte_index += 4
-            client.publish(config['mqtt_base_topic'] + "/pack_remain_cap",str(pack_remain_cap))
-            if print_initial:
-                print("Pack Remaining Capacity: " + str(pack_remain_cap) + " mAh")
-
-            pack_full_cap = int(inc_data[byte_index:byte_index+4],16)*10
-            byte_index += 4
-            client.publish(config['mqtt_base_topic'] + "/pack_full_cap",str(pack_full_cap))
-            if print_initial:
-                print("Pack Full Capacity: " + str(pack_full_cap) + " mAh")
-
-            pack_design_cap = int(inc_data[byte_index:byte_index+4],16)*10
-            byte_index += 4
-            client.publish(config['mqtt_base_topic'] + "/pack_design_cap",str(pack_design_cap))
-            if print_initial:
-                print("Pack Design Capacity: " + str(pack_design_cap) + " mAh")
-
-            pack_soc = round(pack_remain_cap/pack_full_cap*100,2)
-            client.publish(config['mqtt_base_topic'] + "/pack_soc",str(pack_soc))
-            if print_initial:
-                print("Pack SOC: " + str(pack_soc) + " %")
-
-            pack_soh = round(pack_full_cap/pack_design_cap*100,2)
-            client.publish(config['mqtt_base_topic'] + "/pack_soh",str(pack_soh))
-            if print_initial:
-                print("Pack SOH: " + str(pack_soh) + " %")
-
+            capacity.decode(inc_data)
+            pack_capacity = snapshot.capacity_from(capacity)
+            if trace is not None:
+                trace.mark("decode")
         except Exception as e:
             print("Error parsing BMS pack capacity data: ", str(e))
             return False, "Error parsing BMS pack capacity data: " + str(e)
 
-        return True,True
+        return True,pack_capacity
 
     def bms_getWarnInfo(bms):
 
-        byte_index = 2
-        packsW = 1
-        warnings = ""
-
         success, inc_data = bms_request(bms,cid2=constants.cid2WarnInfo,info=b'FF')
 
         if success == False:
             return(False,inc_data)
 
         try:
-
-            packsW = int(inc_data[byte_index:byte_index+2],16)
-            if print_initial:
-                print("Packs for warnings: " + str(packs))
-            byte_index += 2
-
-            for p in range(1,packs+1):
-
-                cellsW = int(inc_data[byte_index:byte_index+2],16)
-                byte_index += 2
-
-                for c in range(1,cellsW+1):
-
-                    if inc_data[byte_index:byte_index+2] != b'00':
-                        warn = constants.warningStates[inc_data[byte_index:byte_index+2]]
-                        warnings += "cell " + str(c) + " " + warn + ", "
-                    byte_index += 2
-
-                tempsW = int(inc_data[byte_index:byte_index+2],16)
-                byte_index += 2
-            
-                for t in range(1,tempsW+1):
-
-                    if inc_data[byte_index:byte_index+2] != b'00':
-                        warn = constants.warningStates[inc_data[byte_index:byte_index+2]]
-                        warnings += "temp " + str(t) + " " + warn + ", "
-                    byte_index += 2
-
-                if inc_data[byte_index:byte_index+2] != b'00':
-                    warn = constants.warningStates[inc_data[byte_index:byte_index+2]]
-                    warnings += "charge current " + warn + ", "
-                byte_index += 2
-
-                if inc_data[byte_index:byte_index+2] != b'00':
-                    warn = constants.warningStates[inc_data[byte_index:byte_index+2]]
-                    warnings += "total voltage " + warn + ", "
-                byte_index += 2
-
-                if inc_data[byte_index:byte_index+2] != b'00':
-                    warn = constants.warningStates[inc_data[byte_index:byte_index+2]]
-                    warnings += "discharge current " + warn + ", "
-                byte_index += 2
-
-                protectState1 = ord(bytes.fromhex(inc_data[byte_index:byte_index+2].decode('ascii')))
-                if protectState1 > 0:
-                    warnings += "Protection State 1: "
-                    for x in range(0,8):
-                        if (protectState1 & (1<<x)):
-                            warnings += constants.protectState1[x+1] + " | "
-                    warnings = warnings.rstrip("| ")
-                    warnings += ", "
-                client.publish(config['mqtt_base_topic'] + "/pack_" + str(p) + "/prot_short_circuit",str(protectState1>>6 & 1))  
-                client.publish(config['mqtt_base_topic'] + "/pack_" + str(p) + "/prot_discharge_current",str(protectState1>>5 & 1))  
-                client.publish(config['mqtt_base_topic'] + "/pack_" + str(p) + "/prot_charge_current",str(protectState1>>4 & 1))  
-                byte_index += 2
-
-                protectState2 = ord(bytes.fromhex(inc_data[byte_index:byte_index+2].decode('ascii')))
-                if protectState2 > 0:
-                    warnings += "Protection State 2: "
-                    for x in range(0,8):
-                        if (protectState2 & (1<<x)):
-                            warnings += constants.protectState2[x+1] + " | "
-                    warnings = warnings.rstrip("| ")
-                    warnings += ", "
-                client.publish(config['mqtt_base_topic'] + "/pack_" + str(p) + "/fully",str(protectState2>>7 & 1))  
-                byte_index += 2
-
-                instructionState = ord(bytes.fromhex(inc_data[byte_index:byte_index+2].decode('ascii')))
-                client.publish(config['mqtt_base_topic'] + "/pack_" + str(p) + "/current_limit",str(instructionState>>0 & 1))
-                client.publish(config['mqtt_base_topic'] + "/pack_" + str(p) + "/charge_fet",str(instructionState>>1 & 1))
-                client.publish(config['mqtt_base_topic'] + "/pack_" + str(p) + "/discharge_fet",str(instructionState>>4 & 1))
-                client.publish(config['mqtt_base_topic'] + "/pack_" + str(p) + "/pack_indicate",str(instructionState>>3 & 1))
-                client.publish(config['mqtt_base_topic'] + "/pack_" + str(p) + "/reverse",str(instructionState>>4 & 1))
-                client.publish(config['mqtt_base_topic'] + "/pack_" + str(p) + "/ac_in",str(instructionState>>5 & 1))
-                client.publish(config['mqtt_base_topic'] + "/pack_" + str(p) + "/heart",str(instructionState>>7 & 1))
-                byte_index += 2
-
-                controlState = ord(bytes.fromhex(inc_data[byte_index:byte_index+2].decode('ascii')))
-                if controlState > 0:
-                    warnings += "Control State: "
-                    for x in range(0,8):
-                        if (controlState & (1<<x)):
-                            warnings += constants.controlState[x+1] + " | "
-                    warnings = warnings.rstrip("| ")
-                    warnings += ", "  
-                byte_index += 2
-
-                faultState = ord(bytes.fromhex(inc_data[byte_index:byte_index+2].decode('ascii')))
-                if faultState > 0:
-                    warnings += "Fault State: "
-                    for x in range(0,8):
-                        if (faultState & (1<<x)):
-                            warnings += constants.faultState[x+1] + " | "
-                    warnings = warnings.rstrip("| ")
-                    warnings += ", "  
-                byte_index += 2
-
-                balanceState1 = '{0:08b}'.format(int(inc_data[byte_index:byte_index+2],16))
-                byte_index += 2
-
-                balanceState2 = '{0:08b}'.format(int(inc_data[byte_index:byte_index+2],16))
-                byte_index += 2
-
-                warnState1 = ord(bytes.fromhex(inc_data[byte_index:byte_index+2].decode('ascii')))
-                if warnState1 > 0:
-                    warnings += "Warning State 1: "
-                    for x in range(0,8):
-                        if (warnState1 & (1<<x)):
-                            warnings += constants.warnState1[x+1] + " | "
-                    warnings = warnings.rstrip("| ")
-                    warnings += ", "  
-                byte_index += 2
-
-                warnState2 = ord(bytes.fromhex(inc_data[byte_index:byte_index+2].decode('ascii')))
-                if warnState2 > 0:
-                    warnings += "Warning State 2: "
-                    for x in range(0,8):
-                        if (warnState2 & (1<<x)):
-                            warnings += constants.warnState2[x+1] + " | "
-                    warnings = warnings.rstrip("| ")
-                    warnings += ", "  
-                byte_index += 2
-
-                warnings = warnings.rstrip(", ")
-
-                client.publish(config['mqtt_base_topic'] + "/pack_" + str(p) + "/warnings",warnings)
-                if print_initial:
-                    print("Pack " + str(p) + ", warnings: " + warnings)
-
-                client.publish(config['mqtt_base_topic'] + "/pack_" + str(p) + "/balancing1",balanceState1)
-                if print_initial:
-                    print("Pack " + str(p) + ", balancing1: " + balanceState1)
-
-                client.publish(config['mqtt_base_topic'] + "/pack_" + str(p) + "/balancing2",balanceState2)
-                if print_initial:
-                    print("Pack " + str(p) + ", balancing2: " + balanceState2)
-
-                warnings = ""
-
-                #Test for non signed value (matching cell count), to skip possible INFOFLAG present in data
-                if (byte_index < len(inc_data)) and (cellsW != int(inc_data[byte_index:byte_index+2],16)):
-                    byte_index += 2
-
+            warn.decode(inc_data)
+            status = snapshot.status_from(warn)
+            if trace is not None:
+                trace.mark("decode")
         except Exception as e:
             print("Error parsing BMS warning data: ", str(e))
             return False, "Error parsing BMS warning data: " + str(e)
 
-        return True,True
+        return True,status
+
+    def bms_poll(cid2):
+
+        # Runs one scheduled command. Analog, capacity and warning results are kept
+        # in latest, each scan publishes the latest of all three
+        if cid2 == constants.cid2PackAnalogData:
+            success, pack_data = bms_getAnalogData(bms,batNumber=255)
+            if success != True:
+                print("Error retrieving BMS analog data: " + pack_data)
+                pack_data = ()
+            latest['packs'] = pack_data
+            if adaptive is not None and pack_data:
+                # Adaptive scan interval, published when it changes
+                interval = adaptive.update(pack_data)
+                if interval != polling.scan_interval:
+                    polling.set_scan_interval(interval)
+                    client.publish(config['mqtt_base_topic'] + "/scan_interval",str(interval))
+        elif cid2 == constants.cid2PackCapacity:
+            success, pack_capacity = bms_getPackCapacity(bms)
+            if success != True:
+                print("Error retrieving BMS pack capacity: " + pack_capacity)
+                pack_capacity = None
+            latest['capacity'] = pack_capacity
+        elif cid2 == constants.cid2WarnInfo:
+            success, pack_status = bms_getWarnInfo(bms)
+            if success != True:
+                print("Error retrieving BMS warning info: " + pack_status)
+                pack_status = ()
+            latest['status'] = pack_status
+        elif cid2 == constants.cid2PackNumber:
+            success, pack_number = bms_getPackNumber(bms)
+            if success != True:
+                print("Error retrieving BMS pack number: " + pack_number)
+            else:
+                client.publish(config['mqtt_base_topic'] + "/pack_number",str(pack_number))
+        elif cid2 == constants.cid2SoftwareVersion:
+            success, data = bms_getVersion(bms)
+            if success != True:
+                print("Error retrieving BMS version number")
+        elif cid2 == constants.cid2SerialNumber:
+            success = bms_getSerial(bms)[0]
+            if success != True:
+                print("Error retrieving BMS and pack serial numbers")
+
+    def bms_sniff():
+
+        # Passive mode: decode what another master polls, never send anything
+        nonlocal bms, bms_connected, print_initial
+
+        bus = sniffer.BusSniffer(dialect, debug_output)
+        last_refresh = time.monotonic()
+        print("Listening to BMS traffic, no requests are sent")
+
+        while code_running == True:
+
+            if bms_connected != True:
+                print("BMS disconnected, trying to reconnect...")
+                stats.reconnect()
+                client.publish(config['mqtt_base_topic'] + "/availability","offline")
+                time.sleep(5)
+                bms,bms_connected = bms_connect(config['bms_ip'],config['bms_port'])
+                print_initial = True
+                continue
+
+            try:
+                data = transport.read_chunk(bms, 1)
+            except OSError as e:
+                print("BMS receive error: %s" % e)
+                bms_connected = False
+                continue
+            reassembler.feed(data)
+
+            for frame in reassembler.pending_frames():
+                cid2 = bus.feed(frame)
+                if cid2 == constants.cid2SoftwareVersion:
+                    client.publish(config['mqtt_base_topic'] + "/bms_version",version.bms_version)
+                elif cid2 == constants.cid2SerialNumber:
+                    client.publish(config['mqtt_base_topic'] + "/bms_sn",serial_number.bms_sn.replace(" ", ""))
+                    client.publish(config['mqtt_base_topic'] + "/pack_sn",serial_number.pack_sn.replace(" ", ""))
+                elif cid2 is not None:
+                    bank = bus.bank()
+                    if mqtt_connected == True:
+                        publishing.put(bank, print_initial)
+                        client.publish(config['mqtt_base_topic'] + "/availability","online")
+                        if print_initial:
+                            print("Script running....")
+                            if debug_output > 0:
+                                print("Sniffed frames: " + json.dumps(bus.stats()))
+                        print_initial = False
+                        if time.monotonic() - last_refresh > 3600:
+                            last_refresh = time.monotonic()
+                            print_initial = True
+                    elif spooling is not None:
+                        spooling.append(bank)
+                        print_initial = True
 
     print("Connecting to BMS...")
     bms,bms_connected = bms_connect(config['bms_ip'],config['bms_port'])
 
     client.publish(config['mqtt_base_topic'] + "/availability","offline")
 
+    if config.get('bus_mode', "active") == "passive":
+        bms_sniff()
+        return
+
     success, data = bms_getVersion(bms)
     if success != True:
         print("Error retrieving BMS version number")
+    polling.done(constants.cid2SoftwareVersion)
 
     time.sleep(0.1)
     success, bms_sn, pack_sn = bms_getSerial(bms)
     if success != True:
-        print("Error retrieving BMS and pack serial numbers. This is required. Exiting...")
-        quit()
-
-    repub_discovery = 0
+        print("Error retrieving BMS and pack serial numbers. This is required. Stopping " + config['mqtt_base_topic'] + "...")
+        return
+    polling.done(constants.cid2SerialNumber)
+
+    latest = {'packs': (), 'status': (), 'capacity': None}
+    last_refresh = time.monotonic()
+    last_trace = time.monotonic()
+    last_timing = time.monotonic()
     while code_running == True:
 
         if bms_connected == True:
-            global mqtt_connected
-            if mqtt_connected == True:
-
-                success, data = bms_getAnalogData(bms,batNumber=255)
-                if success != True:
-                    print("Error retrieving BMS analog data: " + data)
-                time.sleep(scan_interval/3)
-                success, data = bms_getPackCapacity(bms)
-                if success != True:
-                    print("Error retrieving BMS pack capacity: " + data)
-                time.sleep(scan_interval/3)
-                success, data = bms_getWarnInfo(bms)
-                if success != True:
-                    print("Error retrieving BMS warning info: " + data)
-                time.sleep(scan_interval/3)
-
-                client.publish(config['mqtt_base_topic'] + "/availability","online")
-
-                print_initial = False
-                
-                repub_discovery += 1
-                if repub_discovery*scan_interval > 3600:
-                    repub_discovery = 0
-                    print_initial = True
-            
-            else: #MQTT not connected
-                client.loop_stop()
-                print("MQTT disconnected, trying to reconnect...")
-                client.connect(config['mqtt_host'], config['mqtt_port'], 60)
-                client.loop_start()
+            if mqtt_connected == True or spooling is not None:
+
+                due = polling.due()
+                started = time.monotonic()
+                for cid2 in due:
+                    bms_poll(cid2)
+                    polling.done(cid2)
+                if due:
+                    stats.scan(time.monotonic() - started)
+
+                # One snapshot per scan, built after all of its commands ran
+                if set(due) & set((constants.cid2PackAnalogData, constants.cid2PackCapacity, constants.cid2WarnInfo)):
+                    bank = snapshot.BankSnapshot(latest['packs'], latest['status'], latest['capacity'])
+                    if mqtt_connected == True:
+                        publishing.put(bank, print_initial)
+                        if print_initial:
+                            print("Script running....")
+                            if debug_output > 0:
+                                print("Publish queue: " + json.dumps(publishing.stats()))
+                    else: #MQTT not connected, keep the scan for the backfill topic
+                        spooling.append(bank)
+                    stats.publish_queue(publishing.stats())
+
+                    if sampler is not None:
+                        # State changes start a burst of back to back 0x42/0x44 reads
+                        documents = sampler.add(bank)
+                        if sampler.active():
+                            polling.burst(burst.BURST_COMMANDS, sampler.until)
+                        if documents is not None:
+                            for document in documents:
+                                client.publish(config['mqtt_base_topic'] + "/burst",document)
+
+                    if mqtt_connected == True:
+                        client.publish(config['mqtt_base_topic'] + "/availability","online")
+
+                        if trace is not None and time.monotonic() - last_trace >= config.get('trace_interval', 60):
+                            last_trace = time.monotonic()
+                            client.publish(config['mqtt_base_topic'] + "/trace",trace.document())
+
+                        if config.get('scan_timing_interval', 300) > 0 and time.monotonic() - last_timing >= config.get('scan_timing_interval', 300):
+                            # Actual scan period, jitter and overruns against the scan interval
+                            last_timing = time.monotonic()
+                            report = polling.timing.report(polling.scan_interval)
+                            if report is not None:
+                                client.publish(config['mqtt_base_topic'] + "/scan_timing",json.dumps(report))
+                                stats.scan_timing(report)
+
+                        print_initial = False
+
+                        if time.monotonic() - last_refresh > 3600:
+                            last_refresh = time.monotonic()
+                            print_initial = True
+                    else:
+                        print_initial = True
+
+                time.sleep(polling.wait())
+
+            else: #MQTT not connected, main() reconnects
                 time.sleep(5)
                 print_initial = True
         else: #BMS not connected
             print("BMS disconnected, trying to reconnect...")
+            stats.reconnect()
             bms,bms_connected = bms_connect(config['bms_ip'],config['bms_port'])
             client.publish(config['mqtt_base_topic'] + "/availability","offline")
             time.sleep(5)
             print_initial = True
 
+def main():
+    global config
+
+    print("Starting up...")
+    config = config_loader()
+    endpoints = endpoint_configs(config)
+
+    mux = multiplexer.multiplexer(config)
+    if mux is not None:
+        # The multiplexer owns the BMS link, endpoints on that link poll through it
+        # like any other client
+        for endpoint in endpoints:
+            if same_link(endpoint, config):
+                endpoint.update(connection_type="IP", bms_ip="127.0.0.1", bms_port=mux.port)
+
+    metrics.metrics_server(config)
+
+    if config.get('engine', "threads") == "asyncio":
+        # One event loop drives the BMS connections and the MQTT socket
+        client = mqtt_client()
+        atexit.register(exit_handler, client, endpoints)
+        engine.run(config, client, topic_aliases or client, endpoints, lambda: mqtt_connected)
+        return
+
+    client = mqtt_setup()
+    atexit.register(exit_handler, client, endpoints)
+
+    threads = []
+    for endpoint in endpoints:
+        thread = threading.Thread(target=poll_endpoint, args=(client, endpoint), name=endpoint['mqtt_base_topic'], daemon=True)
+        thread.start()
+        threads.append(thread)
+
+    while any(thread.is_alive() for thread in threads):
+        if mqtt_connected == False:
+            client.loop_stop()
+            print("MQTT disconnected, trying to reconnect...")
+            try:
+                client.connect(config['mqtt_host'], config['mqtt_port'], 60)
+            except OSError as e:
+                # Broker still down, the endpoints keep spooling and the next tick retries
+                print("MQTT reconnect failed: %s" % e)
+            client.loop_start()
+        time.sleep(5)
+
     client.loop_stop()
 
 if __name__ == "__main__":
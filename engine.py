@@ -0,0 +1,436 @@
+import asyncio
+import json
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+import serial
+
+import codec
+import constants
+import decoders
+import layouts
+import metrics
+import modbus
+import publisher
+import scheduler
+import snapshot
+import spool
+import transport
+
+# asyncio polling engine (engine: "asyncio"). Every BMS endpoint is a task on one
+# event loop with its own TCP stream or serial port, and the paho client is driven
+# from the same loop through its socket callbacks instead of a network thread. A
+# request only waits for its own response, so a slow or dead gateway holds up its
+# own endpoint and nothing else.
+#
+# Scans go through the same publish queue, sinks and store_and_forward spool as
+# with the threaded engine. The per command schedule, adaptive interval, burst
+# sampling, passive bus mode and tracing only exist in poll_endpoint() in bms.py,
+# run() refuses to start when any of them is configured.
+
+
+class MqttLoop:
+
+    # Runs a paho client's network I/O on an asyncio event loop. connect() and
+    # reconnect() block on DNS and the TCP handshake, so serve() runs them in an
+    # executor and the socket callbacks they trigger are passed to the loop thread
+
+    def __init__(self, loop, client):
+        self.loop = loop
+        self.client = client
+        self.misc = None
+        self.thread = threading.get_ident()
+        client.on_socket_open = self.in_loop(self.on_socket_open)
+        client.on_socket_close = self.in_loop(self.on_socket_close)
+        client.on_socket_register_write = self.in_loop(self.on_socket_register_write)
+        client.on_socket_unregister_write = self.in_loop(self.on_socket_unregister_write)
+
+    def in_loop(self, callback):
+        def call(*args):
+            if threading.get_ident() == self.thread:
+                callback(*args)
+            else:
+                self.loop.call_soon_threadsafe(callback, *args)
+        return call
+
+    def on_socket_open(self, client, userdata, sock):
+        self.loop.add_reader(sock, client.loop_read)
+        self.misc = self.loop.create_task(self.misc_loop())
+
+    def on_socket_close(self, client, userdata, sock):
+        self.loop.remove_reader(sock)
+        if self.misc is not None:
+            self.misc.cancel()
+            self.misc = None
+
+    def on_socket_register_write(self, client, userdata, sock):
+        self.loop.add_writer(sock, client.loop_write)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self.loop.remove_writer(sock)
+
+    async def misc_loop(self):
+        # Keepalive pings and retries, what loop_forever does once a second
+        while self.client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+            await asyncio.sleep(1)
+
+
+class TcpStream:
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+
+    @classmethod
+    async def open(cls, address, port, timeout):
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(address, port), timeout)
+        return cls(reader, writer)
+
+    async def read(self):
+        data = await self.reader.read(4096)
+        if len(data) == 0:
+            raise ConnectionError("BMS closed the connection")
+        return data
+
+    async def write(self, data):
+        self.writer.write(data)
+        await self.writer.drain()
+
+    def close(self):
+        self.writer.close()
+
+
+class SerialStream:
+
+    # pyserial port read through the event loop: the port is non blocking and
+    # watched with add_reader, received bytes are queued for read()
+
+    def __init__(self, loop, port):
+        self.loop = loop
+        self.port = port
+        self.received = asyncio.Queue()
+        loop.add_reader(port.fileno(), self.on_readable)
+
+    @classmethod
+    async def open(cls, device):
+        return cls(asyncio.get_running_loop(), serial.Serial(device, timeout=0))
+
+    def on_readable(self):
+        try:
+            data = self.port.read(max(1, self.port.in_waiting))
+        except serial.SerialException as e:
+            self.loop.remove_reader(self.port.fileno())
+            self.received.put_nowait(e)
+            return
+        if data:
+            self.received.put_nowait(data)
+
+    async def read(self):
+        data = await self.received.get()
+        if isinstance(data, Exception):
+            raise ConnectionError(str(data))
+        return data
+
+    async def write(self, data):
+        # Writes block until the bytes are out at the baud rate
+        await self.loop.run_in_executor(None, self.port.write, data)
+
+    def close(self):
+        try:
+            self.loop.remove_reader(self.port.fileno())
+        except (ValueError, OSError):
+            pass
+        self.port.close()
+
+
+class AsyncEndpoint:
+
+    # One BMS, the asyncio counterpart of poll_endpoint() in bms.py
+
+    def __init__(self, config, client, sink_client, mqtt_connected):
+        self.config = config
+        self.client = client
+        self.mqtt_connected = mqtt_connected
+        self.name = config['mqtt_base_topic']
+        self.debug_output = config['debug_output']
+        self.scan_interval = config['scan_interval']
+        self.frame_timeout = config.get('frame_timeout', 2)
+        self.pacer = transport.RequestPacer(config.get('request_pacing', "fixed"), turnaround=config.get('bus_turnaround', 0.05), max_timeout=self.frame_timeout)
+        self.reassembler = transport.FrameReassembler()
+        dialect = decoders.compile_dialect(layouts.PACE, pack_offset=int(config.get('force_pack_offset', 0))//2)
+        self.analog = dialect[constants.cid2PackAnalogData]
+        self.warn = dialect[constants.cid2WarnInfo]
+        self.capacity = dialect[constants.cid2PackCapacity]
+        self.version = dialect[constants.cid2SoftwareVersion]
+        self.serial_number = dialect[constants.cid2SerialNumber]
+        self.sinks = [publisher.mqtt_sink(sink_client, config)]
+        modbus_sink = modbus.modbus_sink(config)
+        if modbus_sink is not None:
+            self.sinks.append(modbus_sink)
+        metrics_sink = metrics.metrics_sink(config, self.name)
+        if metrics_sink is not None:
+            self.sinks.append(metrics_sink)
+        self.stats = metrics.endpoint_metrics(config, self.name)
+        self.publishing = publisher.publish_queue(self.sinks, config)
+        self.spooling = spool.store_and_forward(client, config, mqtt_connected)
+        self.rate = scheduler.FixedRate(self.scan_interval)
+        self.stream = None
+        self.print_initial = True
+        self.bms_sn = ''
+
+    def log(self, message):
+        print(self.name + ": " + message)
+
+    async def connect(self):
+
+        try:
+            if self.config['connection_type'] == "Serial":
+                self.log("trying to connect %s" % self.config['bms_serial'])
+                self.stream = await SerialStream.open(self.config['bms_serial'])
+            else:
+                self.log("trying to connect " + self.config['bms_ip'] + ":" + str(self.config['bms_port']))
+                self.stream = await TcpStream.open(self.config['bms_ip'], self.config['bms_port'], self.frame_timeout)
+        except (OSError, serial.SerialException, asyncio.TimeoutError) as e:
+            self.log("BMS error connecting: %s" % e)
+            self.stream = None
+            return False
+
+        self.reassembler.reset()
+        self.log("BMS connected")
+        return True
+
+    def disconnect(self):
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+
+    async def read_frame(self):
+        frame = self.reassembler.next_frame()
+        while frame is None:
+            self.reassembler.feed(await self.stream.read())
+            frame = self.reassembler.next_frame()
+        return frame
+
+    async def request(self, cid2, info=b''):
+
+        request = codec.build_request(b"\x32\x35", b"\x30\x31", b"\x34\x36", cid2, info)
+
+        if self.debug_output > 2:
+            self.log("-> Outgoing Data: " + str(request))
+
+        # Complete frames still buffered are late replies to earlier requests
+        stale = self.reassembler.pending_frames()
+        if (len(stale) > 0) & (self.debug_output > 0):
+            self.log("Discarding stale frames: " + str(stale))
+
+        await asyncio.sleep(self.pacer.send_delay())
+        try:
+            await self.stream.write(request)
+        except (OSError, serial.SerialException) as e:
+            self.log("BMS write error: %s" % e)
+            self.disconnect()
+            return False, "Error, connection to BMS lost"
+        self.pacer.sent(request)
+        sent = time.monotonic()
+        if self.pacer.mode == "fixed":
+            await asyncio.sleep(self.pacer.fixed_delay)
+
+        timeout = self.pacer.response_timeout()
+        try:
+            frame = await asyncio.wait_for(self.read_frame(), timeout)
+        except asyncio.TimeoutError:
+            frame = None
+            self.reassembler.timeouts += 1
+        except ConnectionError as e:
+            self.pacer.after_response(False)
+            self.log("BMS receive error: %s" % e)
+            self.disconnect()
+            return False, "Error, connection to BMS lost"
+
+        self.pacer.after_response(frame is not None)
+        self.stats.request(cid2, None if frame is None else time.monotonic() - sent)
+        if frame is None:
+            return False, "No complete frame received within " + str(round(timeout,3)) + "s"
+
+        if self.debug_output > 2:
+            self.log("<- Incoming data: " + str(frame))
+
+        success, INFO = codec.parse_response(frame)
+        if not success:
+            if frame[7:9] in codec.RTN_ERRORS:
+                self.stats.rtn_error(frame[7:9])
+            elif INFO.startswith("LCHKSUM"):
+                self.stats.frame_error("lchksum")
+            elif INFO == "Checksum error":
+                self.stats.frame_error("chksum")
+        return success, INFO
+
+    async def identify(self):
+
+        # Version and serial numbers, once per connection
+        success, INFO = await self.request(constants.cid2SoftwareVersion)
+        if success:
+            try:
+                self.version.decode(INFO)
+                self.client.publish(self.name + "/bms_version", self.version.bms_version)
+                self.log("BMS Version: " + self.version.bms_version)
+            except Exception:
+                self.log("Error extracting BMS version")
+        else:
+            self.log("Error retrieving BMS version number: " + INFO)
+
+        success, INFO = await self.request(constants.cid2SerialNumber)
+        if not success:
+            return False
+        try:
+            self.serial_number.decode(INFO)
+        except Exception:
+            return False
+        self.bms_sn = self.serial_number.bms_sn.replace(" ", "")
+        pack_sn = self.serial_number.pack_sn.replace(" ", "")
+        self.client.publish(self.name + "/bms_sn", self.bms_sn)
+        self.client.publish(self.name + "/pack_sn", pack_sn)
+        self.log("BMS Serial Number: " + self.bms_sn)
+        self.log("Pack Serial Number: " + pack_sn)
+        return True
+
+    async def read(self, cid2, decoder, build, info=b''):
+        success, INFO = await self.request(cid2, info)
+        if not success:
+            return False, INFO
+        try:
+            decoder.decode(INFO)
+            return True, build(decoder)
+        except Exception as e:
+            return False, "Error parsing BMS data: " + str(e)
+
+    async def poll(self, started):
+
+        # Fixed pacing spreads the three commands over the scan interval, on
+        # deadlines counted from the start of the scan
+        gap = self.scan_interval/3 if self.pacer.mode == "fixed" else 0
+
+        success, pack_data = await self.read(constants.cid2PackAnalogData, self.analog, snapshot.packs_from, b'FF')
+        if not success:
+            self.log("Error retrieving BMS analog data: " + pack_data)
+            pack_data = ()
+        await asyncio.sleep(max(0, started + gap - time.monotonic()))
+        success, pack_capacity = await self.read(constants.cid2PackCapacity, self.capacity, snapshot.capacity_from)
+        if not success:
+            self.log("Error retrieving BMS pack capacity: " + pack_capacity)
+            pack_capacity = None
+        await asyncio.sleep(max(0, started + 2*gap - time.monotonic()))
+        success, pack_status = await self.read(constants.cid2WarnInfo, self.warn, snapshot.status_from, b'FF')
+        if not success:
+            self.log("Error retrieving BMS warning info: " + pack_status)
+            pack_status = ()
+
+        bank = snapshot.BankSnapshot(pack_data, pack_status, pack_capacity)
+        if self.mqtt_connected():
+            self.publishing.put(bank, self.print_initial)
+        else: #MQTT not connected, keep the scan for the backfill topic
+            self.spooling.append(bank)
+        self.stats.publish_queue(self.publishing.stats())
+
+    async def run(self):
+
+        repub_discovery = 0
+        last_timing = time.monotonic()
+        while True:
+
+            if self.stream is None:
+                if self.bms_sn:
+                    self.stats.reconnect()
+                if await self.connect() and not self.bms_sn and not await self.identify():
+                    self.log("Error retrieving BMS and pack serial numbers. This is required. Stopping...")
+                    self.disconnect()
+                    return
+                if self.stream is None:
+                    self.client.publish(self.name + "/availability", "offline")
+                    await asyncio.sleep(5)
+                    self.print_initial = True
+                continue
+
+            if not self.mqtt_connected() and self.spooling is None:
+                await asyncio.sleep(5)
+                self.print_initial = True
+                continue
+
+            cycle_start = time.monotonic()
+            self.rate.start(cycle_start)
+            await self.poll(cycle_start)
+            self.stats.scan(time.monotonic() - cycle_start)
+
+            if not self.mqtt_connected():
+                # Spooling, publish the rest once MQTT is back
+                self.print_initial = True
+                await asyncio.sleep(self.rate.wait())
+                continue
+
+            self.client.publish(self.name + "/availability", "online")
+
+            if self.config.get('scan_timing_interval', 300) > 0 and cycle_start - last_timing >= self.config.get('scan_timing_interval', 300):
+                last_timing = cycle_start
+                report = self.rate.timing.report(self.scan_interval)
+                if report is not None:
+                    self.client.publish(self.name + "/scan_timing", json.dumps(report))
+                    self.stats.scan_timing(report)
+
+            if self.print_initial:
+                self.log("Script running....")
+            self.print_initial = False
+
+            repub_discovery += 1
+            if repub_discovery*self.scan_interval > 3600:
+                repub_discovery = 0
+                self.print_initial = True
+
+            # Next scan on the fixed grid, whatever this one took
+            await asyncio.sleep(self.rate.wait())
+
+
+async def serve(config, client, sink_client, endpoints, mqtt_connected):
+
+    loop = asyncio.get_running_loop()
+    MqttLoop(loop, client)
+    try:
+        await loop.run_in_executor(None, client.connect, config['mqtt_host'], config['mqtt_port'], 60)
+    except OSError as e:
+        # Polling starts anyway, the loop below keeps trying to connect
+        print("MQTT connect failed: %s" % e)
+
+    tasks = [asyncio.create_task(AsyncEndpoint(endpoint, client, sink_client, mqtt_connected).run()) for endpoint in endpoints]
+
+    while not all(task.done() for task in tasks):
+        await asyncio.sleep(5)
+        if not mqtt_connected():
+            print("MQTT disconnected, trying to reconnect...")
+            try:
+                await loop.run_in_executor(None, client.reconnect)
+            except OSError as e:
+                print("MQTT reconnect failed: %s" % e)
+
+
+def unsupported(config):
+
+    # Options set in an endpoint config that only the threaded engine implements
+    options = []
+    if config.get('command_schedule'):
+        options.append("command_schedule")
+    for option in ('adaptive_scan', 'burst_sampling', 'tracing'):
+        if config.get(option, False):
+            options.append(option)
+    if config.get('bus_mode', "active") != "active":
+        options.append("bus_mode")
+    return options
+
+
+def run(config, client, sink_client, endpoints, mqtt_connected):
+
+    for endpoint in endpoints:
+        options = unsupported(endpoint)
+        if options:
+            print("Error: engine asyncio does not support " + ", ".join(options) + " (" + endpoint['mqtt_base_topic'] + "), use engine threads. Stopping...")
+            return
+    asyncio.run(serve(config, client, sink_client, endpoints, mqtt_connected))
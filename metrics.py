@@ -0,0 +1,269 @@
+import bisect
+import http.server
+import threading
+import time
+
+# Prometheus metrics. The polling threads update counters, histograms and gauges
+# in a Metrics registry, the /metrics endpoint renders them in the Prometheus text
+# format. A scrape copies the values under the lock and renders outside it, and
+# the rendered text is reused for a second, so scrapes never hold up a poll.
+
+REQUEST_BUCKETS = (0.05, 0.1, 0.2, 0.3, 0.5, 0.75, 1, 1.5, 2, 3, 5)
+SCAN_BUCKETS = (0.1, 0.25, 0.5, 1, 2, 5, 10, 30)
+
+HELP = {
+    "bms_request_duration_seconds": ("histogram", "Round trip of BMS requests that got a response, per CID2"),
+    "bms_request_timeouts_total": ("counter", "BMS requests without a complete response, per CID2"),
+    "bms_frame_errors_total": ("counter", "Response frames with a CHKSUM or LCHKSUM mismatch"),
+    "bms_rtn_errors_total": ("counter", "Responses with an RTN error code"),
+    "bms_reconnects_total": ("counter", "Reconnects to the BMS"),
+    "bms_scan_duration_seconds": ("histogram", "Time spent on the BMS commands of one scan"),
+    "bms_scan_period_seconds": ("gauge", "Mean time between scan starts"),
+    "bms_scan_jitter_seconds": ("gauge", "Standard deviation of the time between scan starts"),
+    "bms_scan_overruns_total": ("counter", "Scans skipped because the scan before ran past their start"),
+    "bms_publish_queue_depth": ("gauge", "Scans waiting in the publish queue"),
+    "bms_published_scans_total": ("counter", "Scans handed to the sinks"),
+    "bms_dropped_scans_total": ("counter", "Scans dropped or coalesced because the publish queue was full"),
+    "bms_pack_voltage_volts": ("gauge", "Pack voltage"),
+    "bms_pack_current_amperes": ("gauge", "Pack current, negative when discharging"),
+    "bms_pack_soc_percent": ("gauge", "Pack state of charge"),
+    "bms_pack_soh_percent": ("gauge", "Pack state of health"),
+    "bms_pack_cycles": ("gauge", "Pack charge cycles"),
+    "bms_pack_remaining_capacity_ah": ("gauge", "Pack remaining capacity"),
+    "bms_cell_voltage_millivolts": ("gauge", "Cell voltage"),
+    "bms_cell_max_diff_millivolts": ("gauge", "Difference between the highest and lowest cell voltage of a pack"),
+    "bms_temperature_celsius": ("gauge", "Temperature sensor reading"),
+    "bms_last_scan_timestamp_seconds": ("gauge", "Time of the last scan"),
+}
+
+
+class Histogram:
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def copy(self):
+        histogram = Histogram(self.buckets)
+        histogram.counts = list(self.counts)
+        histogram.sum = self.sum
+        histogram.count = self.count
+        return histogram
+
+
+def label_text(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"')) for name, value in labels) + "}"
+
+
+class Metrics:
+
+    def __init__(self, cache_time=1):
+        self.lock = threading.Lock()
+        self.values = {}
+        self.histograms = {}
+        self.cache_time = cache_time
+        self.rendered = None
+        self.rendered_at = 0
+
+    def inc(self, name, labels=(), value=1):
+        key = (name, tuple(labels))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def set(self, name, value, labels=()):
+        with self.lock:
+            self.values[(name, tuple(labels))] = value
+
+    def observe(self, name, value, labels=(), buckets=REQUEST_BUCKETS):
+        key = (name, tuple(labels))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def render(self):
+
+        now = time.monotonic()
+        with self.lock:
+            if self.rendered is not None and now - self.rendered_at < self.cache_time:
+                return self.rendered
+            values = dict(self.values)
+            histograms = dict((key, histogram.copy()) for key, histogram in self.histograms.items())
+
+        families = {}
+        for (name, labels), value in sorted(values.items()):
+            families.setdefault(name, []).append(name + label_text(labels) + " " + repr(float(value)))
+        for (name, labels), histogram in sorted(histograms.items(), key=lambda item: item[0]):
+            lines = families.setdefault(name, [])
+            cumulative = 0
+            for bound, count in zip(histogram.buckets + (float("inf"),), histogram.counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(float(bound))
+                lines.append(name + "_bucket" + label_text(labels + (("le", le),)) + " " + str(cumulative))
+            lines.append(name + "_sum" + label_text(labels) + " " + repr(float(histogram.sum)))
+            lines.append(name + "_count" + label_text(labels) + " " + str(histogram.count))
+
+        text = []
+        for name in sorted(families):
+            kind, description = HELP.get(name, ("untyped", name))
+            text.append("# HELP " + name + " " + description)
+            text.append("# TYPE " + name + " " + kind)
+            text.extend(families[name])
+        rendered = ("\n".join(text) + "\n").encode()
+
+        with self.lock:
+            self.rendered = rendered
+            self.rendered_at = now
+        return rendered
+
+
+registry = Metrics()
+
+
+class EndpointMetrics:
+
+    # The metrics of one BMS endpoint, labelled with its base topic
+
+    def __init__(self, endpoint, metrics=None):
+        self.metrics = metrics or registry
+        self.endpoint = (("endpoint", endpoint),)
+
+    def request(self, cid2, seconds):
+        labels = self.endpoint + (("cid2", cid2.decode("ASCII")),)
+        if seconds is None:
+            self.metrics.inc("bms_request_timeouts_total", labels)
+        else:
+            self.metrics.observe("bms_request_duration_seconds", seconds, labels)
+
+    def frame_error(self, kind):
+        self.metrics.inc("bms_frame_errors_total", self.endpoint + (("kind", kind),))
+
+    def rtn_error(self, rtn):
+        self.metrics.inc("bms_rtn_errors_total", self.endpoint + (("rtn", rtn.decode("ASCII")),))
+
+    def reconnect(self):
+        self.metrics.inc("bms_reconnects_total", self.endpoint)
+
+    def scan(self, seconds):
+        self.metrics.observe("bms_scan_duration_seconds", seconds, self.endpoint, SCAN_BUCKETS)
+
+    def scan_timing(self, report):
+        self.metrics.set("bms_scan_period_seconds", report["period"], self.endpoint)
+        self.metrics.set("bms_scan_jitter_seconds", report["jitter"], self.endpoint)
+        self.metrics.set("bms_scan_overruns_total", report["overruns"], self.endpoint)
+
+    def publish_queue(self, stats):
+        self.metrics.set("bms_publish_queue_depth", stats["depth"], self.endpoint)
+        self.metrics.set("bms_published_scans_total", stats["published"], self.endpoint)
+        self.metrics.set("bms_dropped_scans_total", stats["dropped"] + stats["coalesced"], self.endpoint)
+
+
+class NullMetrics:
+
+    # Stands in for EndpointMetrics when the metrics server is off
+
+    def request(self, cid2, seconds):
+        pass
+
+    def frame_error(self, kind):
+        pass
+
+    def rtn_error(self, rtn):
+        pass
+
+    def reconnect(self):
+        pass
+
+    def scan(self, seconds):
+        pass
+
+    def scan_timing(self, report):
+        pass
+
+    def publish_queue(self, stats):
+        pass
+
+
+def endpoint_metrics(config, endpoint):
+
+    # EndpointMetrics when metrics_server is set, NullMetrics otherwise
+    if not config.get('metrics_server', False):
+        return NullMetrics()
+    return EndpointMetrics(endpoint)
+
+
+def metrics_sink(config, endpoint):
+
+    # MetricsSink when metrics_server is set, None otherwise
+    if not config.get('metrics_server', False):
+        return None
+    return MetricsSink(endpoint)
+
+
+class MetricsSink:
+
+    # Sink that keeps gauges of the latest pack values
+
+    def __init__(self, endpoint, metrics=None):
+        self.metrics = metrics or registry
+        self.endpoint = (("endpoint", endpoint),)
+
+    def publish(self, bank, verbose=False):
+
+        metrics = self.metrics
+        metrics.set("bms_last_scan_timestamp_seconds", bank.timestamp, self.endpoint)
+
+        for pack in bank.packs:
+            labels = self.endpoint + (("pack", pack.pack),)
+            metrics.set("bms_pack_voltage_volts", pack.v_pack, labels)
+            metrics.set("bms_pack_current_amperes", pack.i_pack, labels)
+            metrics.set("bms_pack_remaining_capacity_ah", pack.i_remain_cap / 1000, labels)
+            metrics.set("bms_pack_cycles", pack.cycles, labels)
+            metrics.set("bms_cell_max_diff_millivolts", pack.cell_max_diff_volt, labels)
+            if pack.soc is not None:
+                metrics.set("bms_pack_soc_percent", pack.soc, labels)
+            if pack.soh is not None:
+                metrics.set("bms_pack_soh_percent", pack.soh, labels)
+            for i, v_cell in enumerate(pack.v_cells):
+                metrics.set("bms_cell_voltage_millivolts", v_cell, labels + (("cell", i+1),))
+            for i, t_cell in enumerate(pack.t_cells):
+                metrics.set("bms_temperature_celsius", round(t_cell, 1), labels + (("sensor", i+1),))
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = registry.render()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def metrics_server(config):
+
+    # Starts the /metrics endpoint when metrics_server is set
+    if not config.get('metrics_server', False):
+        return None
+    server = http.server.ThreadingHTTPServer(("", config.get('metrics_port', 9120)), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    print("Prometheus metrics on port " + str(server.server_address[1]) + ", path /metrics")
+    return server
@@ -0,0 +1,201 @@
+import queue
+import socket
+import threading
+import time
+
+import serial
+
+import transport
+
+# BMS port multiplexer. It owns the physical link to the BMS and accepts any number
+# of TCP clients speaking the Pace framing (this add-on, the dev add-ons, the vendor
+# PC tool over a TCP to serial bridge). Requests from all clients are serialized
+# onto the bus one at a time. Identical requests (same frame, so same ADR, CID2
+# and INFO) already waiting for the bus share one transaction, and answers are
+# cached for cache_ttl seconds.
+
+
+class Transaction:
+
+    def __init__(self, frame):
+        self.frame = frame
+        self.response = None
+        self.done = threading.Event()
+
+
+class Multiplexer:
+
+    def __init__(self, config, port=5100, cache_ttl=1):
+        self.config = config
+        self.port = port
+        self.cache_ttl = cache_ttl
+        self.debug_output = config['debug_output']
+        self.frame_timeout = config.get('frame_timeout', 2)
+        self.pacer = transport.RequestPacer(config.get('request_pacing', "fixed"), turnaround=config.get('bus_turnaround', 0.05), max_timeout=self.frame_timeout)
+        self.reassembler = transport.FrameReassembler()
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.in_flight = {}
+        self.cache = {}
+        self.link = None
+        self.clients = 0
+        self.requests = 0
+        self.transactions = 0
+        self.coalesced = 0
+        self.cache_hits = 0
+
+    def start(self):
+        threading.Thread(target=self.run_bus, name="multiplexer-bus", daemon=True).start()
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind(("", self.port))
+        server.listen()
+        threading.Thread(target=self.run_server, args=(server,), name="multiplexer", daemon=True).start()
+        print("BMS multiplexer listening on port " + str(self.port))
+        return self
+
+    def stats(self):
+        with self.lock:
+            return {"clients": self.clients, "requests": self.requests, "transactions": self.transactions,
+                    "coalesced": self.coalesced, "cache_hits": self.cache_hits, "queued": self.queue.qsize()}
+
+    # Bus side
+
+    def connect(self):
+
+        try:
+            if self.config['connection_type'] == "Serial":
+                print("Multiplexer connecting %s" % self.config['bms_serial'])
+                self.link = serial.Serial(self.config['bms_serial'], timeout=1)
+            else:
+                print("Multiplexer connecting " + self.config['bms_ip'] + ":" + str(self.config['bms_port']))
+                self.link = socket.create_connection((self.config['bms_ip'], self.config['bms_port']), timeout=2)
+        except OSError as e:
+            print("Multiplexer error connecting to BMS: %s" % e)
+            self.link = None
+            return False
+
+        self.reassembler.reset()
+        return True
+
+    def disconnect(self):
+        if self.link is not None:
+            try:
+                self.link.close()
+            except OSError:
+                pass
+            self.link = None
+
+    def transact(self, frame):
+
+        # One request on the bus, returns the response frame or None
+        if self.link is None and not self.connect():
+            return None
+
+        stale = self.reassembler.pending_frames()
+        if (len(stale) > 0) & (self.debug_output > 0):
+            print("Multiplexer discarding stale frames: " + str(stale))
+
+        try:
+            self.pacer.before_send()
+            if hasattr(self.link, 'sendall'):
+                self.link.sendall(frame)
+            else:
+                self.link.write(frame)
+            self.pacer.after_send(frame)
+            response = self.reassembler.read_frame(self.link, self.pacer.response_timeout())
+            self.pacer.after_response(response is not None)
+        except OSError as e:
+            self.pacer.after_response(False)
+            print("Multiplexer BMS error: %s" % e)
+            self.disconnect()
+            return None
+
+        if response is None and self.debug_output > 0:
+            print("Multiplexer: no response to " + str(frame))
+        return response
+
+    def run_bus(self):
+
+        # Every queued transaction ends with done set, answered or expired after the
+        # response timeout, so requesters never give up on a transaction still queued
+        while True:
+            transaction = self.queue.get()
+            response = None
+            try:
+                response = self.transact(transaction.frame)
+            finally:
+                now = time.monotonic()
+                with self.lock:
+                    self.transactions += 1
+                    del self.in_flight[transaction.frame]
+                    self.cache = dict((frame, cached) for frame, cached in self.cache.items() if now - cached[0] < self.cache_ttl)
+                    if response is not None:
+                        self.cache[transaction.frame] = (now, response)
+                transaction.response = response
+                transaction.done.set()
+
+    def request(self, frame):
+
+        # Response frame for a client's request frame, None when the BMS did not answer
+        with self.lock:
+            self.requests += 1
+
+            cached = self.cache.get(frame)
+            if cached is not None and time.monotonic() - cached[0] < self.cache_ttl:
+                self.cache_hits += 1
+                return cached[1]
+
+            transaction = self.in_flight.get(frame)
+            if transaction is None:
+                transaction = Transaction(frame)
+                self.in_flight[frame] = transaction
+                self.queue.put(transaction)
+            else:
+                self.coalesced += 1
+
+        # Waits for the requests queued before it plus its own round trip, the bus
+        # thread sets done when the transaction is answered or expired
+        transaction.done.wait()
+        return transaction.response
+
+    # Client side
+
+    def run_server(self, server):
+        while True:
+            connection, address = server.accept()
+            threading.Thread(target=self.run_client, args=(connection, address), daemon=True).start()
+
+    def run_client(self, connection, address):
+
+        with self.lock:
+            self.clients += 1
+        if self.debug_output > 0:
+            print("Multiplexer client connected: " + str(address))
+
+        reassembler = transport.FrameReassembler()
+        try:
+            while True:
+                data = connection.recv(4096)
+                if len(data) == 0:
+                    break
+                reassembler.feed(data)
+                for frame in reassembler.pending_frames():
+                    response = self.request(frame)
+                    if response is not None:
+                        connection.sendall(response)
+        except OSError as e:
+            if self.debug_output > 0:
+                print("Multiplexer client error: %s" % e)
+        finally:
+            connection.close()
+            with self.lock:
+                self.clients -= 1
+
+
+def multiplexer(config):
+
+    # Started Multiplexer from the multiplexer options, None when it is off
+    if not config.get('multiplexer', False):
+        return None
+    return Multiplexer(config, config.get('multiplexer_port', 5100), config.get('multiplexer_cache_ttl', 1)).start()
@@ -0,0 +1,119 @@
+import collections
+import json
+import time
+
+import constants
+import spool
+
+# Burst sampling. A change of a protect, fault or warning state, or a jump in pack
+# current, starts a burst: analog data and warnings are polled back to back for a
+# while instead of at their normal period. The last scans before the trigger are
+# kept in a ring buffer, so when the burst ends the lead-up and the burst go out
+# together on <base>/burst, split into parts of at most max_payload bytes so no
+# single MQTT message gets larger than brokers accept.
+
+BURST_COMMANDS = (constants.cid2PackAnalogData, constants.cid2WarnInfo)
+
+STATE_FIELDS = ("protect_state1", "protect_state2", "fault_state", "warn_state1", "warn_state2")
+
+
+class BurstSampler:
+
+    def __init__(self, duration=10, current_step=20, pre_trigger=10, max_scans=1000, max_payload=256*1024):
+        self.duration = duration
+        self.current_step = current_step
+        self.max_scans = max_scans
+        self.max_payload = max_payload
+        self.ring = collections.deque(maxlen=pre_trigger)
+        self.states = {}
+        self.currents = {}
+        self.until = 0
+        self.trigger = None
+        self.scans = []
+        self.bursts = 0
+
+    def changes(self, bank):
+
+        # Why this scan starts a burst, None when it doesn't. The first scan of a
+        # pack only sets the reference
+        reasons = []
+
+        for status in bank.status:
+            states = tuple(getattr(status, name) for name in STATE_FIELDS)
+            last = self.states.get(status.pack)
+            if last is not None and last != states:
+                changed = [name for name, a, b in zip(STATE_FIELDS, last, states) if a != b]
+                reasons.append("pack_" + str(status.pack) + " " + ", ".join(changed))
+            self.states[status.pack] = states
+
+        for pack in bank.packs:
+            last = self.currents.get(pack.pack)
+            if self.current_step > 0 and last is not None and abs(pack.i_pack - last) >= self.current_step:
+                reasons.append("pack_" + str(pack.pack) + " i_pack " + str(last) + " -> " + str(pack.i_pack))
+            self.currents[pack.pack] = pack.i_pack
+
+        if not reasons:
+            return None
+        return "; ".join(reasons)
+
+    def active(self, now=None):
+        if now is None:
+            now = time.monotonic()
+        return self.trigger is not None and now < self.until
+
+    def add(self, bank, now=None):
+
+        # Takes every scan. Returns the burst documents when a burst ended, else None
+        if now is None:
+            now = time.monotonic()
+
+        reason = self.changes(bank)
+        documents = None
+
+        if self.trigger is not None:
+            if len(self.scans) < self.max_scans:
+                self.scans.append(bank)
+            if reason is not None:
+                # Another change during the burst extends it
+                self.until = now + self.duration
+            elif now >= self.until:
+                documents = self.documents()
+                self.trigger = None
+                self.scans = []
+        elif reason is not None:
+            self.trigger = (bank.timestamp, reason)
+            self.until = now + self.duration
+            self.scans = list(self.ring) + [bank]
+            self.bursts += 1
+            print("Burst sampling: " + reason)
+
+        self.ring.append(bank)
+        return documents
+
+    def documents(self):
+
+        # The burst as documents of at most max_payload bytes, each with its part
+        # number and the number of parts. A part holds at least one scan
+        timestamp, reason = self.trigger
+        head = '{"timestamp":' + json.dumps(round(timestamp, 3)) + ',"trigger":' + json.dumps(reason)
+        overhead = len(head) + len(',"part":,"parts":,"scans":[]}') + 8
+        parts = [[]]
+        size = overhead
+        for bank in self.scans:
+            record = spool.record(bank)
+            if parts[-1] and size + len(record) + 1 > self.max_payload:
+                parts.append([])
+                size = overhead
+            parts[-1].append(record)
+            size += len(record) + 1
+        return [head + ',"part":' + str(n) + ',"parts":' + str(len(parts)) + ',"scans":[' + ",".join(records) + ']}'
+                for n, records in enumerate(parts, 1)]
+
+
+def burst_sampler(config):
+
+    # BurstSampler from the burst_sampling options, None when bursts are off
+    if not config.get('burst_sampling', False):
+        return None
+    return BurstSampler(config.get('burst_duration', 10), config.get('burst_current_step', 20), config.get('burst_pre_trigger', 10),
+                        max_payload=int(config.get('burst_max_payload', 256)*1024))
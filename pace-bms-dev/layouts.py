@@ -0,0 +1,137 @@
+import constants
+
+# Response INFO layouts per protocol dialect, compiled into decode functions by decoders.py
+#
+# Field kinds:
+#   "skip", n       n bytes that are not used
+#   "u8"/"u16"/"s16" one value per pack
+#   "count"         number of items in the list that follows
+#   "words", count  list of u16, one per counted item
+#   "states", count list of u8, one per counted item
+#   "ascii", n      n bytes of ASCII text (None for the rest of INFO)
+#
+# "header" fields are read once, "pack" fields once per pack. If the header has no
+# "packs" field the response holds one pack. Between packs the decoder skips bytes
+# until it finds the first count of the previous pack again (INFOFLAG / padding).
+#
+# "units" convert raw values: (raw + offset) * factor / divisor
+
+PACE = {
+    "name": "Pace",
+    "ver": b"\x32\x35",
+    "per_address": False,
+
+    constants.cid2PackAnalogData: {
+        "header": [(None, "skip", 1), ("packs", "u8")],
+        "pack": [
+            ("cells", "count"),
+            ("v_cells", "words", "cells"),
+            ("temps", "count"),
+            ("t_cells", "words", "temps"),
+            ("i_pack", "s16"),
+            ("v_pack", "u16"),
+            ("i_remain_cap", "u16"),
+            (None, "skip", 1),
+            ("i_full_cap", "u16"),
+            ("cycles", "u16"),
+            ("i_design_cap", "u16"),
+        ],
+        "units": {
+            "t_cells": (-2730, 1, 10),
+            "i_pack": (0, 1, 100),
+            "v_pack": (0, 1, 1000),
+            "i_remain_cap": (0, 10, 1),
+            "i_full_cap": (0, 10, 1),
+            "i_design_cap": (0, 10, 1),
+        },
+    },
+
+    constants.cid2WarnInfo: {
+        "header": [(None, "skip", 1), ("packs", "u8")],
+        "pack": [
+            ("cells", "count"),
+            ("cell_states", "states", "cells"),
+            ("temps", "count"),
+            ("temp_states", "states", "temps"),
+            ("charge_current_state", "u8"),
+            ("total_voltage_state", "u8"),
+            ("discharge_current_state", "u8"),
+            ("protect_state1", "u8"),
+            ("protect_state2", "u8"),
+            ("instruction_state", "u8"),
+            ("control_state", "u8"),
+            ("fault_state", "u8"),
+            ("balance_state1", "u8"),
+            ("balance_state2", "u8"),
+            ("warn_state1", "u8"),
+            ("warn_state2", "u8"),
+        ],
+    },
+
+    constants.cid2PackCapacity: {
+        "header": [],
+        "pack": [
+            ("pack_remain_cap", "u16"),
+            ("pack_full_cap", "u16"),
+            ("pack_design_cap", "u16"),
+        ],
+        "units": {
+            "pack_remain_cap": (0, 10, 1),
+            "pack_full_cap": (0, 10, 1),
+            "pack_design_cap": (0, 10, 1),
+        },
+    },
+
+    constants.cid2SoftwareVersion: {
+        "header": [("bms_version", "ascii", None)],
+        "pack": [],
+    },
+
+    constants.cid2SerialNumber: {
+        "header": [("bms_sn", "ascii", 15), (None, "skip", 5), ("pack_sn", "ascii", 14)],
+        "pack": [],
+    },
+}
+
+# Volta SG1 answers per ADR with a single pack, reports SOC / SOH directly and
+# has no design capacity. Temperatures are in degrees C + 40, voltage in 10 mV.
+VOLTA_SG1 = {
+    "name": "Volta SG1",
+    "ver": b"\x32\x31",
+    "per_address": True,
+
+    constants.cid2PackAnalogData: {
+        "header": [(None, "skip", 1)],
+        "pack": [
+            ("cells", "count"),
+            ("v_cells", "words", "cells"),
+            ("temps", "count"),
+            ("t_cells", "words", "temps"),
+            ("i_pack", "s16"),
+            ("v_pack", "u16"),
+            ("i_remain_cap", "u16"),
+            (None, "skip", 1),
+            ("i_full_cap", "u16"),
+            ("cycles", "u16"),
+            ("soc", "u8"),
+            ("soh", "u8"),
+        ],
+        "units": {
+            "t_cells": (-40, 1, 1),
+            "i_pack": (0, 1, 100),
+            "v_pack": (0, 1, 100),
+            "i_remain_cap": (0, 10, 1),
+            "i_full_cap": (0, 10, 1),
+        },
+    },
+
+    constants.cid2WarnInfo: PACE[constants.cid2WarnInfo],
+    constants.cid2PackCapacity: PACE[constants.cid2PackCapacity],
+    constants.cid2SoftwareVersion: PACE[constants.cid2SoftwareVersion],
+    constants.cid2SerialNumber: PACE[constants.cid2SerialNumber],
+}
+
+DIALECTS = {
+    "Pace": PACE,
+    "Volta SG1": VOLTA_SG1,
+}
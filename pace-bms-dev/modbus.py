@@ -0,0 +1,238 @@
+import socketserver
+import struct
+import threading
+from array import array
+
+# Modbus TCP server for the latest snapshot. ModbusSink writes every published
+# BankSnapshot into a register image and the server answers reads (function 3,
+# read holding registers, and 4, read input registers, same image) from it. It
+# never talks to the BMS, so any number of readers can poll at any rate.
+#
+# Register map, unsigned 16 bit registers unless noted:
+#
+#   Bank, registers 0-99
+#     0        number of packs, every pack read since the start counts, so it
+#              is also right when each scan reads one pack (Volta SG1)
+#     1        remaining capacity, 10 mAh
+#     2        full capacity, 10 mAh
+#     3        design capacity, 10 mAh
+#     4        SOC, 0.1 %
+#     5        SOH, 0.1 %
+#     6-7      timestamp of the scan, epoch seconds, 32 bit high word first
+#     8        update counter, wraps at 65535
+#
+#   Pack N, registers N*100 to N*100+99 (pack 1 at 100, pack 2 at 200, ...)
+#     +0       number of cells
+#     +1-24    cell voltages, mV
+#     +25      number of temperatures
+#     +26-33   temperatures, 0.1 C, signed
+#     +34      current, 0.01 A, signed
+#     +35      voltage, 0.01 V
+#     +36      remaining capacity, 10 mAh
+#     +37      full capacity, 10 mAh
+#     +38      design capacity, 10 mAh, 0 if unknown
+#     +39      SOC, 0.1 %
+#     +40      SOH, 0.1 %
+#     +41      cycles
+#     +42      cell max difference, mV
+#     +50-58   protect state 1, protect state 2, instruction state, control state,
+#              fault state, balance state 1, balance state 2, warn state 1,
+#              warn state 2 (bitfields, see constants.py)
+#
+# Capacity registers are kept from the last 0xA6 read, pack blocks from the last
+# read of that pack. Registers that were never written read 0.
+
+PACK_BLOCK = 100
+MAX_CELLS = 24
+MAX_TEMPS = 8
+
+ILLEGAL_FUNCTION = 1
+ILLEGAL_DATA_ADDRESS = 2
+ILLEGAL_DATA_VALUE = 3
+GATEWAY_TARGET_FAILED = 11
+
+
+def u16(value, scale=1):
+    return min(0xFFFF, max(0, int(round(value * scale))))
+
+
+def s16(value, scale=1):
+    return min(0x7FFF, max(-0x8000, int(round(value * scale)))) & 0xFFFF
+
+
+class ModbusServer:
+
+    def __init__(self, port=502, max_packs=16):
+        self.port = port
+        self.size = PACK_BLOCK * (max_packs + 1)
+        self.images = {}
+        self.lock = threading.Lock()
+        self.requests = 0
+
+    def start(self):
+        server = socketserver.ThreadingTCPServer(("", self.port), ModbusHandler, bind_and_activate=False)
+        server.allow_reuse_address = True
+        server.daemon_threads = True
+        server.modbus = self
+        server.server_bind()
+        server.server_activate()
+        threading.Thread(target=server.serve_forever, name="modbus", daemon=True).start()
+        print("Modbus TCP server listening on port " + str(self.port))
+        return self
+
+    def image(self, unit):
+        with self.lock:
+            return self.images.get(unit) or array('H', bytes(2 * self.size))
+
+    def update(self, unit, image):
+        # Replaces the whole image, readers see one scan or the next, never a mix
+        with self.lock:
+            self.images[unit] = image
+
+    def read(self, unit, start, count):
+
+        # (registers, None) or (None, exception code)
+        with self.lock:
+            self.requests += 1
+            if unit in (0, 255) and unit not in self.images and self.images:
+                # Broadcast / "not used" unit ids read the first BMS
+                unit = min(self.images)
+            image = self.images.get(unit)
+        if image is None:
+            return None, GATEWAY_TARGET_FAILED
+        if count < 1 or count > 125:
+            return None, ILLEGAL_DATA_VALUE
+        if start + count > len(image):
+            return None, ILLEGAL_DATA_ADDRESS
+        return image[start:start + count], None
+
+    def handle(self, header, pdu):
+
+        # Response ADU for one request ADU (MBAP header + PDU)
+        transaction, protocol, length, unit = struct.unpack(">HHHB", header)
+        function = pdu[0]
+
+        if function not in (3, 4):
+            body = struct.pack(">BB", function | 0x80, ILLEGAL_FUNCTION)
+        elif len(pdu) != 5:
+            body = struct.pack(">BB", function | 0x80, ILLEGAL_DATA_VALUE)
+        else:
+            start, count = struct.unpack(">HH", pdu[1:5])
+            registers, error = self.read(unit, start, count)
+            if error is not None:
+                body = struct.pack(">BB", function | 0x80, error)
+            else:
+                registers = array('H', registers)
+                registers.byteswap()
+                body = struct.pack(">BB", function, 2 * count) + registers.tobytes()
+
+        return struct.pack(">HHHB", transaction, protocol, len(body) + 1, unit) + body
+
+
+class ModbusHandler(socketserver.BaseRequestHandler):
+
+    def read_exactly(self, size):
+        data = b''
+        while len(data) < size:
+            chunk = self.request.recv(size - len(data))
+            if not chunk:
+                return None
+            data += chunk
+        return data
+
+    def handle(self):
+        server = self.server.modbus
+        try:
+            while True:
+                header = self.read_exactly(7)
+                if header is None:
+                    return
+                length = struct.unpack(">H", header[4:6])[0]
+                if length < 2 or length > 254:
+                    return
+                pdu = self.read_exactly(length - 1)
+                if pdu is None:
+                    return
+                self.request.sendall(server.handle(header, pdu))
+        except OSError:
+            return
+
+
+class ModbusSink:
+
+    # Sink that writes BankSnapshots into the register image of one unit id
+
+    def __init__(self, server, unit=1):
+        self.server = server
+        self.unit = unit
+        self.updates = 0
+        self.packs = set()
+
+    def publish(self, bank, verbose=False):
+
+        image = array('H', self.server.image(self.unit))
+        max_packs = len(image) // PACK_BLOCK - 1
+
+        self.packs.update(pack.pack for pack in bank.packs if 1 <= pack.pack <= max_packs)
+        image[0] = len(self.packs)
+
+        capacity = bank.capacity
+        if capacity is not None:
+            image[1:6] = array('H', (u16(capacity.pack_remain_cap, 0.1), u16(capacity.pack_full_cap, 0.1),
+                                     u16(capacity.pack_design_cap, 0.1), u16(capacity.pack_soc, 10),
+                                     u16(capacity.pack_soh, 10)))
+
+        timestamp = int(bank.timestamp) & 0xFFFFFFFF
+        image[6] = timestamp >> 16
+        image[7] = timestamp & 0xFFFF
+        self.updates += 1
+        image[8] = self.updates & 0xFFFF
+
+        for pack in bank.packs:
+            if not 1 <= pack.pack <= max_packs:
+                continue
+            base = pack.pack * PACK_BLOCK
+            cells = pack.v_cells[:MAX_CELLS]
+            temps = pack.t_cells[:MAX_TEMPS]
+            image[base:base + 50] = array('H', bytes(100))
+            image[base] = len(cells)
+            image[base + 1:base + 1 + len(cells)] = array('H', (u16(v) for v in cells))
+            image[base + 25] = len(temps)
+            image[base + 26:base + 26 + len(temps)] = array('H', (s16(t, 10) for t in temps))
+            image[base + 34] = s16(pack.i_pack, 100)
+            image[base + 35] = u16(pack.v_pack, 100)
+            image[base + 36] = u16(pack.i_remain_cap, 0.1)
+            image[base + 37] = u16(pack.i_full_cap, 0.1)
+            image[base + 38] = u16(pack.i_design_cap or 0, 0.1)
+            image[base + 39] = u16(pack.soc or 0, 10)
+            image[base + 40] = u16(pack.soh or 0, 10)
+            image[base + 41] = u16(pack.cycles)
+            image[base + 42] = u16(pack.cell_max_diff_volt)
+
+        for status in bank.status:
+            if not 1 <= status.pack <= max_packs:
+                continue
+            base = status.pack * PACK_BLOCK + 50
+            states = (status.protect_state1, status.protect_state2, status.instruction_state, status.control_state,
+                      status.fault_state, status.balance_state1, status.balance_state2, status.warn_state1, status.warn_state2)
+            image[base:base + 9] = array('H', (state or 0 for state in states))
+
+        self.server.update(self.unit, image)
+
+
+servers = {}
+servers_lock = threading.Lock()
+
+
+def modbus_sink(config):
+
+    # ModbusSink from the modbus options, None when the server is off. Endpoints
+    # share one server per port, each with its own unit id
+    if not config.get('modbus_server', False):
+        return None
+    port = config.get('modbus_port', 502)
+    with servers_lock:
+        server = servers.get(port)
+        if server is None:
+            server = servers[port] = ModbusServer(port).start()
+    return ModbusSink(server, config.get('modbus_unit', 1))
@@ -0,0 +1,375 @@
+import collections
+import json
+import threading
+import time
+
+# Sinks consume BankSnapshots (see snapshot.py). Each sink has a
+# publish(bank, verbose) method, verbose prints the values as they are published.
+
+# Field classes that can have a deadband, with the option that sets it
+DEADBAND_OPTIONS = {
+    "cells": "deadband_cells",
+    "temps": "deadband_temps",
+    "current": "deadband_current",
+    "voltage": "deadband_voltage",
+}
+
+
+def parse_deadband(text):
+
+    # "5" is an absolute deadband in the unit of the value, "2%" is relative to the
+    # last published value. Returns (size, percent)
+    text = str(text).strip()
+    if text.endswith("%"):
+        return float(text[:-1]), True
+    return float(text or 0), False
+
+
+class ChangeFilter:
+
+    # Remembers the last published payload per topic and tells which values are
+    # worth publishing: anything that moved by at least the deadband of its field
+    # class, or anything that has not been published for max_silence seconds
+
+    def __init__(self, deadbands=None, max_silence=300):
+        self.deadbands = deadbands or {}
+        self.max_silence = max_silence
+        self.last = {}
+        self.skipped = 0
+
+    def clear(self):
+        self.last.clear()
+
+    def changed(self, topic, payload, value=None, field=None):
+
+        now = time.monotonic()
+        last = self.last.get(topic)
+
+        if last is not None and now - last[2] < self.max_silence:
+            last_payload, last_value = last[0], last[1]
+            if payload == last_payload:
+                self.skipped += 1
+                return False
+            band = self.deadbands.get(field)
+            if band is not None and value is not None and last_value is not None:
+                size, percent = band
+                if percent:
+                    size = abs(last_value) * size / 100
+                if abs(value - last_value) < size:
+                    self.skipped += 1
+                    return False
+
+        self.last[topic] = (payload, value, now)
+        return True
+
+
+def change_filter(config):
+
+    # ChangeFilter from the add-on options, None when every value is published every cycle
+    if not config.get('publish_changes_only', False):
+        return None
+
+    deadbands = {}
+    for field, option in DEADBAND_OPTIONS.items():
+        size, percent = parse_deadband(config.get(option, 0))
+        if size > 0:
+            deadbands[field] = (size, percent)
+
+    return ChangeFilter(deadbands, config.get('publish_max_silence', 300))
+
+
+class MqttSink:
+
+    # One MQTT topic per value under base_topic, e.g. <base>/pack_1/v_cells/cell_1.
+    # With a ChangeFilter only changed values are sent
+
+    def __init__(self, client, base_topic, changes=None):
+        self.client = client
+        self.base_topic = base_topic
+        self.changes = changes
+
+    def send(self, topic, payload, value=None, field=None):
+        if self.changes is not None and not self.changes.changed(topic, payload, value, field):
+            return
+        self.client.publish(topic, payload)
+
+    def publish(self, bank, verbose=False):
+
+        # Verbose cycles (start up, reconnect, hourly) send everything again
+        if verbose and self.changes is not None:
+            self.changes.clear()
+
+        if bank.packs and verbose:
+            print("Packs: " + str(len(bank.packs)))
+
+        for pack in bank.packs:
+            self.publish_pack(pack, verbose)
+
+        if bank.capacity is not None:
+            self.publish_capacity(bank.capacity, verbose)
+
+        if bank.status and verbose:
+            print("Packs for warnings: " + str(len(bank.status)))
+
+        for status in bank.status:
+            self.publish_status(status, verbose)
+
+    def publish_pack(self, pack, verbose=False):
+
+        p = str(pack.pack)
+        topic = self.base_topic + "/pack_" + p
+
+        if verbose:
+            print("Pack " + p + ", Total cells: " + str(pack.cells))
+
+        for i, v_cell in enumerate(pack.v_cells):
+            self.send(topic + "/v_cells/cell_" + str(i+1), str(v_cell), v_cell, "cells")
+            if verbose:
+                print("Pack " + p + ", V Cell" + str(i+1) + ": " + str(v_cell) + " mV")
+
+        self.send(topic + "/cells_max_diff_calc", str(pack.cell_max_diff_volt), pack.cell_max_diff_volt, "cells")
+        if verbose:
+            print("Pack " + p + ", Cell Max Diff Volt Calc: " + str(pack.cell_max_diff_volt) + " mV")
+
+        if verbose:
+            print("Pack " + p + ", Total temperature sensors: " + str(pack.temps))
+
+        for i, t_cell in enumerate(pack.t_cells):
+            self.send(topic + "/temps/temp_" + str(i+1), str(round(t_cell,1)), t_cell, "temps")
+            if verbose:
+                print("Pack " + p + ", Temp" + str(i+1) + ": " + str(round(t_cell,1)) + " ℃")
+
+        for name, label, unit, field in (("i_pack", "I Pack", " A", "current"),
+                                         ("v_pack", "V Pack", " V", "voltage"),
+                                         ("i_remain_cap", "I Remaining Capacity", " mAh", None),
+                                         ("i_full_cap", "I Full Capacity", " mAh", None),
+                                         ("soc", "SOC", " %", None),
+                                         ("cycles", "Cycles", "", None),
+                                         ("i_design_cap", "Design Capacity", " mAh", None),
+                                         ("soh", "SOH", " %", None)):
+            value = getattr(pack, name)
+            if value is None:
+                continue
+            self.send(topic + "/" + name, str(value), value, field)
+            if verbose:
+                print("Pack " + p + ", " + label + ": " + str(value) + unit)
+
+    def publish_capacity(self, capacity, verbose=False):
+
+        for name, label, unit in (("pack_remain_cap", "Pack Remaining Capacity", " mAh"),
+                                  ("pack_full_cap", "Pack Full Capacity", " mAh"),
+                                  ("pack_design_cap", "Pack Design Capacity", " mAh"),
+                                  ("pack_soc", "Pack SOC", " %"),
+                                  ("pack_soh", "Pack SOH", " %")):
+            value = getattr(capacity, name)
+            self.send(self.base_topic + "/" + name, str(value))
+            if verbose:
+                print(label + ": " + str(value) + unit)
+
+    def publish_status(self, status, verbose=False):
+
+        p = str(status.pack)
+        topic = self.base_topic + "/pack_" + p
+
+        self.send(topic + "/prot_short_circuit", str(status.protect_state1>>6 & 1))
+        self.send(topic + "/prot_discharge_current", str(status.protect_state1>>5 & 1))
+        self.send(topic + "/prot_charge_current", str(status.protect_state1>>4 & 1))
+
+        self.send(topic + "/fully", str(status.protect_state2>>7 & 1))
+
+        self.send(topic + "/current_limit", str(status.instruction_state>>0 & 1))
+        self.send(topic + "/charge_fet", str(status.instruction_state>>1 & 1))
+        # DFET is bit 3 (>>2), the root add-on used to publish the reverse bit (>>4)
+        self.send(topic + "/discharge_fet", str(status.instruction_state>>2 & 1))
+        self.send(topic + "/pack_indicate", str(status.instruction_state>>3 & 1))
+        self.send(topic + "/reverse", str(status.instruction_state>>4 & 1))
+        self.send(topic + "/ac_in", str(status.instruction_state>>5 & 1))
+        self.send(topic + "/heart", str(status.instruction_state>>7 & 1))
+
+        self.send(topic + "/warnings", status.warnings)
+        if verbose:
+            print("Pack " + p + ", warnings: " + status.warnings)
+
+        balanceState1 = '{0:08b}'.format(status.balance_state1)
+        self.send(topic + "/balancing1", balanceState1)
+        if verbose:
+            print("Pack " + p + ", balancing1: " + balanceState1)
+
+        balanceState2 = '{0:08b}'.format(status.balance_state2)
+        self.send(topic + "/balancing2", balanceState2)
+        if verbose:
+            print("Pack " + p + ", balancing2: " + balanceState2)
+
+
+def pack_documents(bank):
+
+    # {pack number: document} for the JSON publish mode and the store and forward
+    # spool. Keys follow the per value topics
+    documents = {}
+
+    for pack in bank.packs:
+        document = documents.setdefault(pack.pack, {})
+        document["v_cells"] = dict(("cell_" + str(i+1), v_cell) for i, v_cell in enumerate(pack.v_cells))
+        document["cells_max_diff_calc"] = pack.cell_max_diff_volt
+        document["temps"] = dict(("temp_" + str(i+1), round(t_cell,1)) for i, t_cell in enumerate(pack.t_cells))
+        for name in ("i_pack", "v_pack", "i_remain_cap", "i_full_cap", "soc", "cycles", "i_design_cap", "soh"):
+            value = getattr(pack, name)
+            if value is not None:
+                document[name] = value
+
+    for status in bank.status:
+        document = documents.setdefault(status.pack, {})
+        document["prot_short_circuit"] = status.protect_state1>>6 & 1
+        document["prot_discharge_current"] = status.protect_state1>>5 & 1
+        document["prot_charge_current"] = status.protect_state1>>4 & 1
+        document["fully"] = status.protect_state2>>7 & 1
+        document["current_limit"] = status.instruction_state>>0 & 1
+        document["charge_fet"] = status.instruction_state>>1 & 1
+        document["discharge_fet"] = status.instruction_state>>2 & 1
+        document["pack_indicate"] = status.instruction_state>>3 & 1
+        document["reverse"] = status.instruction_state>>4 & 1
+        document["ac_in"] = status.instruction_state>>5 & 1
+        document["heart"] = status.instruction_state>>7 & 1
+        document["warnings"] = status.warnings
+        document["balancing1"] = '{0:08b}'.format(status.balance_state1)
+        document["balancing2"] = '{0:08b}'.format(status.balance_state2)
+
+    return documents
+
+
+def bank_document(bank):
+
+    # The bank document needs the 0xA6 capacity, which per address reads don't have
+    if bank.capacity is None:
+        return None
+    document = {"packs": len(bank.packs)}
+    for name in ("pack_remain_cap", "pack_full_cap", "pack_design_cap", "pack_soc", "pack_soh"):
+        document[name] = getattr(bank.capacity, name)
+    return document
+
+
+class JsonSink:
+
+    # One JSON document per pack on <base>/pack_N/state and one for
+    # the bank on <base>/state. Keys follow the per value topics, so
+    # <base>/pack_1/v_cells/cell_1 is value_json.v_cells.cell_1 in the pack document.
+    # With a ChangeFilter documents are only sent when they changed
+
+    def __init__(self, client, base_topic, changes=None):
+        self.client = client
+        self.base_topic = base_topic
+        self.changes = changes
+
+    def send(self, topic, document):
+        payload = json.dumps(document, separators=(',', ':'))
+        if self.changes is not None and not self.changes.changed(topic, payload):
+            return
+        self.client.publish(topic, payload)
+
+    def publish(self, bank, verbose=False):
+
+        if verbose and self.changes is not None:
+            self.changes.clear()
+
+        for p, document in pack_documents(bank).items():
+            self.send(self.base_topic + "/pack_" + str(p) + "/state", document)
+            if verbose:
+                print("Pack " + str(p) + ": " + json.dumps(document))
+
+        document = bank_document(bank)
+        if document is not None:
+            self.send(self.base_topic + "/state", document)
+            if verbose:
+                print("Bank: " + json.dumps(document))
+
+
+class PublishQueue:
+
+    # Hands BankSnapshots from the polling loop to a publisher thread, so a slow
+    # broker does not stretch the scan interval. The queue is bounded, when it is
+    # full "drop_oldest" discards the oldest snapshot and "coalesce" replaces the
+    # newest queued one, so the latest values always go out. With size 0 put()
+    # publishes inline as before
+
+    def __init__(self, sinks, size=8, policy="drop_oldest"):
+        self.sinks = sinks
+        self.size = size
+        self.policy = policy
+        self.queue = collections.deque()
+        self.condition = threading.Condition()
+        self.thread = None
+        self.queued = 0
+        self.published = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.high_water = 0
+        self.tracer = None
+
+    def start(self):
+        if self.size > 0 and self.thread is None:
+            self.thread = threading.Thread(target=self.run, name="publisher", daemon=True)
+            self.thread.start()
+        return self
+
+    def put(self, bank, verbose=False):
+
+        if self.thread is None:
+            self.publish(bank, verbose)
+            return
+
+        with self.condition:
+            if len(self.queue) >= self.size:
+                if self.policy == "coalesce":
+                    # A verbose cycle stays verbose, it resets the change filters
+                    verbose = self.queue.pop()[1] or verbose
+                    self.coalesced += 1
+                else:
+                    if self.queue.popleft()[1]:
+                        if self.queue:
+                            self.queue[0] = (self.queue[0][0], True)
+                        else:
+                            verbose = True
+                    self.dropped += 1
+            self.queue.append((bank, verbose))
+            self.queued += 1
+            self.high_water = max(self.high_water, len(self.queue))
+            self.condition.notify()
+
+    def stats(self):
+        with self.condition:
+            return {"depth": len(self.queue), "high_water": self.high_water, "queued": self.queued,
+                    "published": self.published, "dropped": self.dropped, "coalesced": self.coalesced}
+
+    def publish(self, bank, verbose):
+        if self.tracer is not None:
+            started = time.monotonic()
+        for sink in self.sinks:
+            sink.publish(bank, verbose)
+        self.published += 1
+        if self.tracer is not None:
+            self.tracer.record("publish", time.monotonic() - started)
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.queue:
+                    self.condition.wait()
+                bank, verbose = self.queue.popleft()
+            try:
+                self.publish(bank, verbose)
+            except Exception as e:
+                print("Error publishing snapshot: " + str(e))
+
+
+def publish_queue(sinks, config):
+
+    # Started PublishQueue from the publish_queue_size and publish_queue_policy options
+    return PublishQueue(sinks, config.get('publish_queue_size', 8), config.get('publish_queue_policy', "drop_oldest")).start()
+
+
+def mqtt_sink(client, config):
+
+    # Sink for the publish_mode option: "topics" (default) or "json"
+    if config.get('publish_mode', "topics") == "json":
+        return JsonSink(client, config['mqtt_base_topic'], change_filter(config))
+    return MqttSink(client, config['mqtt_base_topic'], change_filter(config))
@@ -0,0 +1,146 @@
+import time
+from array import array
+
+import decoders
+
+# Immutable per cycle records of what was read from the BMS. The decoders in
+# decoders.py are reused for every response, so their values are copied out into
+# snapshots, which can then be handed to sinks (MQTT, storage, aggregation) on
+# any thread while the next poll decodes into the same buffers.
+
+
+class Snapshot:
+
+    __slots__ = ()
+
+    def __init__(self, **values):
+        for name in self.__slots__:
+            object.__setattr__(self, name, values.get(name))
+
+    def __setattr__(self, name, value):
+        raise AttributeError(type(self).__name__ + " is read only")
+
+    def __delattr__(self, name):
+        raise AttributeError(type(self).__name__ + " is read only")
+
+    def __repr__(self):
+        return type(self).__name__ + "(" + ", ".join(name + "=" + repr(getattr(self, name)) for name in self.__slots__) + ")"
+
+
+class PackSnapshot(Snapshot):
+
+    # 0x42 analog data of one pack. Cell voltages in mV, temperatures in degrees C,
+    # i_design_cap is None when the BMS does not report it
+    __slots__ = ("pack", "v_cells", "t_cells", "i_pack", "v_pack", "i_remain_cap", "i_full_cap",
+                 "i_design_cap", "cycles", "soc", "soh")
+
+    @property
+    def cells(self):
+        return len(self.v_cells)
+
+    @property
+    def temps(self):
+        return len(self.t_cells)
+
+    @property
+    def cell_max_diff_volt(self):
+        return max(self.v_cells) - min(self.v_cells) if self.v_cells else 0
+
+
+class PackStatus(Snapshot):
+
+    # 0x44 warning info of one pack, the state bytes as ints (see constants.py)
+    __slots__ = ("pack", "cell_states", "temp_states", "protect_state1", "protect_state2",
+                 "instruction_state", "control_state", "fault_state", "balance_state1",
+                 "balance_state2", "warn_state1", "warn_state2", "warnings")
+
+
+class CapacitySnapshot(Snapshot):
+
+    # 0xA6 capacity of the whole bank
+    __slots__ = ("pack_remain_cap", "pack_full_cap", "pack_design_cap", "pack_soc", "pack_soh")
+
+
+class BankSnapshot(Snapshot):
+
+    # Everything read in one poll cycle. packs / status are tuples (empty when the
+    # request failed), capacity is None when it was not read, timestamp is epoch seconds
+    __slots__ = ("timestamp", "packs", "status", "capacity")
+
+    def __init__(self, packs=(), status=(), capacity=None, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        Snapshot.__init__(self, timestamp=timestamp, packs=tuple(packs), status=tuple(status), capacity=capacity)
+
+
+def packs_from(analog, first_pack=1):
+
+    # PackSnapshots for every pack in the last decoded 0x42 response
+    packs = []
+
+    for i in range(analog.packs):
+
+        i_remain_cap = analog.value("i_remain_cap", i)
+        i_full_cap = analog.value("i_full_cap", i)
+        i_design_cap = analog.value("i_design_cap", i) if analog.has("i_design_cap") else None
+
+        if analog.has("soc"):
+            soc = analog.value("soc", i)
+            soh = analog.value("soh", i)
+        else:
+            soc = round(i_remain_cap/i_full_cap*100,2)
+            soh = round(i_full_cap/i_design_cap*100,2)
+
+        packs.append(PackSnapshot(
+            pack=first_pack + i,
+            v_cells=array('H', analog.items("v_cells", "cells", i)),
+            t_cells=array('f', analog.item_values("t_cells", "temps", i)),
+            i_pack=analog.value("i_pack", i),
+            v_pack=analog.value("v_pack", i),
+            i_remain_cap=i_remain_cap,
+            i_full_cap=i_full_cap,
+            i_design_cap=i_design_cap,
+            cycles=analog.value("cycles", i),
+            soc=soc,
+            soh=soh))
+
+    return tuple(packs)
+
+
+def status_from(warn, first_pack=1):
+
+    # PackStatus for every pack in the last decoded 0x44 response
+    status = []
+
+    for i in range(warn.packs):
+        status.append(PackStatus(
+            pack=first_pack + i,
+            cell_states=array('B', warn.items("cell_states", "cells", i)),
+            temp_states=array('B', warn.items("temp_states", "temps", i)),
+            protect_state1=warn.protect_state1[i],
+            protect_state2=warn.protect_state2[i],
+            instruction_state=warn.instruction_state[i],
+            control_state=warn.control_state[i],
+            fault_state=warn.fault_state[i],
+            balance_state1=warn.balance_state1[i],
+            balance_state2=warn.balance_state2[i],
+            warn_state1=warn.warn_state1[i],
+            warn_state2=warn.warn_state2[i],
+            warnings=decoders.describe_warnings(warn, i)))
+
+    return tuple(status)
+
+
+def capacity_from(capacity):
+
+    # CapacitySnapshot from the last decoded 0xA6 response
+    pack_remain_cap = capacity.value("pack_remain_cap", 0)
+    pack_full_cap = capacity.value("pack_full_cap", 0)
+    pack_design_cap = capacity.value("pack_design_cap", 0)
+
+    return CapacitySnapshot(
+        pack_remain_cap=pack_remain_cap,
+        pack_full_cap=pack_full_cap,
+        pack_design_cap=pack_design_cap,
+        pack_soc=round(pack_remain_cap/pack_full_cap*100,2),
+        pack_soh=round(pack_full_cap/pack_design_cap*100,2))
@@ -0,0 +1,180 @@
+import socket
+import time
+
+SOI = 0x7e
+EOI = 0x0d
+
+
+class FrameReassembler:
+
+    # Persistent receive buffer for one BMS connection. Incoming bytes are
+    # scanned for SOI (0x7E) ... EOI (0x0D). A frame that is cut short stays in
+    # the buffer until the rest arrives, and anything received after a
+    # complete frame is carried over to the next read instead of being dropped.
+
+    def __init__(self, max_buffer=8192):
+        self.buffer = bytearray()
+        self.max_buffer = max_buffer
+        self.dropped_bytes = 0
+        self.timeouts = 0
+        self.first_data = None
+
+    def reset(self):
+        self.buffer.clear()
+
+    def feed(self, data):
+        self.buffer += data
+        if len(self.buffer) > self.max_buffer:
+            # Keep the newest data, starting from an SOI if there is one
+            cut = len(self.buffer) - self.max_buffer
+            start = self.buffer.find(SOI, cut)
+            if start < 0:
+                start = len(self.buffer)
+            self.dropped_bytes += start
+            del self.buffer[:start]
+
+    def next_frame(self):
+
+        start = self.buffer.find(SOI)
+        if start < 0:
+            self.dropped_bytes += len(self.buffer)
+            self.buffer.clear()
+            return None
+        if start > 0:
+            self.dropped_bytes += start
+            del self.buffer[:start]
+
+        end = self.buffer.find(EOI, 1)
+        if end < 0:
+            return None
+
+        # A second SOI before the EOI means the first frame was cut short, resync on the later one
+        restart = self.buffer.rfind(SOI, 1, end)
+        if restart > 0:
+            self.dropped_bytes += restart
+            del self.buffer[:restart]
+            end -= restart
+
+        frame = bytes(self.buffer[:end + 1])
+        del self.buffer[:end + 1]
+        return frame
+
+    def pending_frames(self):
+        # Complete frames already buffered, e.g. late replies to earlier requests
+        frames = []
+        frame = self.next_frame()
+        while frame is not None:
+            frames.append(frame)
+            frame = self.next_frame()
+        return frames
+
+    def read_frame(self, comms, timeout):
+
+        # Returns the next complete frame, or None if none completes before the deadline.
+        # Raises ConnectionError if the remote side closed the connection.
+
+        deadline = time.monotonic() + timeout
+        self.first_data = None
+
+        frame = self.next_frame()
+        while frame is None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                self.timeouts += 1
+                return None
+            data = read_chunk(comms, remaining, self)
+            if data:
+                self.feed(data)
+                frame = self.next_frame()
+
+        return frame
+
+
+def read_chunk(comms, timeout, reassembler=None):
+
+    # With a reassembler, the time the first chunk of a frame is read is kept in
+    # its first_data, for the tracing first_byte span
+    if hasattr(comms, 'recv'):
+        previous = comms.gettimeout()
+        comms.settimeout(timeout)
+        try:
+            data = comms.recv(4096)
+        except socket.timeout:
+            return b''
+        finally:
+            comms.settimeout(previous)
+        if len(data) == 0:
+            raise ConnectionError("BMS closed the connection")
+
+    else:
+        comms.timeout = timeout
+        data = comms.read(max(1, comms.in_waiting))
+
+    if data and reassembler is not None and reassembler.first_data is None:
+        reassembler.first_data = time.monotonic()
+    return data
+
+
+class RequestPacer:
+
+    # Paces requests on the bus. In "fixed" mode every write is followed by the
+    # legacy fixed delay. In "response" mode nothing sleeps after a write: the
+    # reader returns as soon as the response frame is complete, and the only
+    # enforced gap is the bus turnaround time before the next request. The
+    # round trip is learned per BMS address and used to bound the response wait.
+
+    def __init__(self, mode="fixed", turnaround=0.05, fixed_delay=0.25, max_timeout=2, min_timeout=0.2, rtt_factor=4, alpha=0.2):
+        self.mode = mode
+        self.turnaround = turnaround
+        self.fixed_delay = fixed_delay
+        self.max_timeout = max_timeout
+        self.min_timeout = min_timeout
+        self.rtt_factor = rtt_factor
+        self.alpha = alpha
+        self.rtt = {}
+        self.last_response = 0
+        self.pending = None
+
+    def send_delay(self):
+        # Seconds to wait before the next request may go out
+        return max(0, self.last_response + self.turnaround - time.monotonic())
+
+    def sent(self, request):
+        # ADR is ASCII bytes 3:5 of the request frame
+        self.pending = (request[3:5], time.monotonic())
+
+    def before_send(self):
+        wait = self.send_delay()
+        if wait > 0:
+            time.sleep(wait)
+
+    def after_send(self, request):
+        self.sent(request)
+        if self.mode == "fixed":
+            time.sleep(self.fixed_delay)
+
+    def response_timeout(self):
+        if self.mode == "fixed" or self.pending is None:
+            return self.max_timeout
+        rtt = self.rtt.get(self.pending[0])
+        if rtt is None:
+            return self.max_timeout
+        return min(self.max_timeout, max(self.min_timeout, rtt * self.rtt_factor))
+
+    def after_response(self, received):
+        now = time.monotonic()
+        self.last_response = now
+        if self.pending is None:
+            return None
+        adr, sent = self.pending
+        self.pending = None
+        if not received:
+            return None
+        sample = now - sent
+        rtt = self.rtt.get(adr)
+        if rtt is None:
+            rtt = sample
+        else:
+            rtt += self.alpha * (sample - rtt)
+        self.rtt[adr] = rtt
+        return sample
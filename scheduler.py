@@ -0,0 +1,253 @@
+import collections
+import math
+import time
+
+import constants
+
+# Per command polling rates. Every CID2 command has its own period and priority, so
+# bus time goes to the values that change (analog data) and not to the ones that
+# barely move (capacity, serial numbers).
+
+# cid2: (period in seconds, priority). None is the scan interval, 0 disables the
+# command. When several commands are due the lowest priority number goes first
+DEFAULT_SCHEDULE = {
+    constants.cid2PackAnalogData: (None, 0),
+    constants.cid2PackCapacity: (None, 1),
+    constants.cid2WarnInfo: (None, 2),
+    constants.cid2PackNumber: (0, 3),
+    constants.cid2SoftwareVersion: (86400, 4),
+    constants.cid2SerialNumber: (86400, 4),
+}
+
+
+class CommandScheduler:
+
+    def __init__(self, schedule, scan_interval):
+        self.periods = {}
+        self.priorities = {}
+        self.next_due = {}
+        self.scan_interval = scan_interval
+        self.scan_commands = []
+        self.burst_commands = ()
+        self.burst_until = 0
+        self.due_at = None
+        self.timing = ScanTiming()
+        for cid2, (period, priority) in schedule.items():
+            if period is None:
+                period = scan_interval
+                self.scan_commands.append(cid2)
+            if period > 0:
+                self.periods[cid2] = period
+                self.priorities[cid2] = priority
+                self.next_due[cid2] = float("-inf")
+
+    def due(self, now=None):
+
+        # Commands due now, in priority order
+        if now is None:
+            now = time.monotonic()
+        self.due_at = now
+        burst = now < self.burst_until
+        due = [cid2 for cid2, next_due in self.next_due.items() if next_due <= now or (burst and cid2 in self.burst_commands)]
+        if self.scan_commands and self.scan_commands[0] in self.next_due:
+            # The first scan command marks the start of a scan for the timing report
+            next_due = self.next_due[self.scan_commands[0]]
+            if next_due <= now:
+                self.timing.started(now if next_due == float("-inf") else next_due, now)
+        return sorted(due, key=lambda cid2: (self.priorities[cid2], self.next_due[cid2]))
+
+    def done(self, cid2, now=None):
+
+        # The next run is one period after this one was due, so late runs don't shift
+        # the schedule. A command that fell more than a period behind skips the runs
+        # it missed and stays on its grid. Burst runs ahead of the grid don't move it.
+        # Times are taken at the due() call that returned the command, not when it
+        # finished, so the commands of one scan stay on one grid and are due together
+        if cid2 not in self.next_due:
+            return
+        if now is None:
+            now = self.due_at if self.due_at is not None else time.monotonic()
+        period = self.periods[cid2]
+        if self.next_due[cid2] == float("-inf"):
+            # The first run starts the grid
+            self.next_due[cid2] = now + period
+            return
+        if self.next_due[cid2] > now:
+            return
+        next_due = self.next_due[cid2] + period
+        if next_due <= now:
+            missed = int((now - next_due) // period) + 1
+            next_due += missed * period
+            if self.scan_commands and cid2 == self.scan_commands[0]:
+                self.timing.overruns += missed
+        self.next_due[cid2] = next_due
+
+    def burst(self, commands, until):
+
+        # commands are due on every call until the monotonic time until, i.e. they
+        # run back to back at whatever rate the bus allows
+        self.burst_commands = commands
+        self.burst_until = until
+
+    def set_scan_interval(self, scan_interval):
+
+        # New period for the commands that follow the scan interval, counted from
+        # their last run
+        for cid2 in self.scan_commands:
+            if cid2 in self.next_due:
+                self.next_due[cid2] += scan_interval - self.periods[cid2]
+                self.periods[cid2] = scan_interval
+        self.scan_interval = scan_interval
+
+    def wait(self, now=None):
+
+        # Seconds until the next command is due
+        if not self.next_due:
+            return 1
+        if now is None:
+            now = time.monotonic()
+        if now < self.burst_until:
+            return 0
+        return max(0, min(self.next_due.values()) - now)
+
+
+class ScanTiming:
+
+    # Actual start times of a fixed rate loop over the last window cycles: period,
+    # jitter (standard deviation of the period), lateness against the deadline, and
+    # overruns, the cycles skipped because the one before ran past their deadline
+
+    def __init__(self, window=100):
+        self.starts = collections.deque(maxlen=window + 1)
+        self.lateness = collections.deque(maxlen=window)
+        self.overruns = 0
+
+    def started(self, deadline, now):
+        self.starts.append(now)
+        self.lateness.append(max(0, now - deadline))
+
+    def report(self, target):
+
+        # Dict for the scan_timing topic, None until two cycles ran
+        starts = list(self.starts)
+        periods = [b - a for a, b in zip(starts, starts[1:])]
+        if not periods:
+            return None
+        period = sum(periods) / len(periods)
+        jitter = math.sqrt(sum((p - period) ** 2 for p in periods) / len(periods))
+        return {"target": target, "period": round(period, 3), "period_min": round(min(periods), 3),
+                "period_max": round(max(periods), 3), "jitter": round(jitter, 3),
+                "late_max": round(max(self.lateness), 3), "overruns": self.overruns, "cycles": len(periods)}
+
+
+class FixedRate:
+
+    # Cycles on absolute deadlines period seconds apart on the monotonic clock. A
+    # cycle that starts late is shortened to get back on the grid, deadlines a
+    # cycle overran are skipped instead of run late
+
+    def __init__(self, period):
+        self.period = period
+        self.deadline = None
+        self.timing = ScanTiming()
+
+    def start(self, now=None):
+        # Call at the start of every cycle
+        if now is None:
+            now = time.monotonic()
+        if self.deadline is None:
+            self.deadline = now
+        self.timing.started(self.deadline, now)
+
+    def wait(self, now=None):
+
+        # Seconds until the next deadline, call at the end of every cycle
+        if now is None:
+            now = time.monotonic()
+        if self.deadline is None:
+            self.deadline = now
+        self.deadline += self.period
+        if self.deadline <= now:
+            missed = int((now - self.deadline) // self.period) + 1
+            self.deadline += missed * self.period
+            self.timing.overruns += missed
+        return self.deadline - now
+
+
+class AdaptiveInterval:
+
+    # Scan interval from battery activity. At busy_current amps or busy_dvdt mV per
+    # minute of cell voltage change the interval is min_interval, with no current
+    # and steady cells max_interval, in between it scales linearly. It shortens at
+    # once when activity rises and lengthens by at most half per scan when it drops.
+    #
+    # Cell voltages are compared with a reference sample, not the previous scan, and
+    # the change is spread over at least window seconds. Changes within noise mV are
+    # ignored, so the 1-2 mV quantisation steps of idle cells read at a short
+    # interval don't keep the interval at its minimum
+
+    def __init__(self, min_interval, max_interval, busy_current=10, busy_dvdt=5, window=60, noise=2):
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, max_interval)
+        self.busy_current = busy_current
+        self.busy_dvdt = busy_dvdt
+        self.window = window
+        self.noise = noise
+        self.interval = self.max_interval
+        self.reference = {}
+
+    def activity(self, packs, now):
+
+        activity = 0
+        for pack in packs:
+            if self.busy_current > 0 and pack.i_pack is not None:
+                activity = max(activity, abs(pack.i_pack) / self.busy_current)
+            reference = self.reference.get(pack.pack)
+            if reference is None or len(reference[1]) != len(pack.v_cells):
+                self.reference[pack.pack] = (now, pack.v_cells)
+                continue
+            age = now - reference[0]
+            if self.busy_dvdt > 0 and pack.v_cells:
+                dv = max(abs(v - r) for v, r in zip(pack.v_cells, reference[1]))
+                if dv > self.noise:
+                    activity = max(activity, dv * 60 / max(age, self.window) / self.busy_dvdt)
+            if age >= self.window:
+                self.reference[pack.pack] = (now, pack.v_cells)
+        return min(1, activity)
+
+    def update(self, packs, now=None):
+
+        # Interval after an analog read, packs are its PackSnapshots
+        if now is None:
+            now = time.monotonic()
+        target = self.max_interval - (self.max_interval - self.min_interval) * self.activity(packs, now)
+        self.interval = round(min(target, self.interval * 1.5), 1)
+        return self.interval
+
+
+def adaptive_interval(config):
+
+    # AdaptiveInterval from the adaptive_scan options, None for a fixed scan interval
+    if not config.get('adaptive_scan', False):
+        return None
+    return AdaptiveInterval(config.get('scan_interval_min', 1), config.get('scan_interval_max', 30),
+                            config.get('adaptive_current', 10), config.get('adaptive_dvdt', 5))
+
+
+def command_schedule(config):
+
+    # DEFAULT_SCHEDULE with the command_schedule option applied, e.g.
+    # [{"command": "A6", "period": 60}, {"command": "C2", "period": 86400, "priority": 5}]
+    schedule = dict(DEFAULT_SCHEDULE)
+    for entry in config.get('command_schedule') or []:
+        cid2 = bytes(str(entry['command']).upper().replace("0X", "").zfill(2), 'ASCII')
+        if cid2 not in schedule:
+            print("Unknown command in command_schedule: " + str(entry['command']))
+            continue
+        period, priority = schedule[cid2]
+        schedule[cid2] = (entry.get('period', period), entry.get('priority', priority))
+    return schedule
+
+
+def command_scheduler(config):
+    return CommandScheduler(command_schedule(config), config['scan_interval'])
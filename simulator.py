@@ -0,0 +1,362 @@
+import argparse
+import binascii
+import math
+import os
+import random
+import socketserver
+import struct
+import threading
+import time
+import tty
+
+import codec
+import constants
+import decoders
+import layouts
+import transport
+
+# Simulated BMS for testing and benchmarking without hardware. It answers Pace
+# framed requests (SOI VER ADR CID1 CID2 LENGTH INFO CHKSUM EOI) over a TCP
+# listener or a Linux pseudo terminal, with responses encoded from the same
+# layouts.py tables the decoders are compiled from. Packs follow scripted current
+# and cell voltage waveforms, the remaining capacity follows the current.
+#
+# Run from the repository root, e.g.
+#   python3 simulator.py --port 5000 --packs 16 --cells 16
+#   python3 simulator.py --pty --link /tmp/ttyBMS --dialect "Volta SG1" --packs 4
+#   python3 simulator.py --port 5000 --current sine:40:120 --latency 0.08 --jitter 0.02
+
+MAX_LENID = 4095
+
+
+class Waveform:
+
+    # Value over time from a spec string:
+    #   "12.5"                           constant
+    #   "sine:amplitude:period[:offset]" sine wave
+    #   "square:amplitude:period[:offset]"
+    #   "steps:0=0,60=-30,120=20"        step to each value at its time, repeats
+    #                                    after the last step
+
+    def __init__(self, spec):
+        self.spec = str(spec)
+        parts = self.spec.split(":")
+        self.kind = parts[0]
+        if self.kind in ("sine", "square"):
+            self.amplitude = float(parts[1])
+            self.period = float(parts[2])
+            self.offset = float(parts[3]) if len(parts) > 3 else 0
+        elif self.kind == "steps":
+            self.steps = sorted((float(t), float(v)) for t, v in (step.split("=") for step in parts[1].split(",")))
+            self.period = self.steps[-1][0] + (self.steps[-1][0] - self.steps[-2][0] if len(self.steps) > 1 else 1)
+        else:
+            self.kind = "constant"
+            self.offset = float(parts[0])
+
+    def value(self, t):
+        if self.kind == "sine":
+            return self.offset + self.amplitude * math.sin(2 * math.pi * t / self.period)
+        if self.kind == "square":
+            return self.offset + (self.amplitude if (t % self.period) < self.period / 2 else -self.amplitude)
+        if self.kind == "steps":
+            t = t % self.period
+            value = self.steps[0][1]
+            for start, step in self.steps:
+                if t >= start:
+                    value = step
+            return value
+        return self.offset
+
+
+def raw_value(layout, name, value):
+    # Inverse of Decoder.convert: (raw + offset) * factor / divisor = value
+    unit = layout.get("units", {}).get(name)
+    if unit is not None:
+        offset, factor, divisor = unit
+        value = value * divisor / factor - offset
+    return int(round(value))
+
+
+def encode(layout, header, packs):
+
+    # Hex INFO for a response layout, the inverse of decoders.Decoder. header is a
+    # dict of the header fields, packs a list of dicts of the pack fields, both in
+    # the decoded units. Counts come from the length of the list they count
+    out = bytearray()
+
+    for field in layout["header"]:
+        name, kind = field[0], field[1]
+        if kind == "skip":
+            out += bytes(field[2])
+        elif kind == "ascii":
+            text = header.get(name, "").encode("ascii")
+            if field[2] is not None:
+                text = text.ljust(field[2])[:field[2]]
+            out += text
+        elif name == "packs":
+            out.append(len(packs))
+        else:
+            out += struct.pack(">" + decoders.KINDS[kind][0], raw_value(layout, name, header.get(name, 0)))
+
+    counted = dict((field[2], field[0]) for field in layout["pack"] if field[1] in ("words", "states"))
+    for pack in packs:
+        for field in layout["pack"]:
+            name, kind = field[0], field[1]
+            if kind == "skip":
+                out += bytes(field[2])
+            elif kind == "count":
+                out.append(len(pack.get(counted[name], ())))
+            elif kind == "words":
+                out += struct.pack(">%dH" % len(pack[name]), *(raw_value(layout, name, v) for v in pack[name]))
+            elif kind == "states":
+                out += bytes(pack[name])
+            else:
+                code = decoders.KINDS[kind][0]
+                value = raw_value(layout, name, pack.get(name, 0))
+                if code == "h":
+                    value = min(0x7FFF, max(-0x8000, value))
+                elif code == "H":
+                    value = min(0xFFFF, max(0, value))
+                else:
+                    value = min(0xFF, max(0, value))
+                out += struct.pack(">" + code, value)
+
+    return binascii.hexlify(out).upper()
+
+
+def response_frame(ver, adr, rtn, info=b''):
+    if len(info) > MAX_LENID:
+        raise ValueError("INFO too long for LENID: " + str(len(info)))
+    frame = codec.SOI + ver + adr + b'46' + rtn + codec.LENGTH_FIELDS[len(info)] + info
+    return frame + codec.chksum(frame) + codec.EOI
+
+
+class SimulatedPack:
+
+    def __init__(self, number, cells=16, temps=6, design_cap=100000, soc=80, cycles=0):
+        self.number = number
+        self.cells = cells
+        self.temps = temps
+        self.design_cap = design_cap
+        self.full_cap = design_cap * (0.99 - 0.002 * number)
+        self.remain_cap = self.full_cap * soc / 100
+        self.cycles = cycles + 10 * number
+        # Fixed per cell spread so packs and cells are told apart in the output
+        self.spread = [((number * 7 + cell * 13) % 21) - 10 for cell in range(cells)]
+
+    def update(self, current, dt):
+        # current in A, positive when charging
+        self.remain_cap = min(self.full_cap, max(0, self.remain_cap + current * dt * 1000 / 3600))
+
+    def values(self, current, voltage):
+
+        # Decoded field values, voltage is the cell voltage waveform in mV
+        soc = 100 * self.remain_cap / self.full_cap
+        base = 3200 + 2 * soc + voltage + 0.5 * current
+        v_cells = [max(0, base + spread) for spread in self.spread]
+        t_cells = [25 + abs(current) * 0.05 + 0.3 * sensor for sensor in range(self.temps)]
+        cell_states = [2 if v > 3550 else 1 if v < 2900 else 0 for v in v_cells]
+        return {
+            "v_cells": v_cells,
+            "t_cells": t_cells,
+            "i_pack": current,
+            "v_pack": sum(v_cells) / 1000,
+            "i_remain_cap": self.remain_cap,
+            "i_full_cap": self.full_cap,
+            "i_design_cap": self.design_cap,
+            "cycles": self.cycles,
+            "soc": round(soc),
+            "soh": round(100 * self.full_cap / self.design_cap),
+            "cell_states": cell_states,
+            "temp_states": [0] * self.temps,
+            "protect_state1": (1 if max(v_cells) > 3650 else 0) | (2 if min(v_cells) < 2800 else 0),
+            "balance_state1": sum(1 << cell for cell, v in enumerate(v_cells[:8]) if v - min(v_cells) > 15),
+        }
+
+
+class Simulator:
+
+    # The simulated bank. respond() takes a request frame and returns the response
+    # frame, or None where a real BMS stays silent (Volta SG1 address without a pack)
+
+    def __init__(self, packs=1, cells=16, temps=6, dialect="Pace", current="0", voltage="0",
+                 latency=0.05, jitter=0, baud=0, seed=None):
+        self.dialect = layouts.DIALECTS[dialect]
+        self.packs = [SimulatedPack(p + 1, cells, temps) for p in range(packs)]
+        self.current = Waveform(current)
+        self.voltage = Waveform(voltage)
+        self.latency = latency
+        self.jitter = jitter
+        self.baud = baud
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.updated = self.started
+        self.requests = 0
+        self.errors = 0
+
+    def pack_values(self, packs):
+        now = time.monotonic()
+        t = now - self.started
+        current = self.current.value(t)
+        voltage = self.voltage.value(t)
+        for pack in self.packs:
+            pack.update(current, now - self.updated)
+        self.updated = now
+        return [pack.values(current, voltage) for pack in packs]
+
+    def select(self, adr, info):
+
+        # Packs a request is for. Per address dialects answer for the pack at ADR,
+        # Pace answers for all packs on FF / no INFO, else for the pack in INFO
+        try:
+            if self.dialect["per_address"]:
+                number = int(adr, 16)
+            elif info and info != b'FF':
+                number = int(info, 16)
+            else:
+                return self.packs
+        except ValueError:
+            return []
+        return [pack for pack in self.packs if pack.number == number]
+
+    def info(self, cid2, adr, info):
+
+        # (RTN, INFO) for a request, None for no answer
+        layout = self.dialect.get(cid2)
+        if cid2 == constants.cid2PackNumber:
+            return b'00', b'%02X' % len(self.packs)
+        if cid2 == constants.cid2SoftwareVersion:
+            return b'00', encode(layout, {"bms_version": "SIM_BMS_V1.0"}, [])
+        if cid2 == constants.cid2SerialNumber:
+            return b'00', encode(layout, {"bms_sn": "SIM%012d" % int(adr, 16), "pack_sn": "SIMPACK%07d" % int(adr, 16)}, [])
+        if cid2 == constants.cid2PackCapacity:
+            # Real BMSs answer 0xA6 with the first pack, whatever ADR and INFO say
+            pack = self.pack_values(self.packs[:1])[0]
+            return b'00', encode(layout, {}, [{"pack_remain_cap": pack["i_remain_cap"],
+                                               "pack_full_cap": pack["i_full_cap"],
+                                               "pack_design_cap": pack["i_design_cap"]}])
+        if cid2 in (constants.cid2PackAnalogData, constants.cid2WarnInfo):
+            packs = self.select(adr, info)
+            if not packs:
+                return None
+            return b'00', encode(layout, {}, self.pack_values(packs))
+        return b'04', b''
+
+    def respond(self, request):
+
+        success, info = codec.parse_response(request)
+        with self.lock:
+            self.requests += 1
+            if not success:
+                self.errors += 1
+                rtn = b'03' if info.startswith("LCHKSUM") else b'02'
+                return response_frame(request[1:3], request[3:5], rtn)
+            result = self.info(request[7:9], request[3:5], info)
+        if result is None:
+            return None
+        return response_frame(request[1:3], request[3:5], result[0], result[1])
+
+    def delay(self, response):
+        # Response latency plus the time the response takes on the wire at baud
+        delay = self.latency + self.random.uniform(0, self.jitter)
+        if self.baud:
+            delay += len(response) * 10 / self.baud
+        return delay
+
+    def serve(self, read, write):
+
+        # Answers every complete request frame read from a link until it closes
+        reassembler = transport.FrameReassembler()
+        while True:
+            data = read()
+            if not data:
+                return
+            reassembler.feed(data)
+            for request in reassembler.pending_frames():
+                response = self.respond(request)
+                if response is not None:
+                    time.sleep(self.delay(response))
+                    write(response)
+
+
+class SimulatorHandler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        try:
+            self.server.simulator.serve(lambda: self.request.recv(4096), self.request.sendall)
+        except OSError:
+            return
+
+
+def serve_tcp(simulator, port=5000, host=""):
+
+    # Started TCP listener, every client gets its own thread on the shared bank
+    server = socketserver.ThreadingTCPServer((host, port), SimulatorHandler, bind_and_activate=False)
+    server.allow_reuse_address = True
+    server.daemon_threads = True
+    server.simulator = simulator
+    server.server_bind()
+    server.server_activate()
+    threading.Thread(target=server.serve_forever, name="simulator", daemon=True).start()
+    return server
+
+
+def serve_pty(simulator, link=None):
+
+    # Pseudo terminal for serial connections, returns the device path. The slave
+    # side stays open here so the link survives clients closing and reopening it
+    master, slave = os.openpty()
+    tty.setraw(slave)
+    path = os.ttyname(slave)
+    if link:
+        if os.path.lexists(link):
+            os.remove(link)
+        os.symlink(path, link)
+        path = link
+
+    def write(data):
+        while data:
+            data = data[os.write(master, data):]
+
+    threading.Thread(target=simulator.serve, args=(lambda: os.read(master, 4096), write), name="simulator-pty", daemon=True).start()
+    return path
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Simulated Pace / Volta SG1 BMS")
+    parser.add_argument("--port", type=int, default=5000, help="TCP port, 0 for none (default 5000)")
+    parser.add_argument("--pty", action="store_true", help="also serve a pseudo terminal for bms_serial")
+    parser.add_argument("--link", help="symlink to the pseudo terminal, e.g. /tmp/ttyBMS")
+    parser.add_argument("--dialect", default="Pace", choices=sorted(layouts.DIALECTS))
+    parser.add_argument("--packs", type=int, default=1)
+    parser.add_argument("--cells", type=int, default=16)
+    parser.add_argument("--temps", type=int, default=6)
+    parser.add_argument("--current", default="0", help="pack current waveform in A, see Waveform")
+    parser.add_argument("--voltage", default="0", help="cell voltage waveform in mV added to the SOC based voltage")
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds before every response")
+    parser.add_argument("--jitter", type=float, default=0, help="random extra latency up to this many seconds")
+    parser.add_argument("--baud", type=int, default=0, help="add the wire time of the response at this baud rate")
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+
+    simulator = Simulator(args.packs, args.cells, args.temps, args.dialect, args.current, args.voltage,
+                          args.latency, args.jitter, args.baud, args.seed)
+    print("Simulating %d %s pack(s) of %d cells" % (args.packs, args.dialect, args.cells))
+    if args.port:
+        serve_tcp(simulator, args.port)
+        print("Listening on TCP port " + str(args.port))
+    if args.pty:
+        print("Serial device: " + serve_pty(simulator, args.link))
+
+    try:
+        while True:
+            time.sleep(60)
+            print("Requests: %d, errors: %d" % (simulator.requests, simulator.errors))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+import codec
+import constants
+import snapshot
+
+# Passive bus sniffing (bus_mode: "passive"). Another master, usually the inverter,
+# already polls the BMS; this only reads along and never sends. Every frame on the
+# bus is reassembled, requests are paired with the response that follows from the
+# same address, and the responses go through the same decoders as our own polls.
+
+# Responses carry RTN (00-09) where requests carry CID2 (0x42 and up)
+def is_response(frame):
+    return frame[7:8] == b"0"
+
+
+class BusSniffer:
+
+    def __init__(self, dialect, debug_output=0):
+        self.debug_output = debug_output
+        self.decoders = {
+            constants.cid2PackAnalogData: dialect[constants.cid2PackAnalogData],
+            constants.cid2WarnInfo: dialect[constants.cid2WarnInfo],
+            constants.cid2PackCapacity: dialect[constants.cid2PackCapacity],
+            constants.cid2SoftwareVersion: dialect[constants.cid2SoftwareVersion],
+            constants.cid2SerialNumber: dialect[constants.cid2SerialNumber],
+        }
+        self.request = None
+        self.packs = {}
+        self.status = {}
+        self.capacity = None
+        self.requests = 0
+        self.responses = 0
+        self.unpaired = 0
+        self.errors = 0
+
+    def first_pack(self, info):
+        # Per pack polls carry the pack address as INFO, FF or nothing means all packs
+        try:
+            return max(1, int(info, 16)) if info and info != b"FF" else 1
+        except ValueError:
+            return 1
+
+    def feed(self, frame):
+
+        # Takes every frame seen on the bus. Returns the CID2 of a request whose
+        # response was decoded, None for anything else
+        success, info = codec.parse_response(frame)
+        if not success:
+            self.errors += 1
+            if self.debug_output > 0:
+                print("Sniffed frame not valid (" + info + "): " + str(frame))
+            return None
+
+        if not is_response(frame):
+            if self.request is not None:
+                self.unpaired += 1
+            self.request = (frame[3:5], frame[7:9], info)
+            self.requests += 1
+            return None
+
+        if self.request is None or self.request[0] != frame[3:5]:
+            self.unpaired += 1
+            return None
+
+        cid2, request_info = self.request[1], self.request[2]
+        self.request = None
+        self.responses += 1
+
+        decoder = self.decoders.get(cid2)
+        if decoder is None:
+            return None
+
+        try:
+            decoder.decode(info)
+            if cid2 == constants.cid2PackAnalogData:
+                for pack in snapshot.packs_from(decoder, self.first_pack(request_info)):
+                    self.packs[pack.pack] = pack
+            elif cid2 == constants.cid2WarnInfo:
+                for status in snapshot.status_from(decoder, self.first_pack(request_info)):
+                    self.status[status.pack] = status
+            elif cid2 == constants.cid2PackCapacity:
+                self.capacity = snapshot.capacity_from(decoder)
+        except Exception as e:
+            self.errors += 1
+            if self.debug_output > 0:
+                print("Error decoding sniffed " + cid2.decode("ASCII") + " response: " + str(e))
+            return None
+
+        return cid2
+
+    def bank(self):
+        # Latest values of every pack seen so far
+        return snapshot.BankSnapshot([self.packs[p] for p in sorted(self.packs)],
+                                     [self.status[p] for p in sorted(self.status)], self.capacity)
+
+    def stats(self):
+        return {"requests": self.requests, "responses": self.responses, "unpaired": self.unpaired, "errors": self.errors}
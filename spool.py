@@ -0,0 +1,189 @@
+import json
+import os
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+
+import publisher
+
+# Store and forward. While MQTT is down the scans keep being read and are appended
+# to a spool on disk, one JSON line per scan in append only segment files. After
+# a reconnect they are replayed oldest first, at a limited rate, to a backfill
+# topic. The spool is bounded, when it grows over max_size the oldest segment is
+# deleted.
+
+
+def record(bank):
+
+    # Spool line for a BankSnapshot, the JSON publish mode documents plus the time
+    # the scan was read
+    document = {"timestamp": round(bank.timestamp, 3)}
+    document["packs"] = dict(("pack_" + str(p), pack) for p, pack in publisher.pack_documents(bank).items())
+    bank_document = publisher.bank_document(bank)
+    if bank_document is not None:
+        document["bank"] = bank_document
+    return json.dumps(document, separators=(',', ':'))
+
+
+class Spool:
+
+    def __init__(self, path, max_size=50*1024*1024, segments=8):
+        self.path = path
+        self.max_size = max_size
+        self.segment_size = max(1, max_size // segments)
+        self.lock = threading.Lock()
+        self.spooled = 0
+        self.dropped = 0
+        os.makedirs(path, exist_ok=True)
+        self.position = self.load_position()
+
+    def segment_path(self, n):
+        return os.path.join(self.path, "spool-%08d.jsonl" % n)
+
+    def segments(self):
+        return sorted(int(name[6:14]) for name in os.listdir(self.path) if name.startswith("spool-") and name.endswith(".jsonl"))
+
+    def load_position(self):
+
+        # (segment, byte offset) of the next line to replay, kept across restarts
+        try:
+            with open(os.path.join(self.path, "position")) as file:
+                segment, offset = file.read().split()
+                return int(segment), int(offset)
+        except (OSError, ValueError):
+            return 0, 0
+
+    def save_position(self):
+        with open(os.path.join(self.path, "position"), "w") as file:
+            file.write("%d %d" % self.position)
+
+    def pending(self):
+        with self.lock:
+            return len(self.segments()) > 0
+
+    def append(self, bank):
+
+        line = record(bank) + "\n"
+        with self.lock:
+            try:
+                segments = self.segments()
+                n = segments[-1] if segments else self.position[0] + 1
+                if segments and os.path.getsize(self.segment_path(n)) >= self.segment_size:
+                    n += 1
+                with open(self.segment_path(n), "a") as file:
+                    file.write(line)
+                self.spooled += 1
+                self.trim()
+            except OSError as e:
+                print("Error writing spool: %s" % e)
+
+    def trim(self):
+
+        # Over max_size the oldest scans go, the latest are what matters
+        segments = self.segments()
+        sizes = dict((n, os.path.getsize(self.segment_path(n))) for n in segments)
+        total = sum(sizes.values())
+        while total > self.max_size and len(segments) > 1:
+            n = segments.pop(0)
+            total -= sizes[n]
+            os.remove(self.segment_path(n))
+            self.dropped += 1
+            if self.position != (0, 0) and self.position[0] <= n:
+                # The replay resumes at the start of the oldest segment left
+                self.position = (0, 0)
+                self.save_position()
+
+    def read(self, count):
+
+        # Up to count (line, position after the line) pairs from the oldest segment
+        with self.lock:
+            segments = self.segments()
+            if not segments:
+                return []
+            n = segments[0]
+            offset = self.position[1] if self.position[0] == n else 0
+            lines = []
+            with open(self.segment_path(n), "rb") as file:
+                file.seek(offset)
+                while len(lines) < count:
+                    line = file.readline()
+                    if not line.endswith(b"\n"):
+                        break
+                    offset += len(line)
+                    lines.append((line[:-1], (n, offset)))
+            return lines
+
+    def advance(self, position):
+
+        # Marks everything up to position as sent. Segments sent completely are
+        # deleted, appends go to a new segment after that
+        with self.lock:
+            n, offset = position
+            if offset >= os.path.getsize(self.segment_path(n)):
+                os.remove(self.segment_path(n))
+            self.position = position
+            self.save_position()
+
+
+class Forwarder:
+
+    # Replays the spool to topic at rate messages per second while connected()
+
+    def __init__(self, spool, client, topic, rate=10, connected=None):
+        self.spool = spool
+        self.client = client
+        self.topic = topic
+        self.rate = rate
+        self.connected = connected or (lambda: True)
+        self.replayed = 0
+        self.thread = threading.Thread(target=self.run, name="forwarder", daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def run(self):
+        while True:
+            try:
+                if not self.connected() or not self.forward():
+                    time.sleep(1)
+            except OSError as e:
+                print("Error replaying spool: %s" % e)
+                time.sleep(5)
+
+    def forward(self):
+
+        # Sends one second worth of spooled scans, False when there was nothing to send
+        lines = self.spool.read(max(1, int(self.rate)))
+        if not lines:
+            return False
+
+        start = time.monotonic()
+        sent = None
+        for i, (line, position) in enumerate(lines):
+            info = self.client.publish(self.topic, line, qos=1)
+            if info.rc != mqtt.MQTT_ERR_SUCCESS:
+                # Disconnected again, only what was not sent stays in the spool
+                break
+            sent = position
+            self.replayed += 1
+            time.sleep(max(0, start + (i+1)/self.rate - time.monotonic()))
+
+        if sent is not None:
+            self.spool.advance(sent)
+        return sent == lines[-1][1]
+
+
+def store_and_forward(client, config, connected):
+
+    # Spool for the store_and_forward options with its forwarder running, None
+    # when scans are not kept while MQTT is down
+    if not config.get('store_and_forward', False):
+        return None
+
+    path = os.path.join(config.get('spool_path', "/data/spool"), config['mqtt_base_topic'].replace("/", "_"))
+    spool = Spool(path, int(config.get('spool_max_size', 50)*1024*1024))
+    topic = config.get('backfill_topic') or config['mqtt_base_topic'] + "/backfill"
+    Forwarder(spool, client, topic, config.get('backfill_rate', 10), connected).start()
+    return spool
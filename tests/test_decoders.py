@@ -0,0 +1,97 @@
+import binascii
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import constants
+import decoders
+import layouts
+import simulator
+import snapshot
+
+
+def pack_values(packs, current=-12.5):
+    return [simulator.SimulatedPack(p + 1, cells=16, temps=6).values(current, 0) for p in range(packs)]
+
+
+@pytest.mark.parametrize("dialect", sorted(layouts.DIALECTS))
+def test_analog_data(dialect):
+    layout = layouts.DIALECTS[dialect]
+    packs = 1 if layout["per_address"] else 3
+    values = pack_values(packs)
+    analog = decoders.compile_dialect(layout)[constants.cid2PackAnalogData]
+    assert analog.decode(simulator.encode(layout[constants.cid2PackAnalogData], {}, values)) == packs
+
+    for pack, expected in zip(snapshot.packs_from(analog), values):
+        assert list(pack.v_cells) == [round(v) for v in expected["v_cells"]]
+        assert len(pack.t_cells) == 6
+        assert pack.t_cells[0] == pytest.approx(expected["t_cells"][0], abs=1)
+        assert pack.i_pack == expected["i_pack"]
+        assert pack.v_pack == pytest.approx(expected["v_pack"], abs=0.01)
+        assert pack.i_remain_cap == pytest.approx(expected["i_remain_cap"], abs=10)
+        assert pack.cycles == expected["cycles"]
+
+
+@pytest.mark.parametrize("dialect", sorted(layouts.DIALECTS))
+def test_warn_info(dialect):
+    layout = layouts.DIALECTS[dialect]
+    values = pack_values(2)
+    values[1]["protect_state1"] = 0x21
+    values[1]["instruction_state"] = 0x06
+    warn = decoders.compile_dialect(layout)[constants.cid2WarnInfo]
+    assert warn.decode(simulator.encode(layout[constants.cid2WarnInfo], {}, values)) == 2
+
+    status = snapshot.status_from(warn)
+    assert [s.pack for s in status] == [1, 2]
+    assert list(status[0].cell_states) == values[0]["cell_states"]
+    assert status[1].protect_state1 == 0x21
+    assert status[1].instruction_state == 0x06
+
+
+def test_capacity_version_serial():
+    layout = layouts.PACE
+    dialect = decoders.compile_dialect(layout)
+
+    capacity = dialect[constants.cid2PackCapacity]
+    capacity.decode(simulator.encode(layout[constants.cid2PackCapacity], {}, [
+        {"pack_remain_cap": 50000, "pack_full_cap": 100000, "pack_design_cap": 100000}]))
+    assert snapshot.capacity_from(capacity).pack_soc == 50
+
+    version = dialect[constants.cid2SoftwareVersion]
+    version.decode(simulator.encode(layout[constants.cid2SoftwareVersion], {"bms_version": "SIM_V1.0"}, []))
+    assert version.bms_version == "SIM_V1.0"
+
+    serial_number = dialect[constants.cid2SerialNumber]
+    serial_number.decode(simulator.encode(layout[constants.cid2SerialNumber], {"bms_sn": "SN1", "pack_sn": "PACK1"}, []))
+    assert serial_number.bms_sn.strip() == "SN1"
+    assert serial_number.pack_sn.strip() == "PACK1"
+
+
+def padded(gap):
+
+    # Pace 0x42 INFO for two packs with gap 0xFF bytes between them
+    layout = layouts.PACE[constants.cid2PackAnalogData]
+    values = pack_values(2)
+    first = binascii.unhexlify(simulator.encode(layout, {}, values[:1]))
+    both = binascii.unhexlify(simulator.encode(layout, {}, values))
+    return binascii.hexlify(both[:len(first)] + b'\xff' * gap + both[len(first):])
+
+
+def test_pack_resync():
+    analog = decoders.compile_dialect(layouts.PACE)[constants.cid2PackAnalogData]
+    assert analog.decode(padded(decoders.RESYNC_WINDOW)) == 2
+    assert len(snapshot.packs_from(analog)[1].v_cells) == 16
+    with pytest.raises(ValueError):
+        analog.decode(padded(decoders.RESYNC_WINDOW + 1))
+
+
+def test_force_pack_offset():
+    # force_pack_offset is in hex characters, the decoders take bytes
+    gap = 24
+    analog = decoders.compile_dialect(layouts.PACE, pack_offset=(2 * gap)//2)[constants.cid2PackAnalogData]
+    assert analog.decode(padded(gap)) == 2
+    packs = snapshot.packs_from(analog)
+    assert list(packs[1].v_cells) == [round(v) for v in pack_values(2)[1]["v_cells"]]
@@ -0,0 +1,56 @@
+import os
+import random
+import sys
+import types
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import scheduler
+
+
+def pack(v_cells, i_pack=0):
+    return types.SimpleNamespace(pack=1, i_pack=i_pack, v_cells=v_cells)
+
+
+def test_idle_jitter_reaches_max_interval():
+    adaptive = scheduler.AdaptiveInterval(1, 30)
+    adaptive.interval = adaptive.min_interval
+    jitter = random.Random(1)
+    now = 0
+    for _ in range(600):
+        adaptive.update([pack([3300 + jitter.choice((-1, 0, 1)) for _ in range(16)])], now)
+        now += adaptive.interval
+    assert adaptive.interval == 30
+
+
+def test_cell_ramp_keeps_min_interval():
+    adaptive = scheduler.AdaptiveInterval(1, 30)
+    now = 0
+    for _ in range(300):
+        # 10 mV per minute, twice busy_dvdt
+        adaptive.update([pack([3300 + int(now / 6)] * 16)], now)
+        now += adaptive.interval
+    assert adaptive.interval == 1
+
+
+def test_current_sets_min_interval():
+    adaptive = scheduler.AdaptiveInterval(1, 30)
+    assert adaptive.update([pack([3300] * 16, i_pack=-25)], 0) == 1
+
+
+def test_scan_commands_share_one_grid():
+    polling = scheduler.CommandScheduler(scheduler.DEFAULT_SCHEDULE, 5)
+    scan = set(polling.scan_commands)
+    publishes = 0
+    now = 0.0
+    while now < 60:
+        due = polling.due(now)
+        for cid2 in due:
+            # Every command takes 0.3 s on the bus
+            now += 0.3
+            polling.done(cid2)
+        if scan & set(due):
+            publishes += 1
+        now += polling.wait(now)
+    assert publishes == 12
+    assert len(set(polling.next_due[cid2] for cid2 in scan)) == 1
@@ -0,0 +1,111 @@
+import json
+import os
+import sys
+import types
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import snapshot
+import spool
+
+
+def bank(n):
+    return snapshot.BankSnapshot(timestamp=1700000000 + n)
+
+
+def timestamps(lines):
+    return [json.loads(line)["timestamp"] - 1700000000 for line, position in lines]
+
+
+def drain(spooled):
+    # Everything left in the spool, one segment per read
+    sent = []
+    lines = spooled.read(100)
+    while lines:
+        sent += timestamps(lines)
+        spooled.advance(lines[-1][1])
+        lines = spooled.read(100)
+    return sent
+
+
+class Client:
+
+    # publish() fails from the fail_at'th call on, like a broker going away
+    def __init__(self, fail_at=None):
+        self.fail_at = fail_at
+        self.published = []
+
+    def publish(self, topic, payload, qos=0):
+        if self.fail_at is not None and len(self.published) + 1 >= self.fail_at:
+            return types.SimpleNamespace(rc=4)
+        self.published.append(payload)
+        return types.SimpleNamespace(rc=0)
+
+
+def test_position_across_restarts(tmp_path):
+    path = str(tmp_path)
+    spooled = spool.Spool(path)
+    for n in range(5):
+        spooled.append(bank(n))
+    lines = spooled.read(2)
+    assert timestamps(lines) == [0, 1]
+    spooled.advance(lines[-1][1])
+
+    spooled = spool.Spool(path)
+    assert spooled.position == lines[-1][1]
+    assert timestamps(spooled.read(10)) == [2, 3, 4]
+
+
+def test_forwarder_partial_batch(tmp_path):
+    path = str(tmp_path)
+    spooled = spool.Spool(path)
+    for n in range(5):
+        spooled.append(bank(n))
+
+    # The broker goes away at the third publish, only the two sent are done
+    client = Client(fail_at=3)
+    assert not spool.Forwarder(spooled, client, "b/backfill", rate=1000).forward()
+    assert len(client.published) == 2
+
+    client = Client()
+    forwarder = spool.Forwarder(spool.Spool(path), client, "b/backfill", rate=1000)
+    assert forwarder.forward()
+    assert [json.loads(line)["timestamp"] - 1700000000 for line in client.published] == [2, 3, 4]
+    assert not forwarder.forward()
+    assert not forwarder.spool.pending()
+
+
+def test_sent_segment_is_removed(tmp_path):
+    path = str(tmp_path)
+    spooled = spool.Spool(path)
+    spooled.append(bank(0))
+    spooled.advance(spooled.read(10)[-1][1])
+    assert not spooled.pending()
+
+    # New scans go to a segment after the one replayed
+    spooled.append(bank(1))
+    spooled = spool.Spool(path)
+    assert timestamps(spooled.read(10)) == [1]
+
+
+def test_trim_across_restarts(tmp_path):
+    path = str(tmp_path)
+    size = len(spool.record(bank(0))) + 1
+    spooled = spool.Spool(path, max_size=8 * size, segments=4)
+    for n in range(4):
+        spooled.append(bank(n))
+    lines = spooled.read(1)
+    spooled.advance(lines[-1][1])
+    assert spooled.position != (0, 0)
+
+    # Over max_size the oldest segments go, the replay restarts at the oldest left
+    for n in range(4, 12):
+        spooled.append(bank(n))
+    assert spooled.dropped > 0
+    assert spooled.position == (0, 0)
+
+    spooled = spool.Spool(path, max_size=8 * size, segments=4)
+    assert spooled.position == (0, 0)
+    remaining = drain(spooled)
+    assert remaining[0] > 1
+    assert remaining == list(range(remaining[0], 12))
@@ -0,0 +1,92 @@
+import os
+import socket
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import codec
+import simulator
+import transport
+
+
+def frame(info=b'0102'):
+    return simulator.response_frame(b'25', b'01', b'00', info)
+
+
+def test_split_frame():
+    reassembler = transport.FrameReassembler()
+    response = frame()
+    for i in range(len(response) - 1):
+        reassembler.feed(response[i:i+1])
+        assert reassembler.next_frame() is None
+    reassembler.feed(response[-1:])
+    assert reassembler.next_frame() == response
+    assert reassembler.next_frame() is None
+
+
+def test_joined_frames():
+    reassembler = transport.FrameReassembler()
+    first, second = frame(b'01'), frame(b'0203')
+    reassembler.feed(first + second + second[:5])
+    assert reassembler.pending_frames() == [first, second]
+    # The start of the third frame is carried over to the next read
+    reassembler.feed(second[5:])
+    assert reassembler.next_frame() == second
+    assert reassembler.dropped_bytes == 0
+
+
+def test_noise_before_frame():
+    reassembler = transport.FrameReassembler()
+    response = frame()
+    reassembler.feed(b'\x00\xffjunk' + response)
+    assert reassembler.next_frame() == response
+    assert reassembler.dropped_bytes == 6
+
+
+def test_cut_short_frame():
+    # A frame without its EOI is dropped when the next SOI arrives
+    reassembler = transport.FrameReassembler()
+    first, second = frame(b'01'), frame(b'0203')
+    reassembler.feed(first[:10] + second)
+    assert reassembler.next_frame() == second
+    assert reassembler.dropped_bytes == 10
+
+
+def test_corrupted_frame():
+    response = bytearray(frame(b'0102'))
+    assert codec.parse_response(bytes(response)) == (True, b'0102')
+    response[14] = ord('3')
+    assert codec.parse_response(bytes(response)) == (False, "Checksum error")
+    response = bytearray(frame(b'0102'))
+    response[9] = ord('0')
+    assert codec.parse_response(bytes(response))[1].startswith("LCHKSUM")
+
+
+def test_buffer_limit():
+    reassembler = transport.FrameReassembler(max_buffer=64)
+    response = frame()
+    reassembler.feed(b'x' * 200 + response)
+    assert reassembler.next_frame() == response
+
+
+def test_read_frame():
+    bms, client = socket.socketpair()
+    try:
+        reassembler = transport.FrameReassembler()
+        first, second = frame(b'01'), frame(b'0203')
+        bms.sendall(first[:7])
+        assert reassembler.read_frame(client, 0.1) is None
+        assert reassembler.timeouts == 1
+        bms.sendall(first[7:] + second)
+        assert reassembler.read_frame(client, 1) == first
+        assert reassembler.first_data is not None
+        assert reassembler.read_frame(client, 1) == second
+        bms.close()
+        try:
+            reassembler.read_frame(client, 1)
+            assert False
+        except ConnectionError:
+            pass
+    finally:
+        bms.close()
+        client.close()
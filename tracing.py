@@ -0,0 +1,64 @@
+import collections
+import json
+import math
+import threading
+import time
+
+# Per stage timing of BMS transactions (tracing: true). Every request is split into
+# consecutive spans on the monotonic clock: encode the request, send it (pacing
+# waits and the fixed pacing sleep included), wait for the first byte, receive up
+# to the last byte, verify the checksums, decode the fields. Publishing is timed in
+# the publish queue. The last trace_window durations of every stage are kept and
+# reported as p50 / p95 / p99 on <base>/trace. With tracing off the tracer is None
+# and the poller only pays for the None checks.
+
+STAGES = ("encode", "send", "first_byte", "last_byte", "checksum", "decode", "publish")
+
+
+def percentile(durations, fraction):
+    # Nearest rank on a sorted list, rounded first so 0.95 * 100 can't become rank 96
+    return durations[max(0, math.ceil(round(fraction * len(durations), 9)) - 1)]
+
+
+class Tracer:
+
+    def __init__(self, window=500):
+        self.lock = threading.Lock()
+        self.spans = dict((stage, collections.deque(maxlen=window)) for stage in STAGES)
+        self.last = time.monotonic()
+
+    def start(self):
+        self.last = time.monotonic()
+
+    def mark(self, stage, at=None):
+        # Ends the span that started at the previous mark
+        now = time.monotonic() if at is None else at
+        self.record(stage, now - self.last)
+        self.last = now
+
+    def record(self, stage, seconds):
+        with self.lock:
+            self.spans[stage].append(seconds)
+
+    def summary(self):
+
+        # {stage: {count, p50, p95, p99, max}}, durations in ms
+        with self.lock:
+            spans = dict((stage, sorted(durations)) for stage, durations in self.spans.items() if durations)
+        return dict((stage, {"count": len(durations),
+                             "p50": round(percentile(durations, 0.5) * 1000, 3),
+                             "p95": round(percentile(durations, 0.95) * 1000, 3),
+                             "p99": round(percentile(durations, 0.99) * 1000, 3),
+                             "max": round(durations[-1] * 1000, 3)})
+                    for stage, durations in spans.items())
+
+    def document(self):
+        return json.dumps({"timestamp": round(time.time(), 3), "unit": "ms", "stages": self.summary()})
+
+
+def tracer(config):
+
+    # Tracer from the tracing options, None when tracing is off
+    if not config.get('tracing', False):
+        return None
+    return Tracer(config.get('trace_window', 500))
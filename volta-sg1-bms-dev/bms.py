@@ -12,6 +12,17 @@ import json
 import atexit
 import sys
 import constants
+import codec
+import decoders
+import layouts
+import publisher
+import snapshot
+import transport
+import aliases
+import discovery
+import spool
+import modbus
+import scheduler
 
 print("Starting up...")
 
@@ -43,6 +54,19 @@ bms_connected = False
 mqtt_connected = False
 print_initial = True
 debug_output = config['debug_output']
+frame_timeout = config.get('frame_timeout', 2)
+request_pacing = config.get('request_pacing', "fixed")
+publish_mode = config.get('publish_mode', "topics")
+discovery_mode = config.get('mqtt_ha_discovery_mode', "entity")
+discovery_cleanup = False
+pacer = transport.RequestPacer(request_pacing, turnaround=config.get('bus_turnaround', 0.05), max_timeout=frame_timeout)
+reassembler = transport.FrameReassembler()
+dialect = decoders.compile_dialect(layouts.VOLTA_SG1, pack_offset=int(config.get('force_pack_offset', 0))//2)
+analog = dialect[constants.cid2PackAnalogData]
+warn = dialect[constants.cid2WarnInfo]
+capacity = dialect[constants.cid2PackCapacity]
+version = dialect[constants.cid2SoftwareVersion]
+serial_number = dialect[constants.cid2SerialNumber]
 disc_payload = {}
 repub_discovery = 0
 
@@ -54,39 +78,55 @@ cells = 13
 temps = 6
 bat_read = 1
 
-i_pack = []
-v_pack = []
-i_remain_cap = []
-i_design_cap = []
-cycles = []
-i_full_cap = []
-soc = []
-soh = []
-
 print("Connection Type: " + connection_type)
 
-def on_connect(client, userdata, flags, rc):
+def on_connect(client, userdata, flags, rc, properties=None):
     print("MQTT connected with result code "+str(rc))
     client.will_set(config['mqtt_base_topic'] + "/availability","offline", qos=0, retain=False)
+    if topic_aliases is not None:
+        topic_aliases.reset(properties)
+    client.subscribe(config['mqtt_ha_discovery_topic'] + "/status")
     global mqtt_connected
     mqtt_connected = True
 
-def on_disconnect(client, userdata, rc):
+def on_disconnect(client, userdata, rc, properties=None):
     print("MQTT disconnected with result code "+str(rc))
     global mqtt_connected
     mqtt_connected = False
 
+def on_message(client, userdata, message):
+    # HA announces itself on <discovery prefix>/status when it (re)starts
+    if message.topic == config['mqtt_ha_discovery_topic'] + "/status" and message.payload == b"online":
+        discovery_cache.forget()
+    elif discovery_cache.stale(message.topic, message.payload):
+        client.publish(message.topic, "", qos=0, retain=True)
+
 
-client = mqtt.Client("bmspace")
+client = mqtt.Client("bmspace", protocol=aliases.protocol(config))
+topic_aliases = None
+if aliases.protocol(config) == mqtt.MQTTv5:
+    topic_aliases = aliases.TopicAliasClient(client, config.get('mqtt_topic_aliases', 64))
 client.on_connect = on_connect
 client.on_disconnect = on_disconnect
-#client.on_message = on_message
+client.on_message = on_message
+# on_message uses the cache as soon as the network thread delivers a message
+discovery_cache = discovery.DiscoveryCache(client)
 
 client.username_pw_set(username=config['mqtt_user'], password=config['mqtt_password'])
+# The network thread of loop_start() reconnects by itself, so the polling loop
+# never waits for the broker and keeps spooling scans while it is down
+client.reconnect_delay_set(1, 30)
 client.connect(config['mqtt_host'], config['mqtt_port'], 60)
 client.loop_start()
 time.sleep(2)
 
+sinks = [publisher.mqtt_sink(topic_aliases or client, config)]
+modbus_sink = modbus.modbus_sink(config)
+if modbus_sink is not None:
+    sinks.append(modbus_sink)
+publishing = publisher.publish_queue(sinks, config)
+spooling = spool.store_and_forward(client, config, lambda: mqtt_connected)
+
 def exit_handler():
     print("Script exiting")
     client.publish(config['mqtt_base_topic'] + "/availability","offline")
@@ -101,6 +141,7 @@ def bms_connect(address, port):
         try:
             print("trying to connect %s" % bms_serial)
             s = serial.Serial(bms_serial,timeout = 1)
+            reassembler.reset()
             print("BMS serial connected")
             return s, True
         except IOError as msg:
@@ -114,6 +155,7 @@ def bms_connect(address, port):
             s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             s.settimeout(2)
             s.connect((address, port))
+            reassembler.reset()
             print("BMS socket connected")
             return s, True
         except OSError as msg:
@@ -126,8 +168,9 @@ def bms_sendData(comms,request=''):
 
         try:
             if len(request) > 0:
+                pacer.before_send()
                 comms.write(request)
-                time.sleep(0.25)
+                pacer.after_send(request)
                 return True
         except IOError as e:
             print("BMS serial error: %s" % e)
@@ -138,8 +181,9 @@ def bms_sendData(comms,request=''):
 
         try:
             if len(request) > 0:
+                pacer.before_send()
                 comms.send(request)
-                time.sleep(0.25)
+                pacer.after_send(request)
                 return True
         except Exception as e:
             print("BMS socket error: %s" % e)
@@ -148,287 +192,281 @@ def bms_sendData(comms,request=''):
 
 def bms_get_data(comms):
     try:
-        if connection_type == "Serial":
-            inc_data = comms.readline()
-        else:
-            temp = bytes()
-            
-            while len(temp) == 0 or temp[-1] != 13:
-                temp = temp + comms.recv(4096)
-
-            temp2 = temp.split(b'\r')
-            # Decide which one to take:
-            for element in range(0,len(temp2)):
-                SOI = hex(ord(temp2[element][0:1]))
-                if SOI == '0x7e':
-                    inc_data = temp2[element] + b'\r'
-                    break
-
-            if (len(temp2) > 2) & (debug_output > 0):
-                print("Multiple EOIs detected")
-                print("...for incoming data: " + str(temp) + " |Hex: " + str(temp.hex(' ')))
-                
+        timeout = pacer.response_timeout()
+        inc_data = reassembler.read_frame(comms, timeout)
+        rtt = pacer.after_response(inc_data is not None)
+        if inc_data is None:
+            if debug_output > 0:
+                print("No complete frame received within " + str(round(timeout,3)) + "s, partial data kept: " + str(bytes(reassembler.buffer)))
+            return False
+        if debug_output > 1:
+            print("Round trip: " + str(round(rtt*1000)) + " ms")
+        if (len(reassembler.buffer) > 0) & (debug_output > 0):
+            print("Extra data after EOI kept for next read: " + str(bytes(reassembler.buffer)))
         return inc_data
     except Exception as e:
+        pacer.after_response(False)
         print("BMS socket receive error: %s" % e)
         # global bms_connected
         return False
 
-def ha_discovery():
-
-    global ha_discovery_enabled
-    global packs
-
-    if ha_discovery_enabled:
-        
-        print("Publishing HA Discovery topic...")
-
-        disc_payload['availability_topic'] = config['mqtt_base_topic'] + "/availability"
-
-        device = {}
-        device['manufacturer'] = "BMS Pace"
-        device['model'] = "AM-x"
-        device['identifiers'] = "bmspace_" + bms_sn
-        device['name'] = "Generic Lithium"
-        device['sw_version'] = bms_version
-        disc_payload['device'] = device
-
-        for p in range (1,packs+1):
-
-            for i in range(0,cells):
-                disc_payload['name'] = "Pack " + str(p) + " Cell " + str(i+1) + " Voltage"
-                disc_payload['unique_id'] = "bmspace_" + bms_sn + "_pack_" + str(p) + "_v_cell_" + str(i+1)
-                disc_payload['state_topic'] = config['mqtt_base_topic'] + "/pack_" + str(p) + "/v_cells/cell_" + str(i+1)
-                disc_payload['unit_of_measurement'] = "mV"
-                client.publish(config['mqtt_ha_discovery_topic']+"/sensor/BMS-" + bms_sn + "/" + disc_payload['name'].replace(' ', '_') + "/config",json.dumps(disc_payload),qos=0, retain=True)
-
-            for i in range(0,temps):
-                disc_payload['name'] = "Pack " + str(p) + " Temperature " + str(i+1)
-                disc_payload['unique_id'] = "bmspace_" + bms_sn + "_pack_" + str(p) + "_temp_" + str(i+1)
-                disc_payload['state_topic'] = config['mqtt_base_topic'] + "/pack_" + str(p) + "/temps/temp_" + str(i+1)
-                disc_payload['unit_of_measurement'] = "°C"
-                client.publish(config['mqtt_ha_discovery_topic']+"/sensor/BMS-" + bms_sn + "/" + disc_payload['name'].replace(' ', '_') + "/config",json.dumps(disc_payload),qos=0, retain=True)
-
-
-            disc_payload['name'] = "Pack " + str(p) + " Current"
-            disc_payload['unique_id'] = "bmspace_" + bms_sn + "_pack_" + str(p) + "_i_pack"
-            disc_payload['state_topic'] = config['mqtt_base_topic'] + "/pack_" + str(p) + "/i_pack"
-            disc_payload['unit_of_measurement'] = "A"
-            client.publish(config['mqtt_ha_discovery_topic']+"/sensor/BMS-" + bms_sn + "/" + disc_payload['name'].replace(' ', '_') + "/config",json.dumps(disc_payload),qos=0, retain=True)
-
-            disc_payload['name'] = "Pack " + str(p) + " Voltage"
-            disc_payload['unique_id'] = "bmspace_" + bms_sn + "_pack_" + str(p) + "_v_pack"
-            disc_payload['state_topic'] = config['mqtt_base_topic'] + "/pack_" + str(p) + "/v_pack"
-            disc_payload['unit_of_measurement'] = "V"
-            client.publish(config['mqtt_ha_discovery_topic']+"/sensor/BMS-" + bms_sn + "/" + disc_payload['name'].replace(' ', '_') + "/config",json.dumps(disc_payload),qos=0, retain=True)
-
-            disc_payload['name'] = "Pack " + str(p) + " Remaining Capacity"
-            disc_payload['unique_id'] = "bmspace_" + bms_sn + "_pack_" + str(p) + "_i_remain_cap"
-            disc_payload['state_topic'] = config['mqtt_base_topic'] + "/pack_" + str(p) + "/i_remain_cap"
-            disc_payload['unit_of_measurement'] = "mAh"
-            client.publish(config['mqtt_ha_discovery_topic']+"/sensor/BMS-" + bms_sn + "/" + disc_payload['name'].replace(' ', '_') + "/config",json.dumps(disc_payload),qos=0, retain=True)
-
-            disc_payload['name'] = "Pack " + str(p) + " State of Health"
-            disc_payload['unique_id'] = "bmspace_" + bms_sn + "_pack_" + str(p) + "_soh"
-            disc_payload['state_topic'] = config['mqtt_base_topic'] + "/pack_" + str(p) + "/soh"
-            disc_payload['unit_of_measurement'] = "%"
-            client.publish(config['mqtt_ha_discovery_topic']+"/sensor/BMS-" + bms_sn + "/" + disc_payload['name'].replace(' ', '_') + "/config",json.dumps(disc_payload),qos=0, retain=True)
-
-            disc_payload['name'] = "Pack " + str(p) + " Cycles"
-            disc_payload['unique_id'] = "bmspace_" + bms_sn + "_pack_" + str(p) + "_cycles"
-            disc_payload['state_topic'] = config['mqtt_base_topic'] + "/pack_" + str(p) + "/cycles"
-            disc_payload['unit_of_measurement'] = ""
-            client.publish(config['mqtt_ha_discovery_topic']+"/sensor/BMS-" + bms_sn + "/" + disc_payload['name'].replace(' ', '_') + "/config",json.dumps(disc_payload),qos=0, retain=True)
-
-            disc_payload['name'] = "Pack " + str(p) + " Full Capacity"
-            disc_payload['unique_id'] = "bmspace_" + bms_sn + "_pack_" + str(p) + "_i_full_cap"
-            disc_payload['state_topic'] = config['mqtt_base_topic'] + "/pack_" + str(p) + "/i_full_cap"
-            disc_payload['unit_of_measurement'] = "mAh"
-            client.publish(config['mqtt_ha_discovery_topic']+"/sensor/BMS-" + bms_sn + "/" + disc_payload['name'].replace(' ', '_') + "/config",json.dumps(disc_payload),qos=0, retain=True)
-
-            # disc_payload['name'] = "Pack " + str(p) + " Design Capacity"
-            # disc_payload['unique_id'] = "bmspace_" + bms_sn + "_pack_" + str(p) + "_i_design_cap"
-            # disc_payload['state_topic'] = config['mqtt_base_topic'] + "/pack_" + str(p) + "/i_design_cap"
-            # disc_payload['unit_of_measurement'] = "mAh"
-            # client.publish(config['mqtt_ha_discovery_topic']+"/sensor/BMS-" + bms_sn + "/" + disc_payload['name'].replace(' ', '_') + "/config",json.dumps(disc_payload),qos=0, retain=True)
-
-            disc_payload['name'] = "Pack " + str(p) + " State of Charge"
-            disc_payload['unique_id'] = "bmspace_" + bms_sn + "_pack_" + str(p) + "_soc"
-            disc_payload['state_topic'] = config['mqtt_base_topic'] + "/pack_" + str(p) + "/soc"
-            disc_payload['unit_of_measurement'] = "%"
-            client.publish(config['mqtt_ha_discovery_topic']+"/sensor/BMS-" + bms_sn + "/" + disc_payload['name'].replace(' ', '_') + "/config",json.dumps(disc_payload),qos=0, retain=True)
-
-            disc_payload['name'] = "Pack " + str(p) + " State of Health"
-            disc_payload['unique_id'] = "bmspace_" + bms_sn + "_pack_" + str(p) + "_soh"
-            disc_payload['state_topic'] = config['mqtt_base_topic'] + "/pack_" + str(p) + "/soh"
-            disc_payload['unit_of_measurement'] = "%"
-            client.publish(config['mqtt_ha_discovery_topic']+"/sensor/BMS-" + bms_sn + "/" + disc_payload['name'].replace(' ', '_') + "/config",json.dumps(disc_payload),qos=0, retain=True)
-
-
-            disc_payload.pop('unit_of_measurement')
-
-            # disc_payload['name'] = "Pack " + str(p) + " Warnings"
-            # disc_payload['unique_id'] = "bmspace_" + bms_sn + "_pack_" + str(p) + "_warnings"
-            # disc_payload['state_topic'] = config['mqtt_base_topic'] + "/pack_" + str(p) + "/warnings"
-            # client.publish(config['mqtt_ha_discovery_topic']+"/sensor/BMS-" + bms_sn + "/" + disc_payload['name'].replace(' ', '_') + "/config",json.dumps(disc_payload),qos=0, retain=True)
-
-            # disc_payload['name'] = "Pack " + str(p) + " Balancing1"
-            # disc_payload['unique_id'] = "bmspace_" + bms_sn + "_pack_" + str(p) + "_balancing1"
-            # disc_payload['state_topic'] = config['mqtt_base_topic'] + "/pack_" + str(p) + "/balancing1"
-            # client.publish(config['mqtt_ha_discovery_topic']+"/sensor/BMS-" + bms_sn + "/" + disc_payload['name'].replace(' ', '_') + "/config",json.dumps(disc_payload),qos=0, retain=True)
-
-            # disc_payload['name'] = "Pack " + str(p) + " Balancing2"
-            # disc_payload['unique_id'] = "bmspace_" + bms_sn + "_pack_" + str(p) + "_balancing2"
-            # disc_payload['state_topic'] = config['mqtt_base_topic'] + "/pack_" + str(p) + "/balancing2"
-            # client.publish(config['mqtt_ha_discovery_topic']+"/sensor/BMS-" + bms_sn + "/" + disc_payload['name'].replace(' ', '_') + "/config",json.dumps(disc_payload),qos=0, retain=True)
-
-
-            # # Binary Sensors
-            # disc_payload['name'] = "Pack " + str(p) + " Protection Short Circuit"
-            # disc_payload['unique_id'] = "bmspace_" + bms_sn + "_pack_" + str(p) + "_prot_short_circuit"
-            # disc_payload['state_topic'] = config['mqtt_base_topic'] + "/pack_" + str(p) + "/prot_short_circuit"
-            # disc_payload['payload_on'] = "1"
-            # disc_payload['payload_off'] = "0"
-            # client.publish(config['mqtt_ha_discovery_topic']+"/binary_sensor/BMS-" + bms_sn + "/" + disc_payload['name'].replace(' ', '_') + "/config",json.dumps(disc_payload),qos=0, retain=True)
-
-            # disc_payload['name'] = "Pack " + str(p) + " Protection Discharge Current"
-            # disc_payload['unique_id'] = "bmspace_" + bms_sn + "_pack_" + str(p) + "_prot_discharge_current"
-            # disc_payload['state_topic'] = config['mqtt_base_topic'] + "/pack_" + str(p) + "/prot_discharge_current"
-            # disc_payload['payload_on'] = "1"
-            # disc_payload['payload_off'] = "0"
-            # client.publish(config['mqtt_ha_discovery_topic']+"/binary_sensor/BMS-" + bms_sn + "/" + disc_payload['name'].replace(' ', '_') + "/config",json.dumps(disc_payload),qos=0, retain=True)
-
-            # disc_payload['name'] = "Pack " + str(p) + " Protection Charge Current"
-            # disc_payload['unique_id'] = "bmspace_" + bms_sn + "_pack_" + str(p) + "_prot_charge_current"
-            # disc_payload['state_topic'] = config['mqtt_base_topic'] + "/pack_" + str(p) + "/prot_charge_current"
-            # disc_payload['payload_on'] = "1"
-            # disc_payload['payload_off'] = "0"
-            # client.publish(config['mqtt_ha_discovery_topic']+"/binary_sensor/BMS-" + bms_sn + "/" + disc_payload['name'].replace(' ', '_') + "/config",json.dumps(disc_payload),qos=0, retain=True)
-
-            # disc_payload['name'] = "Pack " + str(p) + " Current Limit"
-            # disc_payload['unique_id'] = "bmspace_" + bms_sn + "_pack_" + str(p) + "_current_limit"
-            # disc_payload['state_topic'] = config['mqtt_base_topic'] + "/pack_" + str(p) + "/current_limit"
-            # disc_payload['payload_on'] = "1"
-            # disc_payload['payload_off'] = "0"
-            # client.publish(config['mqtt_ha_discovery_topic']+"/binary_sensor/BMS-" + bms_sn + "/" + disc_payload['name'].replace(' ', '_') + "/config",json.dumps(disc_payload),qos=0, retain=True)
-
-            # disc_payload['name'] = "Pack " + str(p) + " Charge FET"
-            # disc_payload['unique_id'] = "bmspace_" + bms_sn + "_pack_" + str(p) + "_charge_fet"
-            # disc_payload['state_topic'] = config['mqtt_base_topic'] + "/pack_" + str(p) + "/charge_fet"
-            # disc_payload['payload_on'] = "1"
-            # disc_payload['payload_off'] = "0"
-            # client.publish(config['mqtt_ha_discovery_topic']+"/binary_sensor/BMS-" + bms_sn + "/" + disc_payload['name'].replace(' ', '_') + "/config",json.dumps(disc_payload),qos=0, retain=True)
-
-            # disc_payload['name'] = "Pack " + str(p) + " Discharge FET"
-            # disc_payload['unique_id'] = "bmspace_" + bms_sn + "_pack_" + str(p) + "_discharge_fet"
-            # disc_payload['state_topic'] = config['mqtt_base_topic'] + "/pack_" + str(p) + "/discharge_fet"
-            # disc_payload['payload_on'] = "1"
-            # disc_payload['payload_off'] = "0"
-            # client.publish(config['mqtt_ha_discovery_topic']+"/binary_sensor/BMS-" + bms_sn + "/" + disc_payload['name'].replace(' ', '_') + "/config",json.dumps(disc_payload),qos=0, retain=True)
-
-            # disc_payload['name'] = "Pack " + str(p) + " Pack Indicate"
-            # disc_payload['unique_id'] = "bmspace_" + bms_sn + "_pack_" + str(p) + "_pack_indicate"
-            # disc_payload['state_topic'] = config['mqtt_base_topic'] + "/pack_" + str(p) + "/pack_indicate"
-            # disc_payload['payload_on'] = "1"
-            # disc_payload['payload_off'] = "0"
-            # client.publish(config['mqtt_ha_discovery_topic']+"/binary_sensor/BMS-" + bms_sn + "/" + disc_payload['name'].replace(' ', '_') + "/config",json.dumps(disc_payload),qos=0, retain=True)
-
-            # disc_payload['name'] = "Pack " + str(p) + " Reverse"
-            # disc_payload['unique_id'] = "bmspace_" + bms_sn + "_pack_" + str(p) + "_reverse"
-            # disc_payload['state_topic'] = config['mqtt_base_topic'] + "/pack_" + str(p) + "/reverse"
-            # disc_payload['payload_on'] = "1"
-            # disc_payload['payload_off'] = "0"
-            # client.publish(config['mqtt_ha_discovery_topic']+"/binary_sensor/BMS-" + bms_sn + "/" + disc_payload['name'].replace(' ', '_') + "/config",json.dumps(disc_payload),qos=0, retain=True)
-
-            # disc_payload['name'] = "Pack " + str(p) + " AC In"
-            # disc_payload['unique_id'] = "bmspace_" + bms_sn + "_pack_" + str(p) + "_ac_in"
-            # disc_payload['state_topic'] = config['mqtt_base_topic'] + "/pack_" + str(p) + "/ac_in"
-            # disc_payload['payload_on'] = "1"
-            # disc_payload['payload_off'] = "0"
-            # client.publish(config['mqtt_ha_discovery_topic']+"/binary_sensor/BMS-" + bms_sn + "/" + disc_payload['name'].replace(' ', '_') + "/config",json.dumps(disc_payload),qos=0, retain=True)
-
-            # disc_payload['name'] = "Pack " + str(p) + " Heart"
-            # disc_payload['unique_id'] = "bmspace_" + bms_sn + "_pack_" + str(p) + "_heart"
-            # disc_payload['state_topic'] = config['mqtt_base_topic'] + "/pack_" + str(p) + "/heart"
-            # disc_payload['payload_on'] = "1"
-            # disc_payload['payload_off'] = "0"
-            # client.publish(config['mqtt_ha_discovery_topic']+"/binary_sensor/BMS-" + bms_sn + "/" + disc_payload['name'].replace(' ', '_') + "/config",json.dumps(disc_payload),qos=0, retain=True)
-
-            disc_payload['name'] = "Pack " + str(p) + " Cell Max Volt Diff"
-            disc_payload['unique_id'] = "bmspace_" + bms_sn + "_pack_" + str(p) + "_cells_max_diff_calc"
-            disc_payload['state_topic'] = config['mqtt_base_topic'] + "/pack_" + str(p) + "/cells_max_diff_calc"
-            disc_payload['unit_of_measurement'] = "mV"
-            client.publish(config['mqtt_ha_discovery_topic']+"/sensor/BMS-" + bms_sn + "/" + disc_payload['name'].replace(' ', '_') + "/config",json.dumps(disc_payload),qos=0, retain=True)
-
-            # # Pack data
-            # disc_payload.pop('payload_on')
-            # disc_payload.pop('payload_off')
-
-            # disc_payload['name'] = "Pack Remaining Capacity"
-            # disc_payload['unique_id'] = "bmspace_" + bms_sn + "_pack_i_remain_cap"
-            # disc_payload['state_topic'] = config['mqtt_base_topic'] + "/pack_remain_cap"
-            # disc_payload['unit_of_measurement'] = "mAh"
-            # client.publish(config['mqtt_ha_discovery_topic']+"/sensor/BMS-" + bms_sn + "/" + disc_payload['name'].replace(' ', '_') + "/config",json.dumps(disc_payload),qos=0, retain=True)
-
-            # disc_payload['name'] = "Pack Full Capacity"
-            # disc_payload['unique_id'] = "bmspace_" + bms_sn + "_pack_i_full_cap"
-            # disc_payload['state_topic'] = config['mqtt_base_topic'] + "/pack_full_cap"
-            # disc_payload['unit_of_measurement'] = "mAh"
-            # client.publish(config['mqtt_ha_discovery_topic']+"/sensor/BMS-" + bms_sn + "/" + disc_payload['name'].replace(' ', '_') + "/config",json.dumps(disc_payload),qos=0, retain=True)
-
-            # disc_payload['name'] = "Pack Design Capacity"
-            # disc_payload['unique_id'] = "bmspace_" + bms_sn + "_pack_i_design_cap"
-            # disc_payload['state_topic'] = config['mqtt_base_topic'] + "/pack_design_cap"
-            # disc_payload['unit_of_measurement'] = "mAh"
-            # client.publish(config['mqtt_ha_discovery_topic']+"/sensor/BMS-" + bms_sn + "/" + disc_payload['name'].replace(' ', '_') + "/config",json.dumps(disc_payload),qos=0, retain=True)
-
-            # disc_payload['name'] = "Pack State of Charge"
-            # disc_payload['unique_id'] = "bmspace_" + bms_sn + "_pack_soc"
-            # disc_payload['state_topic'] = config['mqtt_base_topic'] + "/pack_soc"
-            # disc_payload['unit_of_measurement'] = "%"
-            # client.publish(config['mqtt_ha_discovery_topic']+"/sensor/BMS-" + bms_sn + "/" + disc_payload['name'].replace(' ', '_') + "/config",json.dumps(disc_payload),qos=0, retain=True)
-
-            # disc_payload['name'] = "Pack State of Health"
-            # disc_payload['unique_id'] = "bmspace_" + bms_sn + "_pack_soh"
-            # disc_payload['state_topic'] = config['mqtt_base_topic'] + "/pack_soh"
-            # disc_payload['unit_of_measurement'] = "%"
-            # client.publish(config['mqtt_ha_discovery_topic']+"/sensor/BMS-" + bms_sn + "/" + disc_payload['name'].replace(' ', '_') + "/config",json.dumps(disc_payload),qos=0, retain=True)
+def state_topic(p, path):
 
+    # Points the entity in disc_payload at its value: its own topic, or in json
+    # publish mode the pack (p) or bank (p None) JSON document plus a value_template
+    if publish_mode == "json":
+        if p is None:
+            disc_payload['state_topic'] = config['mqtt_base_topic'] + "/state"
+        else:
+            disc_payload['state_topic'] = config['mqtt_base_topic'] + "/pack_" + str(p) + "/state"
+        disc_payload['value_template'] = "{{ value_json." + path.replace("/", ".") + " }}"
+    elif p is None:
+        disc_payload['state_topic'] = config['mqtt_base_topic'] + "/" + path
     else:
-        print("HA Discovery Disabled")
+        disc_payload['state_topic'] = config['mqtt_base_topic'] + "/pack_" + str(p) + "/" + path
 
-def chksum_calc(data):
+def build_discovery():
 
-    global debug_output
-    chksum = 0
+    # Discovery configs {config topic: payload} for the current entity layout
+    configs = {}
 
-    try:
+    disc_payload['availability_topic'] = config['mqtt_base_topic'] + "/availability"
 
-        for element in range(1, len(data)): #-5):
-            chksum += (data[element])
-        
-        chksum = chksum % 65536
-        chksum = '{0:016b}'.format(chksum)
-    
-        flip_bits = '' 
-        for i in chksum:
-            if i == '0':
-                flip_bits += '1'
-            else:
-                flip_bits += '0'
+    device = {}
+    device['manufacturer'] = "BMS Pace"
+    device['model'] = "AM-x"
+    device['identifiers'] = "bmspace_" + bms_sn
+    device['name'] = "Generic Lithium"
+    device['sw_version'] = bms_version
+    disc_payload['device'] = device
 
-        chksum = flip_bits
-        chksum = int(chksum,2)+1
+    for p in range (1,packs+1):
 
-        chksum = format(chksum, 'X')
+        for i in range(0,cells):
+            disc_payload['name'] = "Pack " + str(p) + " Cell " + str(i+1) + " Voltage"
+            disc_payload['unique_id'] = "bmspace_" + bms_sn + "_pack_" + str(p) + "_v_cell_" + str(i+1)
+            state_topic(p, "v_cells/cell_" + str(i+1))
+            disc_payload['unit_of_measurement'] = "mV"
+            configs[config['mqtt_ha_discovery_topic']+"/sensor/BMS-" + bms_sn + "/" + disc_payload['name'].replace(' ', '_') + "/config"] = json.dumps(disc_payload)
+
+        for i in range(0,temps):
+            disc_payload['name'] = "Pack " + str(p) + " Temperature " + str(i+1)
+            disc_payload['unique_id'] = "bmspace_" + bms_sn + "_pack_" + str(p) + "_temp_" + str(i+1)
+            state_topic(p, "temps/temp_" + str(i+1))
+            disc_payload['unit_of_measurement'] = "°C"
+            configs[config['mqtt_ha_discovery_topic']+"/sensor/BMS-" + bms_sn + "/" + disc_payload['name'].replace(' ', '_') + "/config"] = json.dumps(disc_payload)
+
+
+        disc_payload['name'] = "Pack " + str(p) + " Current"
+        disc_payload['unique_id'] = "bmspace_" + bms_sn + "_pack_" + str(p) + "_i_pack"
+        state_topic(p, "i_pack")
+        disc_payload['unit_of_measurement'] = "A"
+        configs[config['mqtt_ha_discovery_topic']+"/sensor/BMS-" + bms_sn + "/" + disc_payload['name'].replace(' ', '_') + "/config"] = json.dumps(disc_payload)
+
+        disc_payload['name'] = "Pack " + str(p) + " Voltage"
+        disc_payload['unique_id'] = "bmspace_" + bms_sn + "_pack_" + str(p) + "_v_pack"
+        state_topic(p, "v_pack")
+        disc_payload['unit_of_measurement'] = "V"
+        configs[config['mqtt_ha_discovery_topic']+"/sensor/BMS-" + bms_sn + "/" + disc_payload['name'].replace(' ', '_') + "/config"] = json.dumps(disc_payload)
+
+        disc_payload['name'] = "Pack " + str(p) + " Remaining Capacity"
+        disc_payload['unique_id'] = "bmspace_" + bms_sn + "_pack_" + str(p) + "_i_remain_cap"
+        state_topic(p, "i_remain_cap")
+        disc_payload['unit_of_measurement'] = "mAh"
+        configs[config['mqtt_ha_discovery_topic']+"/sensor/BMS-" + bms_sn + "/" + disc_payload['name'].replace(' ', '_') + "/config"] = json.dumps(disc_payload)
+
+        disc_payload['name'] = "Pack " + str(p) + " State of Health"
+        disc_payload['unique_id'] = "bmspace_" + bms_sn + "_pack_" + str(p) + "_soh"
+        state_topic(p, "soh")
+        disc_payload['unit_of_measurement'] = "%"
+        configs[config['mqtt_ha_discovery_topic']+"/sensor/BMS-" + bms_sn + "/" + disc_payload['name'].replace(' ', '_') + "/config"] = json.dumps(disc_payload)
+
+        disc_payload['name'] = "Pack " + str(p) + " Cycles"
+        disc_payload['unique_id'] = "bmspace_" + bms_sn + "_pack_" + str(p) + "_cycles"
+        state_topic(p, "cycles")
+        disc_payload['unit_of_measurement'] = ""
+        configs[config['mqtt_ha_discovery_topic']+"/sensor/BMS-" + bms_sn + "/" + disc_payload['name'].replace(' ', '_') + "/config"] = json.dumps(disc_payload)
+
+        disc_payload['name'] = "Pack " + str(p) + " Full Capacity"
+        disc_payload['unique_id'] = "bmspace_" + bms_sn + "_pack_" + str(p) + "_i_full_cap"
+        state_topic(p, "i_full_cap")
+        disc_payload['unit_of_measurement'] = "mAh"
+        configs[config['mqtt_ha_discovery_topic']+"/sensor/BMS-" + bms_sn + "/" + disc_payload['name'].replace(' ', '_') + "/config"] = json.dumps(disc_payload)
+
+        # disc_payload['name'] = "Pack " + str(p) + " Design Capacity"
+        # disc_payload['unique_id'] = "bmspace_" + bms_sn + "_pack_" + str(p) + "_i_design_cap"
+        # state_topic(p, "i_design_cap")
+        # disc_payload['unit_of_measurement'] = "mAh"
+        # configs[config['mqtt_ha_discovery_topic']+"/sensor/BMS-" + bms_sn + "/" + disc_payload['name'].replace(' ', '_') + "/config"] = json.dumps(disc_payload)
+
+        disc_payload['name'] = "Pack " + str(p) + " State of Charge"
+        disc_payload['unique_id'] = "bmspace_" + bms_sn + "_pack_" + str(p) + "_soc"
+        state_topic(p, "soc")
+        disc_payload['unit_of_measurement'] = "%"
+        configs[config['mqtt_ha_discovery_topic']+"/sensor/BMS-" + bms_sn + "/" + disc_payload['name'].replace(' ', '_') + "/config"] = json.dumps(disc_payload)
+
+        disc_payload['name'] = "Pack " + str(p) + " State of Health"
+        disc_payload['unique_id'] = "bmspace_" + bms_sn + "_pack_" + str(p) + "_soh"
+        state_topic(p, "soh")
+        disc_payload['unit_of_measurement'] = "%"
+        configs[config['mqtt_ha_discovery_topic']+"/sensor/BMS-" + bms_sn + "/" + disc_payload['name'].replace(' ', '_') + "/config"] = json.dumps(disc_payload)
+
+
+        disc_payload.pop('unit_of_measurement')
+
+        # disc_payload['name'] = "Pack " + str(p) + " Warnings"
+        # disc_payload['unique_id'] = "bmspace_" + bms_sn + "_pack_" + str(p) + "_warnings"
+        # state_topic(p, "warnings")
+        # configs[config['mqtt_ha_discovery_topic']+"/sensor/BMS-" + bms_sn + "/" + disc_payload['name'].replace(' ', '_') + "/config"] = json.dumps(disc_payload)
+
+        # disc_payload['name'] = "Pack " + str(p) + " Balancing1"
+        # disc_payload['unique_id'] = "bmspace_" + bms_sn + "_pack_" + str(p) + "_balancing1"
+        # state_topic(p, "balancing1")
+        # configs[config['mqtt_ha_discovery_topic']+"/sensor/BMS-" + bms_sn + "/" + disc_payload['name'].replace(' ', '_') + "/config"] = json.dumps(disc_payload)
+
+        # disc_payload['name'] = "Pack " + str(p) + " Balancing2"
+        # disc_payload['unique_id'] = "bmspace_" + bms_sn + "_pack_" + str(p) + "_balancing2"
+        # state_topic(p, "balancing2")
+        # configs[config['mqtt_ha_discovery_topic']+"/sensor/BMS-" + bms_sn + "/" + disc_payload['name'].replace(' ', '_') + "/config"] = json.dumps(disc_payload)
+
+
+        # # Binary Sensors
+        # disc_payload['name'] = "Pack " + str(p) + " Protection Short Circuit"
+        # disc_payload['unique_id'] = "bmspace_" + bms_sn + "_pack_" + str(p) + "_prot_short_circuit"
+        # state_topic(p, "prot_short_circuit")
+        # disc_payload['payload_on'] = "1"
+        # disc_payload['payload_off'] = "0"
+        # configs[config['mqtt_ha_discovery_topic']+"/binary_sensor/BMS-" + bms_sn + "/" + disc_payload['name'].replace(' ', '_') + "/config"] = json.dumps(disc_payload)
+
+        # disc_payload['name'] = "Pack " + str(p) + " Protection Discharge Current"
+        # disc_payload['unique_id'] = "bmspace_" + bms_sn + "_pack_" + str(p) + "_prot_discharge_current"
+        # state_topic(p, "prot_discharge_current")
+        # disc_payload['payload_on'] = "1"
+        # disc_payload['payload_off'] = "0"
+        # configs[config['mqtt_ha_discovery_topic']+"/binary_sensor/BMS-" + bms_sn + "/" + disc_payload['name'].replace(' ', '_') + "/config"] = json.dumps(disc_payload)
+
+        # disc_payload['name'] = "Pack " + str(p) + " Protection Charge Current"
+        # disc_payload['unique_id'] = "bmspace_" + bms_sn + "_pack_" + str(p) + "_prot_charge_current"
+        # state_topic(p, "prot_charge_current")
+        # disc_payload['payload_on'] = "1"
+        # disc_payload['payload_off'] = "0"
+        # configs[config['mqtt_ha_discovery_topic']+"/binary_sensor/BMS-" + bms_sn + "/" + disc_payload['name'].replace(' ', '_') + "/config"] = json.dumps(disc_payload)
+
+        # disc_payload['name'] = "Pack " + str(p) + " Current Limit"
+        # disc_payload['unique_id'] = "bmspace_" + bms_sn + "_pack_" + str(p) + "_current_limit"
+        # state_topic(p, "current_limit")
+        # disc_payload['payload_on'] = "1"
+        # disc_payload['payload_off'] = "0"
+        # configs[config['mqtt_ha_discovery_topic']+"/binary_sensor/BMS-" + bms_sn + "/" + disc_payload['name'].replace(' ', '_') + "/config"] = json.dumps(disc_payload)
+
+        # disc_payload['name'] = "Pack " + str(p) + " Charge FET"
+        # disc_payload['unique_id'] = "bmspace_" + bms_sn + "_pack_" + str(p) + "_charge_fet"
+        # state_topic(p, "charge_fet")
+        # disc_payload['payload_on'] = "1"
+        # disc_payload['payload_off'] = "0"
+        # configs[config['mqtt_ha_discovery_topic']+"/binary_sensor/BMS-" + bms_sn + "/" + disc_payload['name'].replace(' ', '_') + "/config"] = json.dumps(disc_payload)
+
+        # disc_payload['name'] = "Pack " + str(p) + " Discharge FET"
+        # disc_payload['unique_id'] = "bmspace_" + bms_sn + "_pack_" + str(p) + "_discharge_fet"
+        # state_topic(p, "discharge_fet")
+        # disc_payload['payload_on'] = "1"
+        # disc_payload['payload_off'] = "0"
+        # configs[config['mqtt_ha_discovery_topic']+"/binary_sensor/BMS-" + bms_sn + "/" + disc_payload['name'].replace(' ', '_') + "/config"] = json.dumps(disc_payload)
+
+        # disc_payload['name'] = "Pack " + str(p) + " Pack Indicate"
+        # disc_payload['unique_id'] = "bmspace_" + bms_sn + "_pack_" + str(p) + "_pack_indicate"
+        # state_topic(p, "pack_indicate")
+        # disc_payload['payload_on'] = "1"
+        # disc_payload['payload_off'] = "0"
+        # configs[config['mqtt_ha_discovery_topic']+"/binary_sensor/BMS-" + bms_sn + "/" + disc_payload['name'].replace(' ', '_') + "/config"] = json.dumps(disc_payload)
+
+        # disc_payload['name'] = "Pack " + str(p) + " Reverse"
+        # disc_payload['unique_id'] = "bmspace_" + bms_sn + "_pack_" + str(p) + "_reverse"
+        # state_topic(p, "reverse")
+        # disc_payload['payload_on'] = "1"
+        # disc_payload['payload_off'] = "0"
+        # configs[config['mqtt_ha_discovery_topic']+"/binary_sensor/BMS-" + bms_sn + "/" + disc_payload['name'].replace(' ', '_') + "/config"] = json.dumps(disc_payload)
+
+        # disc_payload['name'] = "Pack " + str(p) + " AC In"
+        # disc_payload['unique_id'] = "bmspace_" + bms_sn + "_pack_" + str(p) + "_ac_in"
+        # state_topic(p, "ac_in")
+        # disc_payload['payload_on'] = "1"
+        # disc_payload['payload_off'] = "0"
+        # configs[config['mqtt_ha_discovery_topic']+"/binary_sensor/BMS-" + bms_sn + "/" + disc_payload['name'].replace(' ', '_') + "/config"] = json.dumps(disc_payload)
+
+        # disc_payload['name'] = "Pack " + str(p) + " Heart"
+        # disc_payload['unique_id'] = "bmspace_" + bms_sn + "_pack_" + str(p) + "_heart"
+        # state_topic(p, "heart")
+        # disc_payload['payload_on'] = "1"
+        # disc_payload['payload_off'] = "0"
+        # configs[config['mqtt_ha_discovery_topic']+"/binary_sensor/BMS-" + bms_sn + "/" + disc_payload['name'].replace(' ', '_') + "/config"] = json.dumps(disc_payload)
+
+        disc_payload['name'] = "Pack " + str(p) + " Cell Max Volt Diff"
+        disc_payload['unique_id'] = "bmspace_" + bms_sn + "_pack_" + str(p) + "_cells_max_diff_calc"
+        state_topic(p, "cells_max_diff_calc")
+        disc_payload['unit_of_measurement'] = "mV"
+        configs[config['mqtt_ha_discovery_topic']+"/sensor/BMS-" + bms_sn + "/" + disc_payload['name'].replace(' ', '_') + "/config"] = json.dumps(disc_payload)
+
+        # # Pack data
+        # disc_payload.pop('payload_on')
+        # disc_payload.pop('payload_off')
+
+        # disc_payload['name'] = "Pack Remaining Capacity"
+        # disc_payload['unique_id'] = "bmspace_" + bms_sn + "_pack_i_remain_cap"
+        # state_topic(None, "pack_remain_cap")
+        # disc_payload['unit_of_measurement'] = "mAh"
+        # configs[config['mqtt_ha_discovery_topic']+"/sensor/BMS-" + bms_sn + "/" + disc_payload['name'].replace(' ', '_') + "/config"] = json.dumps(disc_payload)
+
+        # disc_payload['name'] = "Pack Full Capacity"
+        # disc_payload['unique_id'] = "bmspace_" + bms_sn + "_pack_i_full_cap"
+        # state_topic(None, "pack_full_cap")
+        # disc_payload['unit_of_measurement'] = "mAh"
+        # configs[config['mqtt_ha_discovery_topic']+"/sensor/BMS-" + bms_sn + "/" + disc_payload['name'].replace(' ', '_') + "/config"] = json.dumps(disc_payload)
+
+        # disc_payload['name'] = "Pack Design Capacity"
+        # disc_payload['unique_id'] = "bmspace_" + bms_sn + "_pack_i_design_cap"
+        # state_topic(None, "pack_design_cap")
+        # disc_payload['unit_of_measurement'] = "mAh"
+        # configs[config['mqtt_ha_discovery_topic']+"/sensor/BMS-" + bms_sn + "/" + disc_payload['name'].replace(' ', '_') + "/config"] = json.dumps(disc_payload)
+
+        # disc_payload['name'] = "Pack State of Charge"
+        # disc_payload['unique_id'] = "bmspace_" + bms_sn + "_pack_soc"
+        # state_topic(None, "pack_soc")
+        # disc_payload['unit_of_measurement'] = "%"
+        # configs[config['mqtt_ha_discovery_topic']+"/sensor/BMS-" + bms_sn + "/" + disc_payload['name'].replace(' ', '_') + "/config"] = json.dumps(disc_payload)
+
+        # disc_payload['name'] = "Pack State of Health"
+        # disc_payload['unique_id'] = "bmspace_" + bms_sn + "_pack_soh"
+        # state_topic(None, "pack_soh")
+        # disc_payload['unit_of_measurement'] = "%"
+        # configs[config['mqtt_ha_discovery_topic']+"/sensor/BMS-" + bms_sn + "/" + disc_payload['name'].replace(' ', '_') + "/config"] = json.dumps(disc_payload)
+
+    return configs
 
-    except Exception as e:
-        if debug_output > 0:
-            print("Error calculating CHKSUM using data: " + data)
-            print("Error details: ", str(e))
-        return(False)
+def ha_discovery():
 
-    return(chksum)
+    global ha_discovery_enabled
+    global discovery_cleanup
+
+    if ha_discovery_enabled:
+        # Configs are serialized once per layout and only changed ones are published
+        if discovery_mode == "device":
+            device_topic = config['mqtt_ha_discovery_topic'] + "/device/BMS-" + bms_sn + "/config"
+            build = lambda: discovery.device_config(build_discovery(), device_topic)
+        else:
+            build = build_discovery
+        configs = discovery_cache.configs((bms_sn, bms_version, packs, cells, temps, publish_mode, discovery_mode), build)
+        sent = discovery_cache.publish(configs)
+        print("HA Discovery: " + str(sent) + " config messages sent")
+
+        # Once published, look for retained configs of this BMS from the other mode
+        # or an older layout, on_message clears them
+        if sent and not discovery_cleanup:
+            client.subscribe([(config['mqtt_ha_discovery_topic'] + "/+/BMS-" + bms_sn + "/+/config", 0),
+                              (config['mqtt_ha_discovery_topic'] + "/device/BMS-" + bms_sn + "/config", 0)])
+            discovery_cleanup = True
+    else:
+        print("HA Discovery Disabled")
 
 def cid2_rtn(rtn):
 
@@ -486,14 +524,12 @@ def bms_parse_data(inc_data):
 
         LENID = int(inc_data[10:13],16) #amount of bytes, i.e. 2x hex
 
-        calc_LCHKSUM = lchksum_calc(inc_data[10:13])
-        if calc_LCHKSUM == False:
-            return(False,"Error calculating LCHKSUM for incoming data")
+        calc_LCHKSUM = codec.LENGTH_FIELDS[LENID][0]
 
-        if LCHKSUM != ord(calc_LCHKSUM):
+        if LCHKSUM != calc_LCHKSUM:
             if debug_output > 0:
-                print("LCHKSUM received: " + str(LCHKSUM) + " does not match calculated: " + str(ord(calc_LCHKSUM)))
-            return(False,"LCHKSUM received: " + str(LCHKSUM) + " does not match calculated: " + str(ord(calc_LCHKSUM)))
+                print("LCHKSUM received: " + str(LCHKSUM) + " does not match calculated: " + str(calc_LCHKSUM))
+            return(False,"LCHKSUM received: " + str(LCHKSUM) + " does not match calculated: " + str(calc_LCHKSUM))
 
         if debug_output > 1:
             print(" - LENID (int): ", LENID)
@@ -509,7 +545,7 @@ def bms_parse_data(inc_data):
             print("CHKSUM: ", CHKSUM)
             #print("EOI: ", hex(inc_data[13+LENID+4]))
 
-        calc_CHKSUM = chksum_calc(inc_data[:len(inc_data)-5])
+        calc_CHKSUM = codec.chksum(inc_data[:len(inc_data)-5])
 
 
         if debug_output > 1:
@@ -519,16 +555,11 @@ def bms_parse_data(inc_data):
             print("Error1 calculating CHKSUM using data: ", inc_data)
         return(False,"Error1 calculating CHKSUM: " + str(e))
 
-    if calc_CHKSUM == False:
-        if debug_output > 0:
-            print("Error2 calculating CHKSUM using data: ", inc_data)
-        return(False,"Error2 calculating CHKSUM")
-
-    if CHKSUM.decode("ASCII") == calc_CHKSUM:
+    if CHKSUM == calc_CHKSUM:
         return(True,INFO)
     else:
         if debug_output > 0:
-            print("Received and calculated CHKSUM does not match: Received: " + CHKSUM.decode("ASCII") + ", Calculated: " + calc_CHKSUM)
+            print("Received and calculated CHKSUM does not match: Received: " + CHKSUM.decode("ASCII") + ", Calculated: " + calc_CHKSUM.decode("ASCII"))
             print("...for incoming data: " + str(inc_data) + " |Hex: " + str(inc_data.hex(' ')))
             print("Length of incoming data as measured: " + str(len(inc_data)))
             print("SOI: ", SOI)
@@ -545,83 +576,22 @@ def bms_parse_data(inc_data):
             #print("EOI: ", hex(inc_data[13+LENID+4]))
         return(False,"Checksum error")
 
-def lchksum_calc(lenid):
-
-    chksum = 0
-
-    try:
-
-        # for element in range(1, len(lenid)): #-5):
-        #     chksum += (lenid[element])
-        
-        for element in range(0, len(lenid)):
-            chksum += int(chr(lenid[element]),16)
-
-        chksum = chksum % 16
-        chksum = '{0:04b}'.format(chksum)
-
-        flip_bits = '' 
-        for i in chksum:
-            if i == '0':
-                flip_bits += '1'
-            else:
-                flip_bits += '0'
-
-        chksum = flip_bits
-        chksum = int(chksum,2)
-
-        chksum += 1
-
-        if chksum > 15:
-            chksum = 0
-
-        chksum = format(chksum, 'X')
-
-    except:
-
-        print("Error calculating LCHKSUM using LENID: ", lenid)
-        return(False)
-
-    return(chksum)
-
-def bms_request(bms, adr,cid1=b"\x34\x36",cid2=b"\x43\x31",info=b"",LENID=False):
+def bms_request(bms, adr,cid1=b"\x34\x36",cid2=b"\x43\x31",info=b""):
     # adr=b"\x30\x31"
 
     global bms_connected
     global debug_output
     
-    request = b'\x7e'
-    request += b"\x32\x31" #ver
-    request += adr
-    request += cid1
-    request += cid2
-
-    if not(LENID):
-        LENID = len(info)
-        #print("Length: ", LENID)
-        LENID = bytes(format(LENID, '03X'), "ASCII")
-
-    #print("LENID: ", LENID)
-
-    if LENID == b'000':
-        LCHKSUM = '0'
-    else:
-        LCHKSUM = lchksum_calc(LENID)
-        if LCHKSUM == False:
-            return(False,"Error calculating LCHKSUM)")
-    #print("LCHKSUM: ", LCHKSUM)
-    request += bytes(LCHKSUM, "ASCII")
-    request += LENID
-    request += info
-    CHKSUM = bytes(chksum_calc(request), "ASCII")
-    if CHKSUM == False:
-        return(False,"Error calculating CHKSUM)")
-    request += CHKSUM
-    request += b'\x0d'
+    request = codec.build_request(layouts.VOLTA_SG1["ver"], adr, cid1, cid2, info)
 
     if debug_output > 2:
         print("-> Outgoing Data: ", request)
 
+    # Complete frames still buffered are late replies to earlier requests
+    stale = reassembler.pending_frames()
+    if (len(stale) > 0) & (debug_output > 0):
+        print("Discarding stale frames: " + str(stale))
+
     if not bms_sendData(bms,request):
         bms_connected = False
         print("Error, connection to BMS lost")
@@ -666,7 +636,8 @@ def bms_getVersion(comms):
 
     try:
 
-        bms_version = bytes.fromhex(INFO.decode("ascii")).decode("ASCII")
+        version.decode(INFO)
+        bms_version = version.bms_version
         client.publish(config['mqtt_base_topic'] + "/bms_version",bms_version)
         print("BMS Version: " + bms_version)
     except:
@@ -687,8 +658,9 @@ def bms_getSerial(comms):
 
     try:
 
-        bms_sn = bytes.fromhex(INFO[0:30].decode("ascii")).decode("ASCII").replace(" ", "") #Remove spaces to prevent the unique ID having spaces
-        pack_sn = bytes.fromhex(INFO[40:68].decode("ascii")).decode("ASCII").replace(" ", "")
+        serial_number.decode(INFO)
+        bms_sn = serial_number.bms_sn.replace(" ", "") #Remove spaces to prevent the unique ID having spaces
+        pack_sn = serial_number.pack_sn.replace(" ", "")
         client.publish(config['mqtt_base_topic'] + "/bms_sn",bms_sn)
         client.publish(config['mqtt_base_topic'] + "/pack_sn",pack_sn)
         print("BMS Serial Number: " + bms_sn)
@@ -701,13 +673,6 @@ def bms_getSerial(comms):
 
 def bms_getAnalogData(bms,adr,batNumber):
 
-    global print_initial
-    global cells
-    global temps
-    global packs
-    byte_index = 0
-
-
     p = adr
     battery = bytes(format(batNumber, '02X'), 'ASCII')
     adr = bytes(format(adr, '02X'), 'ASCII')
@@ -724,210 +689,33 @@ def bms_getAnalogData(bms,adr,batNumber):
         return(False,inc_data)
 
     try:
-
-        # Read one pack at a time, therefore remove this section:
-        # packs = int(inc_data[byte_index:byte_index+2],16)
-        # if print_initial:
-        #     print("Packs: " + str(packs))
-        # byte_index += 2
-        byte_index = 2
-
-        v_cell = {}
-        t_cell = {}
-
-        if p > 1:
-            cells_prev = cells
-
-        cells = int(inc_data[byte_index:byte_index+2],16)
-
-        #Possible remove this next test as were now testing for the INFOFLAG at the end
-        # if p > 1:
-        #     if cells != cells_prev:
-        #         byte_index += 2
-        #         cells = int(inc_data[byte_index:byte_index+2],16)
-        #         if cells != cells_prev:
-        #             print("Error parsing BMS analog data: Cannot read multiple packs")
-        #             return(False,"Error parsing BMS analog data: Cannot read multiple packs")
-
-        if print_initial:
-            print("Pack " + str(p) + ", Total cells: " + str(cells))
-        byte_index += 2
-        
-        cell_min_volt = 0
-        cell_max_volt = 0
-
-        for i in range(0,cells):
-            v_cell[(p-1,i)] = int(inc_data[byte_index:byte_index+4],16)
-            byte_index += 4
-            client.publish(config['mqtt_base_topic'] + "/pack_" + str(p) + "/v_cells/cell_" + str(i+1) ,str(v_cell[(p-1,i)]))
-            if print_initial:
-                print("Pack " + str(p) +", V Cell" + str(i+1) + ": " + str(v_cell[(p-1,i)]) + " mV")
-
-            #Calculate cell max and min volt
-            if i == 0:
-                cell_min_volt = v_cell[(p-1,i)]
-                cell_max_volt = v_cell[(p-1,i)]
-            else:
-                if v_cell[(p-1,i)] < cell_min_volt:
-                    cell_min_volt = v_cell[(p-1,i)]
-                if v_cell[(p-1,i)] > cell_max_volt:
-                    cell_max_volt = v_cell[(p-1,i)]
-        
-        #Calculate cells max diff volt
-        cell_max_diff_volt = cell_max_volt - cell_min_volt
-        client.publish(config['mqtt_base_topic'] + "/pack_" + str(p) + "/cells_max_diff_calc" ,str(cell_max_diff_volt))
-        if print_initial:
-            print("Pack " + str(p) +", Cell Max Diff Volt Calc: " + str(cell_max_diff_volt) + " mV")
-
-        temps = int(inc_data[byte_index:byte_index + 2],16)
-        if print_initial:
-            print("Pack " + str(p) + ", Total temperature sensors: " + str(temps))
-        byte_index += 2
-
-        for i in range(0,temps): #temps-2
-            t_cell[(p-1,i)] = int(inc_data[byte_index:byte_index + 4],16) -40
-            byte_index += 4
-            client.publish(config['mqtt_base_topic'] + "/pack_" + str(p) + "/temps/temp_" + str(i+1) ,str(round(t_cell[(p-1,i)],1)))
-            if print_initial:
-                print("Pack " + str(p) + ", Temp" + str(i+1) + ": " + str(round(t_cell[(p-1,i)],1)) + " ℃")
-
-        # t_mos= (int(inc_data[byte_index:byte_index+4],16))/160-273
-        # client.publish(config['mqtt_base_topic'] + "/t_mos",str(round(t_mos,1)))
-        # if print_initial:
-        #     print("T Mos: " + str(t_mos) + " Deg")
-
-        # t_env= (int(inc_data[byte_index:byte_index+4],16))/160-273
-        # client.publish(config['mqtt_base_topic'] + "/t_env",str(round(t_env,1)))
-        # offset += 7
-        # if print_initial:
-        #     print("T Env: " + str(t_env) + " Deg")
-
-        i_pack.append(int(inc_data[byte_index:byte_index+4],16))
-        byte_index += 4
-        if i_pack[p-1] >= 32768:
-            i_pack[p-1] = -1*(65535 - i_pack[p-1])
-        i_pack[p-1] = i_pack[p-1]/100
-        client.publish(config['mqtt_base_topic'] + "/pack_" + str(p) + "/i_pack",str(i_pack[p-1]))
-        if print_initial:
-            print("Pack " + str(p) + ", I Pack: " + str(i_pack[p-1]) + " A")
-
-        v_pack.append(int(inc_data[byte_index:byte_index+4],16)/100)
-        byte_index += 4
-        client.publish(config['mqtt_base_topic'] + "/pack_" + str(p) + "/v_pack",str(v_pack[p-1]))
-        if print_initial:
-            print("Pack " + str(p) + ", V Pack: " + str(v_pack[p-1]) + " V")
-
-        i_remain_cap.append(int(inc_data[byte_index:byte_index+4],16)*10)
-        byte_index += 4
-        client.publish(config['mqtt_base_topic'] + "/pack_" + str(p) + "/i_remain_cap",str(i_remain_cap[p-1]))
-        if print_initial:
-            print("Pack " + str(p) + ", I Remaining Capacity: " + str(i_remain_cap[p-1]) + " mAh")
-
-        byte_index += 2 # Manual: Define number P = 3
-
-        i_full_cap.append(int(inc_data[byte_index:byte_index+4],16)*10)
-        byte_index += 4
-        client.publish(config['mqtt_base_topic'] + "/pack_" + str(p) + "/i_full_cap",str(i_full_cap[p-1]))
-        if print_initial:
-            print("Pack " + str(p) + ", I Full Capacity: " + str(i_full_cap[p-1]) + " mAh")
-
-        cycles.append(int(inc_data[byte_index:byte_index+4],16))
-        byte_index += 4
-        client.publish(config['mqtt_base_topic'] + "/pack_" + str(p) + "/cycles",str(cycles[p-1]))
-        if print_initial:
-            print("Pack " + str(p) + ", Cycles: " + str(cycles[p-1]))
-
-        soc.append(int(inc_data[byte_index:byte_index+2],16))
-        byte_index += 2
-        client.publish(config['mqtt_base_topic'] + "/pack_" + str(p) + "/soc",str(soc[p-1]))
-        if print_initial:
-            print("Pack " + str(p) + ", SOC: " + str(soc[p-1]) + " %")
-
-        # i_design_cap.append(int(inc_data[byte_index:byte_index+4],16)*10)
-        # byte_index += 4
-        # client.publish(config['mqtt_base_topic'] + "/pack_" + str(p) + "/i_design_cap",str(i_design_cap[p-1]))
-        # if print_initial:
-        #     print("Pack " + str(p) + ", Design Capacity: " + str(i_design_cap[p-1]) + " mAh")
-
-        soh.append(int(inc_data[byte_index:byte_index+2],16))
-        byte_index += 2
-        client.publish(config['mqtt_base_topic'] + "/pack_" + str(p) + "/soh",str(soh[p-1]))
-        if print_initial:
-            print("Pack " + str(p) + ", SOH: " + str(soh[p-1]) + " %")
-
-        #byte_index += 2
-
-        # byte_index += int(config['force_pack_offset'])
-
-        #Test for non signed value (matching cell count), to skip possible INFOFLAG present in data
-        # if p < packs: #Test - Is there more packs to read?
-        #     while (byte_index < len(inc_data)) and (cells != int(inc_data[byte_index:byte_index+2],16)):
-        #         byte_index += 2
-        #         if byte_index > len(inc_data):
-        #             print("Error parsing BMS analog data: Cannot read multiple packs")
-        #             return(False,"Error parsing BMS analog data: Cannot read multiple packs")
-
-
+        # One pack per address, always at index 0 of the decoded response
+        analog.decode(inc_data)
+        packs = snapshot.packs_from(analog, first_pack=p)
     except Exception as e:
         print("Error parsing BMS analog data: ", str(e))
         return(False,"Error parsing BMS analog data: " + str(e))
 
-    if print_initial:
-        print("Script running....")
-
-    return True,True
+    return True,packs
 
 def bms_getPackCapacity(bms):
 
-    byte_index = 0
-
     success, inc_data = bms_request(bms,cid2=constants.cid2PackCapacity) # Seem to always reply with pack 1 data, even with ADR= 0 or FF and INFO= '' or FF
 
     if success == False:
         return(False,inc_data)
 
     try:
-
-        pack_remain_cap = int(inc_data[byte_index:byte_index+4],16)*10
-        byte_index += 4
-        client.publish(config['mqtt_base_topic'] + "/pack_remain_cap",str(pack_remain_cap))
-        if print_initial:
-            print("Pack Remaining Capacity: " + str(pack_remain_cap) + " mAh")
-
-        pack_full_cap = int(inc_data[byte_index:byte_index+4],16)*10
-        byte_index += 4
-        client.publish(config['mqtt_base_topic'] + "/pack_full_cap",str(pack_full_cap))
-        if print_initial:
-            print("Pack Full Capacity: " + str(pack_full_cap) + " mAh")
-
-        pack_design_cap = int(inc_data[byte_index:byte_index+4],16)*10
-        byte_index += 4
-        client.publish(config['mqtt_base_topic'] + "/pack_design_cap",str(pack_design_cap))
-        if print_initial:
-            print("Pack Design Capacity: " + str(pack_design_cap) + " mAh")
-
-        pack_soc = round(pack_remain_cap/pack_full_cap*100,2)
-        client.publish(config['mqtt_base_topic'] + "/pack_soc",str(pack_soc))
-        if print_initial:
-            print("Pack SOC: " + str(pack_soc) + " %")
-
-        pack_soh = round(pack_full_cap/pack_design_cap*100,2)
-        client.publish(config['mqtt_base_topic'] + "/pack_soh",str(pack_soh))
-        if print_initial:
-            print("Pack SOH: " + str(pack_soh) + " %")
-
+        capacity.decode(inc_data)
+        pack_capacity = snapshot.capacity_from(capacity)
     except Exception as e:
         print("Error parsing BMS pack capacity data: ", str(e))
         return False, "Error parsing BMS pack capacity data: " + str(e)
 
-    return True,True
+    return True,pack_capacity
 
 def bms_getWarnInfo(bms,adr,batNumber):
 
-    byte_index = 2
-    packsW = 1
-    warnings = ""
-
     p = adr
     adr = bytes(format(adr, '02X'), 'ASCII')
     battery = bytes(format(batNumber, '02X'), 'ASCII')
@@ -937,166 +725,14 @@ def bms_getWarnInfo(bms,adr,batNumber):
     if success == False:
         return(False,inc_data)
 
-    #inc_data = b'000210000000000000000000000000000000000600000000000000000000000E0000000000001110000000000000000000000000000000000600000000000000000000000E00000000000000'
-    
-
     try:
-
-        packsW = int(inc_data[byte_index:byte_index+2],16)
-        if print_initial:
-            print("Packs for warnings: " + str(packs))
-        byte_index += 2
-
-        cellsW = int(inc_data[byte_index:byte_index+2],16)
-        byte_index += 2
-
-        for c in range(1,cellsW+1):
-
-            if inc_data[byte_index:byte_index+2] != b'00':
-                warn = constants.warningStates[inc_data[byte_index:byte_index+2]]
-                warnings += "cell " + str(c) + " " + warn + ", "
-            byte_index += 2
-
-        tempsW = int(inc_data[byte_index:byte_index+2],16)
-        byte_index += 2
-    
-        for t in range(1,tempsW+1):
-
-            if inc_data[byte_index:byte_index+2] != b'00':
-                warn = constants.warningStates[inc_data[byte_index:byte_index+2]]
-                warnings += "temp " + str(t) + " " + warn + ", "
-            byte_index += 2
-
-        if inc_data[byte_index:byte_index+2] != b'00':
-            warn = constants.warningStates[inc_data[byte_index:byte_index+2]]
-            warnings += "charge current " + warn + ", "
-        byte_index += 2
-
-        if inc_data[byte_index:byte_index+2] != b'00':
-            warn = constants.warningStates[inc_data[byte_index:byte_index+2]]
-            warnings += "total voltage " + warn + ", "
-        byte_index += 2
-
-        if inc_data[byte_index:byte_index+2] != b'00':
-            warn = constants.warningStates[inc_data[byte_index:byte_index+2]]
-            warnings += "discharge current " + warn + ", "
-        byte_index += 2
-
-        protectState1 = ord(bytes.fromhex(inc_data[byte_index:byte_index+2].decode('ascii')))
-        if protectState1 > 0:
-            warnings += "Protection State 1: "
-            for x in range(0,8):
-                if (protectState1 & (1<<x)):
-                    warnings += constants.protectState1[x+1] + " | "
-            warnings = warnings.rstrip("| ")
-            warnings += ", "
-        client.publish(config['mqtt_base_topic'] + "/pack_" + str(p) + "/prot_short_circuit",str(protectState1>>6 & 1))  
-        client.publish(config['mqtt_base_topic'] + "/pack_" + str(p) + "/prot_discharge_current",str(protectState1>>5 & 1))  
-        client.publish(config['mqtt_base_topic'] + "/pack_" + str(p) + "/prot_charge_current",str(protectState1>>4 & 1))  
-        byte_index += 2
-
-        protectState2 = ord(bytes.fromhex(inc_data[byte_index:byte_index+2].decode('ascii')))
-        if protectState2 > 0:
-            warnings += "Protection State 2: "
-            for x in range(0,8):
-                if (protectState2 & (1<<x)):
-                    warnings += constants.protectState2[x+1] + " | "
-            warnings = warnings.rstrip("| ")
-            warnings += ", "
-        client.publish(config['mqtt_base_topic'] + "/pack_" + str(p) + "/fully",str(protectState2>>7 & 1))  
-        byte_index += 2
-
-        # instructionState = ord(bytes.fromhex(inc_data[byte_index:byte_index+2].decode('ascii')))
-        # if instructionState > 0:
-        #     warnings += "Instruction State: "
-        #     for x in range(0,8):
-        #         if (instructionState & (1<<x)):
-        #              warnings += constants.instructionState[x+1] + " | "
-        #     warnings = warnings.rstrip("| ")
-        #     warnings += ", "  
-        # byte_index += 2
-
-        instructionState = ord(bytes.fromhex(inc_data[byte_index:byte_index+2].decode('ascii')))
-        client.publish(config['mqtt_base_topic'] + "/pack_" + str(p) + "/current_limit",str(instructionState>>0 & 1))
-        client.publish(config['mqtt_base_topic'] + "/pack_" + str(p) + "/charge_fet",str(instructionState>>1 & 1))
-        client.publish(config['mqtt_base_topic'] + "/pack_" + str(p) + "/discharge_fet",str(instructionState>>2 & 1))
-        client.publish(config['mqtt_base_topic'] + "/pack_" + str(p) + "/pack_indicate",str(instructionState>>3 & 1))
-        client.publish(config['mqtt_base_topic'] + "/pack_" + str(p) + "/reverse",str(instructionState>>4 & 1))
-        client.publish(config['mqtt_base_topic'] + "/pack_" + str(p) + "/ac_in",str(instructionState>>5 & 1))
-        client.publish(config['mqtt_base_topic'] + "/pack_" + str(p) + "/heart",str(instructionState>>7 & 1))
-        byte_index += 2
-
-        controlState = ord(bytes.fromhex(inc_data[byte_index:byte_index+2].decode('ascii')))
-        if controlState > 0:
-            warnings += "Control State: "
-            for x in range(0,8):
-                if (controlState & (1<<x)):
-                    warnings += constants.controlState[x+1] + " | "
-            warnings = warnings.rstrip("| ")
-            warnings += ", "  
-        byte_index += 2
-
-        faultState = ord(bytes.fromhex(inc_data[byte_index:byte_index+2].decode('ascii')))
-        if faultState > 0:
-            warnings += "Fault State: "
-            for x in range(0,8):
-                if (faultState & (1<<x)):
-                    warnings += constants.faultState[x+1] + " | "
-            warnings = warnings.rstrip("| ")
-            warnings += ", "  
-        byte_index += 2
-
-        balanceState1 = '{0:08b}'.format(int(inc_data[byte_index:byte_index+2],16))
-        byte_index += 2
-
-        balanceState2 = '{0:08b}'.format(int(inc_data[byte_index:byte_index+2],16))
-        byte_index += 2
-
-        warnState1 = ord(bytes.fromhex(inc_data[byte_index:byte_index+2].decode('ascii')))
-        if warnState1 > 0:
-            warnings += "Warning State 1: "
-            for x in range(0,8):
-                if (warnState1 & (1<<x)):
-                    warnings += constants.warnState1[x+1] + " | "
-            warnings = warnings.rstrip("| ")
-            warnings += ", "  
-        byte_index += 2
-
-        warnState2 = ord(bytes.fromhex(inc_data[byte_index:byte_index+2].decode('ascii')))
-        if warnState2 > 0:
-            warnings += "Warning State 2: "
-            for x in range(0,8):
-                if (warnState2 & (1<<x)):
-                    warnings += constants.warnState2[x+1] + " | "
-            warnings = warnings.rstrip("| ")
-            warnings += ", "  
-        byte_index += 2
-
-        warnings = warnings.rstrip(", ")
-
-        client.publish(config['mqtt_base_topic'] + "/pack_" + str(p) + "/warnings",warnings)
-        if print_initial:
-            print("Pack " + str(p) + ", warnings: " + warnings)
-
-        client.publish(config['mqtt_base_topic'] + "/pack_" + str(p) + "/balancing1",balanceState1)
-        if print_initial:
-            print("Pack " + str(p) + ", balancing1: " + balanceState1)
-
-        client.publish(config['mqtt_base_topic'] + "/pack_" + str(p) + "/balancing2",balanceState2)
-        if print_initial:
-            print("Pack " + str(p) + ", balancing2: " + balanceState2)
-
-        warnings = ""
-
-        #Test for non signed value (matching cell count), to skip possible INFOFLAG present in data
-        if (byte_index < len(inc_data)) and (cellsW != int(inc_data[byte_index:byte_index+2],16)):
-            byte_index += 2
-
+        warn.decode(inc_data)
+        status = snapshot.status_from(warn, first_pack=p)
     except Exception as e:
         print("Error parsing BMS warning data: ", str(e))
         return False, "Error parsing BMS warning data: " + str(e)
 
-    return True,True
+    return True,status
 
 
 print("Connecting to BMS...")
@@ -1120,26 +756,37 @@ pack_sn = "pack_sn_volta_sg1"
 #     quit()
 
 
+rate = scheduler.FixedRate(scan_interval/2)
+last_timing = time.monotonic()
 while code_running == True:
 
     if bms_connected == True:
-        if mqtt_connected == True:
+        if mqtt_connected == True or spooling is not None:
+
+            rate.start()
 
             if bat_read > packs_to_read:
                 bat_read = 1
-                i_pack = []
-                v_pack = []
-                i_remain_cap = []
-                i_design_cap = []
-                cycles = []
-                i_full_cap = []
-                soc = []
-                soh = []
-
-            success, data = bms_getAnalogData(bms,bat_read,batNumber=255)
+
+            success, pack_data = bms_getAnalogData(bms,bat_read,batNumber=255)
             if success != True:
-                print("Error retrieving BMS analog data: " + data)
-            time.sleep(scan_interval/2)
+                print("Error retrieving BMS analog data: " + pack_data)
+            else:
+                bank = snapshot.BankSnapshot(pack_data)
+                if mqtt_connected == True:
+                    publishing.put(bank, print_initial)
+                    if print_initial:
+                        print("Script running....")
+                        if debug_output > 0:
+                            print("Publish queue: " + json.dumps(publishing.stats()))
+                else: #MQTT not connected, keep the scan for the backfill topic
+                    spooling.append(bank)
+
+                # Entity layout for HA discovery
+                cells = pack_data[0].cells
+                temps = pack_data[0].temps
+            # One pack per cycle on a fixed grid, so reads don't drift with the I/O time
+            time.sleep(rate.wait())
 
             # success, data = bms_getPackCapacity(bms)
             # if success != True:
@@ -1152,11 +799,22 @@ while code_running == True:
 
             bat_read = bat_read + 1
 
-            if print_initial:
+            if mqtt_connected == False:
+                print_initial = True
+                continue
+
+            if print_initial or (ha_discovery_enabled and not discovery_cache.published):
                 ha_discovery()
                 
             client.publish(config['mqtt_base_topic'] + "/availability","online")
 
+            if config.get('scan_timing_interval', 300) > 0 and time.monotonic() - last_timing >= config.get('scan_timing_interval', 300):
+                # Actual cycle period, jitter and overruns against scan_interval/2
+                last_timing = time.monotonic()
+                report = rate.timing.report(rate.period)
+                if report is not None:
+                    client.publish(config['mqtt_base_topic'] + "/scan_timing",json.dumps(report))
+
             print_initial = False
             
 
@@ -1165,11 +823,7 @@ while code_running == True:
                 repub_discovery = 0
                 print_initial = True
         
-        else: #MQTT not connected
-            client.loop_stop()
-            print("MQTT disconnected, trying to reconnect...")
-            client.connect(config['mqtt_host'], config['mqtt_port'], 60)
-            client.loop_start()
+        else: #MQTT not connected, the network thread reconnects
             time.sleep(5)
             print_initial = True
     else: #BMS not connected
@@ -0,0 +1,69 @@
+import functools
+
+SOI = b'\x7e'
+EOI = b'\x0d'
+
+HEX_DIGITS = b'0123456789ABCDEF'
+
+
+def chksum(data):
+
+    # CHKSUM: sum of all ASCII bytes after SOI, modulo 65536, two's complement.
+    # Returned as the 4 ASCII hex digits that go on the wire.
+    return b'%04X' % (-sum(data[1:]) & 0xFFFF)
+
+
+def lchksum(lenid):
+
+    # LCHKSUM: sum of the three LENID nibbles, modulo 16, two's complement
+    return (-((lenid >> 8) + (lenid >> 4 & 0xF) + (lenid & 0xF))) & 0xF
+
+
+# LENGTH field (LCHKSUM + 3 digit LENID) for every possible LENID
+LENGTH_FIELDS = tuple(b'%c%03X' % (HEX_DIGITS[lchksum(lenid)], lenid) for lenid in range(4096))
+
+# RTN codes that are errors
+RTN_ERRORS = {
+    b'01': "RTN Error 01: Undefined RTN error",
+    b'02': "RTN Error 02: CHKSUM error",
+    b'03': "RTN Error 03: LCHKSUM error",
+    b'04': "RTN Error 04: CID2 undefined",
+    b'05': "RTN Error 05: Undefined error",
+    b'06': "RTN Error 06: Undefined error",
+    b'09': "RTN Error 09: Operation or write error",
+}
+
+
+def parse_response(frame):
+
+    # Checks a complete response frame (SOI ... EOI) and returns (True, INFO),
+    # or (False, reason) for a bad frame or an RTN error
+    if len(frame) < 18 or frame[0] != SOI[0]:
+        return False, "Incorrect starting byte for incoming data"
+
+    error = RTN_ERRORS.get(frame[7:9])
+    if error is not None:
+        return False, error
+
+    try:
+        lenid = int(frame[10:13], 16)
+    except ValueError:
+        return False, "Invalid LENID: " + str(frame[10:13])
+
+    if frame[9] != LENGTH_FIELDS[lenid][0]:
+        return False, "LCHKSUM received: " + str(frame[9]) + " does not match calculated: " + str(LENGTH_FIELDS[lenid][0])
+
+    info = frame[13:13+lenid]
+    if frame[13+lenid:13+lenid+4] != chksum(frame[:len(frame)-5]):
+        return False, "Checksum error"
+
+    return True, info
+
+
+@functools.lru_cache(maxsize=256)
+def build_request(ver, adr, cid1, cid2, info=b''):
+
+    # Requests never change for the same arguments, so finished frames are cached
+    request = SOI + ver + adr + cid1 + cid2 + LENGTH_FIELDS[len(info)] + info
+    return request + chksum(request) + EOI
+
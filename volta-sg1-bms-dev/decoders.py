@@ -0,0 +1,221 @@
+import binascii
+import struct
+from array import array
+
+import constants
+
+# (struct format, array typecode) per scalar kind
+KINDS = {
+    "u8": ("B", "B"),
+    "u16": ("H", "H"),
+    "s16": ("h", "h"),
+}
+
+# Bytes skipped at most when resyncing on the next pack, larger gaps need force_pack_offset
+RESYNC_WINDOW = 16
+
+_blocks = {}
+
+
+def block(code, count):
+
+    # Cached big endian reader for count values of one struct type
+    s = _blocks.get((code, count))
+    if s is None:
+        s = _blocks[(code, count)] = struct.Struct('>%d%s' % (count, code))
+    return s
+
+
+class Decoder:
+
+    # Decoder for one response layout (see layouts.py). The layout is compiled once
+    # into a straight line decode function: runs of fixed size fields become a single
+    # struct read, and lists are read with one block read each. The hex INFO is
+    # converted to bytes once and all values go into arrays allocated up front for
+    # max_packs x max_items, so decoding allocates almost nothing per response.
+
+    def __init__(self, layout, max_packs=16, max_items=32, pack_offset=0, name="layout"):
+
+        self.max_packs = max_packs
+        self.max_items = max_items
+        self.units = layout.get("units", {})
+        self.packs = 0
+        self.fields = []
+        self.source = self.generate(layout, pack_offset)
+
+        namespace = {"array": array, "block": block, "struct": struct}
+        exec(compile(self.source, "<" + name + ">", "exec"), namespace)
+        self.decode_raw = namespace["decode"]
+
+        for field in layout["header"]:
+            if field[1] == "ascii":
+                setattr(self, field[0], "")
+            elif field[0] not in (None, "packs"):
+                setattr(self, field[0], 0)
+
+        for field in layout["pack"]:
+            name, kind = field[0], field[1]
+            if name is None:
+                continue
+            if kind == "count":
+                setattr(self, name, array('B', bytes(max_packs)))
+            elif kind == "words":
+                setattr(self, name, array('H', bytes(2 * max_packs * max_items)))
+            elif kind == "states":
+                setattr(self, name, array('B', bytes(max_packs * max_items)))
+            else:
+                setattr(self, name, array(KINDS[kind][1], bytes(max_packs * struct.calcsize(KINDS[kind][1]))))
+            self.fields.append((name, kind))
+
+    def generate(self, layout, pack_offset):
+
+        lines = ["def decode(d, raw):", "    size = len(raw)", "    offset = 0"]
+        has_packs = False
+
+        for field in layout["header"]:
+            name, kind = field[0], field[1]
+            if kind == "skip":
+                lines.append("    offset += %d" % field[2])
+            elif kind == "ascii":
+                end = "size" if field[2] is None else "offset + %d" % field[2]
+                lines.append("    d.%s = bytes(raw[offset:%s]).decode('ascii')" % (name, end))
+                lines.append("    offset = %s" % end)
+            elif name == "packs":
+                lines.append("    packs = raw[offset]")
+                lines.append("    offset += 1")
+                has_packs = True
+            else:
+                code = KINDS[kind][0]
+                lines.append("    d.%s, = struct.unpack_from('>%s', raw, offset)" % (name, code))
+                lines.append("    offset += %d" % struct.calcsize(code))
+
+        pack = layout["pack"]
+        if not has_packs:
+            lines.append("    packs = %d" % (1 if pack else 0))
+
+        if pack:
+            counts = [f[0] for f in pack if f[1] == "count"]
+            lines.append("    if packs > %d:" % self.max_packs)
+            lines.append("        raise ValueError('Too many packs: ' + str(packs))")
+            lines.append("    for p in range(packs):")
+
+            if counts:
+                # Resync on the first count of the previous pack, skipping INFOFLAG / padding bytes
+                lines.append("        if p > 0:")
+                if pack_offset:
+                    lines.append("            offset += %d" % pack_offset)
+                lines.append("            sync = d.%s[p-1]" % counts[0])
+                lines.append("            limit = min(size, offset + %d)" % (RESYNC_WINDOW + 1))
+                lines.append("            while offset < limit and raw[offset] != sync:")
+                lines.append("                offset += 1")
+                lines.append("            if offset >= limit:")
+                lines.append("                raise ValueError('Cannot read multiple packs')")
+                lines.append("        base = p * %d" % self.max_items)
+
+            run_fmt = ""
+            run_names = []
+
+            def flush():
+                if run_names:
+                    targets = ", ".join("d.%s[p]" % n for n in run_names)
+                    lines.append("        (%s,) = struct.unpack_from('>%s', raw, offset)" % (targets, run_fmt))
+                if run_fmt:
+                    lines.append("        offset += %d" % struct.calcsize('>' + run_fmt))
+
+            for field in pack:
+                name, kind = field[0], field[1]
+                if kind == "skip":
+                    run_fmt += "%dx" % field[2]
+                elif kind in KINDS:
+                    run_fmt += KINDS[kind][0]
+                    run_names.append(name)
+                else:
+                    flush()
+                    run_fmt = ""
+                    run_names = []
+                    if kind == "count":
+                        lines.append("        n_%s = raw[offset]" % name)
+                        lines.append("        offset += 1")
+                        lines.append("        if n_%s > %d:" % (name, self.max_items))
+                        lines.append("            raise ValueError('Too many %s: ' + str(n_%s))" % (name, name))
+                        lines.append("        d.%s[p] = n_%s" % (name, name))
+                    else:
+                        code, width = ("H", 2) if kind == "words" else ("B", 1)
+                        count = "n_" + field[2]
+                        lines.append("        d.%s[base:base + %s] = array('%s', block('%s', %s).unpack_from(raw, offset))" % (name, count, code, code, count))
+                        lines.append("        offset += %d * %s" % (width, count))
+            flush()
+
+        lines.append("    d.packs = packs")
+        lines.append("    return packs")
+        return "\n".join(lines) + "\n"
+
+    def decode(self, info):
+        return self.decode_raw(self, memoryview(binascii.unhexlify(info)))
+
+    def has(self, name):
+        return hasattr(self, name)
+
+    def convert(self, name, raw):
+        unit = self.units.get(name)
+        if unit is None:
+            return raw
+        offset, factor, divisor = unit
+        value = (raw + offset) * factor
+        if divisor != 1:
+            value = value / divisor
+        return value
+
+    def value(self, name, p):
+        return self.convert(name, getattr(self, name)[p])
+
+    def items(self, name, count_name, p):
+        base = p * self.max_items
+        return getattr(self, name)[base:base + getattr(self, count_name)[p]]
+
+    def item_values(self, name, count_name, p):
+        return [self.convert(name, raw) for raw in self.items(name, count_name, p)]
+
+
+def compile_dialect(dialect, max_packs=16, max_items=32, pack_offset=0):
+
+    # Builds one Decoder per CID2 of a dialect from layouts.py, keyed by CID2
+    decoders = {}
+    for cid2, layout in dialect.items():
+        if isinstance(cid2, bytes) and isinstance(layout, dict):
+            decoders[cid2] = Decoder(layout, max_packs, max_items, pack_offset, dialect["name"] + " " + cid2.decode())
+    return decoders
+
+
+def state_bits(state, names):
+
+    # Names of the bits set in a status byte, see constants.py
+    return " | ".join(names[x+1] for x in range(0,8) if state & (1<<x))
+
+
+def describe_warnings(warn, p):
+
+    # Human readable warning summary of pack p from a decoded 0x44 response
+    warnings = []
+
+    for label, name, count_name in (("cell", "cell_states", "cells"), ("temp", "temp_states", "temps")):
+        for i, state in enumerate(warn.items(name, count_name, p)):
+            if state != 0:
+                warnings.append(label + " " + str(i+1) + " " + constants.warningStates.get(b'%02X' % state, "user defined " + str(state)))
+
+    for label, name in (("charge current", "charge_current_state"), ("total voltage", "total_voltage_state"), ("discharge current", "discharge_current_state")):
+        state = getattr(warn, name)[p]
+        if state != 0:
+            warnings.append(label + " " + constants.warningStates.get(b'%02X' % state, "user defined " + str(state)))
+
+    for label, name, names in (("Protection State 1", "protect_state1", constants.protectState1),
+                               ("Protection State 2", "protect_state2", constants.protectState2),
+                               ("Control State", "control_state", constants.controlState),
+                               ("Fault State", "fault_state", constants.faultState),
+                               ("Warning State 1", "warn_state1", constants.warnState1),
+                               ("Warning State 2", "warn_state2", constants.warnState2)):
+        state = getattr(warn, name)[p]
+        if state > 0:
+            warnings.append(label + ": " + state_bits(state, names))
+
+    return ", ".join(warnings)
@@ -0,0 +1,97 @@
+import json
+import threading
+
+# Home Assistant discovery configs are retained on the broker, so they only need to
+# be sent again when they change. DiscoveryCache keeps the serialized configs per
+# entity layout and what was last published, and only sends the difference.
+
+# Abbreviations HA accepts in discovery payloads
+ABBREVIATIONS = {
+    "availability_topic": "avty_t",
+    "device": "dev",
+    "payload_off": "pl_off",
+    "payload_on": "pl_on",
+    "state_topic": "stat_t",
+    "unique_id": "uniq_id",
+    "unit_of_measurement": "unit_of_meas",
+    "value_template": "val_tpl",
+}
+
+
+def device_config(configs, topic, origin="bmspace"):
+
+    # Folds per entity configs {config topic: payload} into one device based
+    # discovery config (HA 2024.11 and newer). The device and availability are
+    # sent once instead of in every entity, the platform comes from the entity's
+    # <prefix>/<platform>/<node>/<object>/config topic
+    device = None
+    availability = None
+    components = {}
+
+    for entity_topic, payload in configs.items():
+        entity = json.loads(payload)
+        device = entity.pop("device", device)
+        availability = entity.pop("availability_topic", availability)
+        component = {"p": entity_topic.split("/")[-4]}
+        for key, value in entity.items():
+            component[ABBREVIATIONS.get(key, key)] = value
+        components[entity["unique_id"]] = component
+
+    document = {"dev": device, "o": {"name": origin}, "avty_t": availability, "cmps": components}
+    return {topic: json.dumps(document, separators=(',', ':'))}
+
+
+class DiscoveryCache:
+
+    def __init__(self, client, size=4):
+        self.client = client
+        self.size = size
+        self.layouts = {}
+        self.published = {}
+        self.lock = threading.Lock()
+
+    def configs(self, layout, build):
+
+        # Serialized configs {config topic: payload} for a layout tuple such as
+        # (bms_sn, packs, cells, temps). build() is only called for unseen layouts
+        configs = self.layouts.get(layout)
+        if configs is None:
+            configs = build()
+            if len(self.layouts) >= self.size:
+                self.layouts.pop(next(iter(self.layouts)))
+            self.layouts[layout] = configs
+        return configs
+
+    def stale(self, topic, payload):
+
+        # A retained config of ours that is not part of what was last published,
+        # e.g. left behind by the other discovery mode or an older layout
+        with self.lock:
+            return len(payload) > 0 and bool(self.published) and topic not in self.published
+
+    def forget(self):
+
+        # The retained configs are gone (HA or broker restart), publish all again
+        with self.lock:
+            self.published = {}
+
+    def publish(self, configs):
+
+        # Publishes configs that changed, and empties the retained config of entities
+        # that are gone so HA removes them. Returns the number of messages sent
+        with self.lock:
+            published = self.published
+            self.published = dict(configs)
+
+        sent = 0
+        for topic, payload in configs.items():
+            if published.get(topic) != payload:
+                self.client.publish(topic, payload, qos=0, retain=True)
+                sent += 1
+
+        for topic in published:
+            if topic not in configs:
+                self.client.publish(topic, "", qos=0, retain=True)
+                sent += 1
+
+        return sent
@@ -0,0 +1,70 @@
+import collections
+import math
+import time
+
+# Fixed rate scan loop of the Volta SG1 add-on, ScanTiming and FixedRate from the
+# root scheduler.py. The per command scheduling and adaptive interval there are
+# not used here; keep these two classes identical to the root copy.
+
+
+class ScanTiming:
+
+    # Actual start times of a fixed rate loop over the last window cycles: period,
+    # jitter (standard deviation of the period), lateness against the deadline, and
+    # overruns, the cycles skipped because the one before ran past their deadline
+
+    def __init__(self, window=100):
+        self.starts = collections.deque(maxlen=window + 1)
+        self.lateness = collections.deque(maxlen=window)
+        self.overruns = 0
+
+    def started(self, deadline, now):
+        self.starts.append(now)
+        self.lateness.append(max(0, now - deadline))
+
+    def report(self, target):
+
+        # Dict for the scan_timing topic, None until two cycles ran
+        starts = list(self.starts)
+        periods = [b - a for a, b in zip(starts, starts[1:])]
+        if not periods:
+            return None
+        period = sum(periods) / len(periods)
+        jitter = math.sqrt(sum((p - period) ** 2 for p in periods) / len(periods))
+        return {"target": target, "period": round(period, 3), "period_min": round(min(periods), 3),
+                "period_max": round(max(periods), 3), "jitter": round(jitter, 3),
+                "late_max": round(max(self.lateness), 3), "overruns": self.overruns, "cycles": len(periods)}
+
+
+class FixedRate:
+
+    # Cycles on absolute deadlines period seconds apart on the monotonic clock. A
+    # cycle that starts late is shortened to get back on the grid, deadlines a
+    # cycle overran are skipped instead of run late
+
+    def __init__(self, period):
+        self.period = period
+        self.deadline = None
+        self.timing = ScanTiming()
+
+    def start(self, now=None):
+        # Call at the start of every cycle
+        if now is None:
+            now = time.monotonic()
+        if self.deadline is None:
+            self.deadline = now
+        self.timing.started(self.deadline, now)
+
+    def wait(self, now=None):
+
+        # Seconds until the next deadline, call at the end of every cycle
+        if now is None:
+            now = time.monotonic()
+        if self.deadline is None:
+            self.deadline = now
+        self.deadline += self.period
+        if self.deadline <= now:
+            missed = int((now - self.deadline) // self.period) + 1
+            self.deadline += missed * self.period
+            self.timing.overruns += missed
+        return self.deadline - now